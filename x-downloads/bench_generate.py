@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for generate_videos.py against fake_wavespeed.py.
+
+Starts the fake server in a subprocess, builds a synthetic manifest of N
+images in a scratch directory, points every generate_videos path, URL and
+the R2 endpoint at the scratch directory and the fake, runs `run()` and
+reports:
+
+  jobs/sec          completed jobs / wall-clock seconds
+  time-to-feed      provider completion -> feed row flushed (p50/p90/p99/max)
+  peak RSS          of the generator process
+  bytes written     by the generator process (/proc/self/io), plus the size
+                    of the files it left behind
+  API calls         submits, 429s, polls, downloads and uploads seen by the fake
+  stages            generate_videos' own latency histograms (see Metrics)
+
+Usage:
+    python bench_generate.py [--jobs 500] [--gen-mean 5] [--rate-429 0.05]
+                             [--concurrency 3] [--webhook] [--vary FIELD=V,...]
+                             [--lora-switch S] [--lora-runs N]
+                             [--json report.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import generate_videos as gv
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _bytes_written() -> int | None:
+    """Bytes this process has written (Linux only)."""
+    try:
+        for line in Path("/proc/self/io").read_text().splitlines():
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def _build_manifest(workdir: Path, jobs: int, image_bytes: int) -> Path:
+    positions = list(gv.PROMPT_MAP)
+    items = []
+    for i in range(jobs):
+        account = f"bench{i % 7}"
+        image = workdir / "images" / account / f"{1900000000000000000 + i}_1.jpg"
+        image.parent.mkdir(parents=True, exist_ok=True)
+        image.write_bytes(i.to_bytes(8, "big") + os.urandom(max(0, image_bytes - 8)))
+        items.append({
+            "path": str(image),
+            "account": account,
+            "filename": image.name,
+            "position": positions[i % len(positions)],
+            "favorite_count": jobs - i,
+        })
+    manifest = workdir / "manifest.json"
+    manifest.write_text(json.dumps(items))
+    return manifest
+
+
+def _sandbox(workdir: Path, manifest: Path, base_url: str) -> None:
+    """Redirect every file and endpoint generate_videos touches."""
+    gv.INPUT_FILE = manifest
+    gv.PROGRESS_FILE = workdir / "generation_progress.json"
+    gv.PROGRESS_JOURNAL = workdir / "generation_progress.journal"
+    gv.GENERATED_DIR = workdir / "generated_videos"
+    gv.FEED_FILE = workdir / "feed-videos.json"
+    gv.FEED_DIR = workdir / "feed"
+    gv.CLASSIFIED_SRC = workdir / "classified_src.json"
+    gv.ENCODE_CACHE_DIR = workdir / "encode_cache"
+    gv.GENERATION_CACHE_FILE = workdir / "generation_cache.jsonl"
+    gv.METRICS_FILE = workdir / "generation_metrics.jsonl"
+    gv.LEASE_DB = workdir / "generation_leases.db"
+    gv.SPEND_LEDGER = workdir / "generation_spend.jsonl"
+    gv.STAGED_IMAGES_FILE = workdir / "staged_images.jsonl"
+    gv.PHASH_INDEX_FILE = workdir / "image_phashes.jsonl"
+    gv.SUBMIT_URL = f"{base_url}/api/v3/wavespeed-ai/wan-2.2/image-to-video-lora"
+    gv.RESULT_URL = f"{base_url}/api/v3/predictions/{{request_id}}/result"
+    os.environ["WAVESPEED_API_KEY"] = "bench"
+    os.environ["R2_ENDPOINT"] = f"{base_url}/s3"
+    os.environ["R2_ACCESS_KEY_ID"] = "bench"
+    os.environ["R2_SECRET_ACCESS_KEY"] = "bench"
+
+
+class _TimedFeedWriter(gv.FeedWriter):
+    """FeedWriter that records when each entry was flushed."""
+
+    flushed_at: dict[str, float] = {}
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._pending_paths: list[str] = []
+
+    def add(self, path: str, meta: dict, r2_url: str, extra: dict | None = None) -> None:
+        super().add(path, meta, r2_url, extra)
+        self._pending_paths.append(path)
+
+    def flush(self) -> list[str]:
+        flushed = super().flush()
+        now = time.time()
+        for path in self._pending_paths:
+            self.flushed_at[path] = now
+        self._pending_paths.clear()
+        return flushed
+
+
+def _dir_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file() and "images" not in f.parts)
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix="bench_generate_"))
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    fake = subprocess.Popen(
+        [
+            sys.executable, str(BASE_DIR / "fake_wavespeed.py"), "--port", str(port),
+            "--gen-mean", str(args.gen_mean), "--gen-sigma", str(args.gen_sigma),
+            "--lora-switch", str(args.lora_switch),
+            "--rate-429", str(args.rate_429), "--fail-rate", str(args.fail_rate),
+            "--drop-rate", str(args.drop_rate), "--webhook-loss", str(args.webhook_loss),
+            "--max-inflight-submits", str(args.max_inflight_submits),
+            "--video-bytes", str(args.video_bytes), "--seed", str(args.seed),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"{base_url}/stats", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("fake server did not start")
+
+        manifest = _build_manifest(workdir, args.jobs, args.image_bytes)
+        _sandbox(workdir, manifest, base_url)
+        gv.FeedWriter = _TimedFeedWriter
+        poll_options = {
+            "concurrency": args.poll_concurrency,
+            "min_interval": args.poll_min_interval,
+            "max_interval": args.poll_max_interval,
+        }
+
+        vary: dict[str, list] = {}
+        for field, values in args.vary or ():
+            vary.setdefault(field, []).extend(values)
+
+        written_before = _bytes_written()
+        started = time.time()
+        stdout = sys.stdout
+        if not args.verbose:
+            sys.stdout = open(os.devnull, "w")
+        try:
+            asyncio.run(gv.run(gv.RunOptions(
+                concurrency=args.concurrency,
+                delay=args.delay,
+                max_concurrency=args.max_concurrency,
+                poll_options=poll_options,
+                download_concurrency=args.download_concurrency,
+                upload_concurrency=args.upload_concurrency,
+                r2_uploader="s3",
+                webhook_port=_free_port() if args.webhook else None,
+                stage_images=args.stage_images,
+                vary=vary or None,
+                lora_runs=args.lora_runs,
+            )))
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+        elapsed = time.time() - started
+        written_after = _bytes_written()
+
+        stats = json.loads(urllib.request.urlopen(f"{base_url}/stats").read())
+        progress = json.loads(gv.PROGRESS_FILE.read_text())
+        ready_at = stats.pop("ready_at")
+        time_to_feed = [
+            flushed - ready_at[progress[path]["requestId"]]
+            for path, flushed in _TimedFeedWriter.flushed_at.items()
+            if progress.get(path, {}).get("requestId") in ready_at
+        ]
+        completed = sum(1 for e in progress.values() if e["status"] == "completed")
+        return {
+            "jobs": args.jobs,
+            "completed": completed,
+            "published": len(_TimedFeedWriter.flushed_at),
+            "wall_seconds": round(elapsed, 3),
+            "jobs_per_sec": round(completed / elapsed, 3) if elapsed else None,
+            "slowest_generation_seconds": round(
+                max((t - started for t in ready_at.values()), default=0.0), 3,
+            ),
+            "time_to_feed_seconds": {
+                p: round(v, 3) if v is not None else None
+                for p, v in (
+                    ("p50", _percentile(time_to_feed, 50)),
+                    ("p90", _percentile(time_to_feed, 90)),
+                    ("p99", _percentile(time_to_feed, 99)),
+                    ("max", _percentile(time_to_feed, 100)),
+                )
+            },
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "bytes_written": (
+                written_after - written_before
+                if written_before is not None and written_after is not None else None
+            ),
+            "state_bytes_on_disk": _dir_bytes(workdir),
+            "api": stats,
+            "stages": gv.METRICS.snapshot()["histograms"],
+            "workdir": str(workdir) if args.keep else None,
+        }
+    finally:
+        fake.terminate()
+        fake.wait()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark generate_videos.py against the local fake")
+    parser.add_argument("--jobs", type=int, default=200, help="Synthetic manifest size (default: 200)")
+    parser.add_argument("--image-bytes", type=int, default=200_000, help="Bytes per synthetic image")
+    parser.add_argument("--gen-mean", type=float, default=5.0, help="Median generation seconds (default: 5)")
+    parser.add_argument("--gen-sigma", type=float, default=0.4)
+    parser.add_argument("--lora-switch", type=float, default=0.0,
+                        help="Seconds the fake adds when consecutive jobs use different LoRA sets")
+    parser.add_argument("--lora-runs", type=int, default=0, help="Group submissions by LoRA set, as for generate_videos.py")
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--max-inflight-submits", type=int, default=0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--webhook", action="store_true", help="Use the webhook receiver instead of polling")
+    parser.add_argument("--webhook-loss", type=float, default=0.0)
+    parser.add_argument("--stage-images", action="store_true", help="Submit images by staged R2 URL")
+    parser.add_argument("--vary", action="append", type=gv.parse_vary, default=None, metavar="FIELD=V,...",
+                        help="Variant matrix, as for generate_videos.py")
+    parser.add_argument("--video-bytes", type=int, default=512 * 1024)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--max-concurrency", type=int, default=gv.AIMD_MAX_CONCURRENCY)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--poll-concurrency", type=int, default=gv.POLL_CONCURRENCY)
+    parser.add_argument("--poll-min-interval", type=float, default=gv.POLL_MIN_INTERVAL)
+    parser.add_argument("--poll-max-interval", type=float, default=gv.POLL_MAX_INTERVAL)
+    parser.add_argument("--download-concurrency", type=int, default=gv.DOWNLOAD_CONCURRENCY)
+    parser.add_argument("--upload-concurrency", type=int, default=gv.UPLOAD_CONCURRENCY)
+    parser.add_argument("--json", type=Path, default=None, help="Also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show generate_videos output")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory for inspection")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.json:
+        args.json.write_text(text)
+
+
+if __name__ == "__main__":
+    main()
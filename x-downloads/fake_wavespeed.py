@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for everything generate_videos.py talks to over the network.
+
+Serves, on one port:
+  POST /api/v3/<model>                     WaveSpeed submit (SUBMIT_URL); a ?webhook=URL
+                                           is POSTed the result when the job finishes
+  GET  /api/v3/predictions/<id>/result     WaveSpeed result (RESULT_URL)
+  GET/HEAD /videos/<id>.mp4                CloudFront-style video download (Range, ETag)
+  HEAD/PUT/POST/DELETE /s3/<bucket>/<key>  minimal S3 API for R2Uploader
+  GET  /s3/<bucket>?list-type=2            ListObjectsV2 (prefix, max-keys, continuation-token)
+  GET  /stats                              request counters as JSON
+
+Generation time, the cost of switching LoRA sets between jobs, request
+latency, 429, failure, dropped-download and lost-webhook rates and video
+size are configurable, so the generator's scheduler, progress
+store and post-generation path can be exercised and benchmarked offline.
+Signatures are not checked; uploaded bytes are hashed and dropped.
+
+Usage:
+    python fake_wavespeed.py [--port 8765] [--gen-mean S] [--gen-sigma F] [--lora-switch S]
+                             [--rate-429 P] [--fail-rate P] [--drop-rate P]
+                             [--webhook-loss P] [--video-bytes N]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+import aiohttp
+from aiohttp import web
+
+
+@dataclass
+class FakeConfig:
+    gen_mean: float = 20.0  # seconds, median submit-to-complete time
+    gen_sigma: float = 0.4  # lognormal shape of generation time
+    lora_switch: float = 0.0  # seconds added when a job's LoRA set differs from the previous job's
+    submit_latency: float = 0.05  # seconds per submit request
+    poll_latency: float = 0.01  # seconds per result request
+    rate_429: float = 0.0  # probability a submit is rejected with 429
+    max_inflight_submits: int = 0  # 429 beyond this many concurrent submits (0 = off)
+    retry_after: float = 1.0  # Retry-After seconds sent with 429s
+    fail_rate: float = 0.0  # probability a generation ends "failed"
+    drop_rate: float = 0.0  # probability a video download is cut off half way
+    webhook_loss: float = 0.0  # probability a requested webhook is never sent
+    video_bytes: int = 2 * 1024 * 1024
+    seed: int | None = None
+
+
+class FakeWaveSpeed:
+    """In-memory state behind the fake endpoints."""
+
+    def __init__(self, config: FakeConfig) -> None:
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.jobs: dict[str, dict] = {}
+        self.objects: dict[str, dict] = {}
+        self.uploads: dict[str, dict] = {}  # uploadId -> {"parts": {n: md5}, "size": int}
+        self.stats: Counter = Counter()
+        self._ids = itertools.count(1)
+        self._inflight_submits = 0
+        self._last_loras: tuple | None = None
+        self._etags: dict[int, str] = {}
+        self._webhooks: set[asyncio.Task] = set()
+        self._client: aiohttp.ClientSession | None = None
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get("/api/v3/predictions/{id}/result", self.result)
+        app.router.add_post("/api/v3/{model:.+}", self.submit)
+        app.router.add_get("/videos/{id}.mp4", self.video)
+        app.router.add_route("*", "/s3/{bucket}/{key:.+}", self.s3)
+        app.router.add_get("/s3/{bucket}", self.s3_list)
+        app.router.add_get("/stats", self.get_stats)
+        app.on_cleanup.append(self._close)
+        return app
+
+    async def _close(self, app: web.Application) -> None:
+        for task in self._webhooks:
+            task.cancel()
+        if self._client is not None:
+            await self._client.close()
+
+    # -- WaveSpeed ------------------------------------------------------------
+    async def submit(self, request: web.Request) -> web.Response:
+        self.stats["submit"] += 1
+        cfg = self.config
+        body = await request.read()
+        self.stats["submit_bytes"] += len(body)
+        over_limit = cfg.max_inflight_submits and self._inflight_submits >= cfg.max_inflight_submits
+        if over_limit or self.rng.random() < cfg.rate_429:
+            self.stats["submit_429"] += 1
+            return web.json_response(
+                {"message": "rate limited"}, status=429,
+                headers={"Retry-After": f"{cfg.retry_after:g}"},
+            )
+        self._inflight_submits += 1
+        try:
+            await asyncio.sleep(cfg.submit_latency)
+        finally:
+            self._inflight_submits -= 1
+        job_id = f"fake-{next(self._ids)}"
+        took = cfg.gen_mean * math.exp(self.rng.gauss(0, cfg.gen_sigma))
+        if cfg.lora_switch:
+            spec = json.loads(body)
+            loras = tuple(tuple(sorted(lora["path"] for lora in spec.get(slot, ())))
+                          for slot in ("loras", "high_noise_loras", "low_noise_loras"))
+            if loras != self._last_loras:
+                self.stats["lora_switch"] += 1
+                took += cfg.lora_switch
+            self._last_loras = loras
+        self.jobs[job_id] = {
+            "submitted_at": time.time(),
+            "ready_at": time.time() + took,
+            "failed": self.rng.random() < cfg.fail_rate,
+        }
+        webhook = request.query.get("webhook")
+        if webhook:
+            base = f"{request.scheme}://{request.host}"
+            task = asyncio.create_task(self._send_webhook(job_id, webhook, base, took))
+            self._webhooks.add(task)
+            task.add_done_callback(self._webhooks.discard)
+        return web.json_response({"code": 200, "data": {"id": job_id, "status": "created"}})
+
+    async def result(self, request: web.Request) -> web.Response:
+        self.stats["poll"] += 1
+        await asyncio.sleep(self.config.poll_latency)
+        job_id = request.match_info["id"]
+        if job_id not in self.jobs:
+            return web.json_response({"message": "not found"}, status=404)
+        return web.json_response({"data": self._result_data(job_id, f"{request.scheme}://{request.host}")})
+
+    def _result_data(self, job_id: str, base: str) -> dict:
+        job = self.jobs[job_id]
+        if time.time() < job["ready_at"]:
+            return {"id": job_id, "status": "processing", "outputs": []}
+        if job["failed"]:
+            return {"id": job_id, "status": "failed", "error": "fake failure"}
+        return {"id": job_id, "status": "completed", "outputs": [f"{base}/videos/{job_id}.mp4"]}
+
+    async def _send_webhook(self, job_id: str, url: str, base: str, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if self.rng.random() < self.config.webhook_loss:
+            self.stats["webhook_lost"] += 1
+            return
+        if self._client is None:
+            self._client = aiohttp.ClientSession()
+        try:
+            async with self._client.post(url, json={"data": self._result_data(job_id, base)}) as resp:
+                self.stats[f"webhook_{resp.status}"] += 1
+        except aiohttp.ClientError:
+            self.stats["webhook_error"] += 1
+
+    async def video(self, request: web.Request) -> web.StreamResponse:
+        self.stats["download" if request.method == "GET" else "download_head"] += 1
+        size = self.config.video_bytes
+        start = 0
+        status = 200
+        headers = {"Content-Type": "video/mp4", "Accept-Ranges": "bytes"}
+        headers["ETag"] = f'"{self._video_etag(size)}"'
+        range_header = request.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            start = int(range_header[6:].split("-")[0] or 0)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+        headers["Content-Length"] = str(size - start)
+        if request.method == "HEAD":
+            return web.Response(status=status, headers=headers)
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        chunk = b"\0" * (256 * 1024)
+        remaining = size - start
+        stop = remaining // 2 if self.rng.random() < self.config.drop_rate else 0
+        while remaining > stop:
+            piece = chunk[:min(len(chunk), remaining - stop)]
+            await resp.write(piece)
+            remaining -= len(piece)
+            self.stats["download_bytes"] += len(piece)
+        if stop:
+            self.stats["download_dropped"] += 1
+            request.transport.close()
+            return resp
+        await resp.write_eof()
+        return resp
+
+    def _video_etag(self, size: int) -> str:
+        # Every fake video is `size` zero bytes
+        if size not in self._etags:
+            self._etags[size] = hashlib.md5(b"\0" * size).hexdigest()
+        return self._etags[size]
+
+    # -- S3 ---------------------------------------------------------------------
+    async def s3(self, request: web.Request) -> web.Response:
+        key = f"{request.match_info['bucket']}/{request.match_info['key']}"
+        query = request.query
+        self.stats[f"s3_{request.method.lower()}"] += 1
+
+        if request.method == "HEAD":
+            obj = self.objects.get(key)
+            if obj is None:
+                return web.Response(status=404)
+            return web.Response(headers={"Content-Length": str(obj["size"]), "ETag": f'"{obj["etag"]}"'})
+
+        if request.method == "PUT" and "uploadId" in query:
+            data = await request.read()
+            upload = self.uploads[query["uploadId"]]
+            upload["parts"][int(query["partNumber"])] = hashlib.md5(data).digest()
+            upload["size"] += len(data)
+            self.stats["s3_bytes"] += len(data)
+            return web.Response(headers={"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+
+        if request.method == "PUT":
+            data = await request.read()
+            self.objects[key] = {"size": len(data), "etag": hashlib.md5(data).hexdigest()}
+            self.stats["s3_bytes"] += len(data)
+            return web.Response(headers={"ETag": f'"{self.objects[key]["etag"]}"'})
+
+        if request.method == "POST" and "uploads" in query:
+            upload_id = f"upload-{next(self._ids)}"
+            self.uploads[upload_id] = {"parts": {}, "size": 0}
+            return web.Response(
+                text=f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>",
+                content_type="application/xml",
+            )
+
+        if request.method == "POST" and "uploadId" in query:
+            upload = self.uploads.pop(query["uploadId"])
+            parts = upload["parts"]
+            digests = b"".join(parts[n] for n in sorted(parts))
+            self.objects[key] = {"size": upload["size"], "etag": f"{hashlib.md5(digests).hexdigest()}-{len(parts)}"}
+            return web.Response(
+                text="<CompleteMultipartUploadResult></CompleteMultipartUploadResult>",
+                content_type="application/xml",
+            )
+
+        if request.method == "DELETE":
+            self.uploads.pop(query.get("uploadId", ""), None)
+            self.objects.pop(key, None)
+            return web.Response(status=204)
+
+        if request.method == "GET" and key in self.objects:
+            return web.Response(body=b"\0" * self.objects[key]["size"])
+        return web.Response(status=404)
+
+    async def s3_list(self, request: web.Request) -> web.Response:
+        self.stats["s3_list"] += 1
+        bucket = request.match_info["bucket"]
+        prefix = request.query.get("prefix", "")
+        after = request.query.get("continuation-token", "")
+        limit = int(request.query.get("max-keys", 1000))
+        keys = sorted(
+            key[len(bucket) + 1:] for key in self.objects
+            if key.startswith(f"{bucket}/{prefix}") and key[len(bucket) + 1:] > after
+        )
+        page = keys[:limit]
+        contents = "".join(
+            f"<Contents><Key>{key}</Key><Size>{self.objects[f'{bucket}/{key}']['size']}</Size></Contents>"
+            for key in page
+        )
+        more = len(keys) > limit
+        token = f"<NextContinuationToken>{page[-1]}</NextContinuationToken>" if more else ""
+        return web.Response(
+            text=f"<ListBucketResult><IsTruncated>{str(more).lower()}</IsTruncated>{contents}{token}</ListBucketResult>",
+            content_type="application/xml",
+        )
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            **self.stats,
+            "jobs": len(self.jobs),
+            "objects": len(self.objects),
+            "ready_at": {job_id: job["ready_at"] for job_id, job in self.jobs.items()},
+        })
+
+
+def main() -> None:
+    defaults = FakeConfig()
+    parser = argparse.ArgumentParser(description="Local fake WaveSpeed/CDN/R2 server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--gen-mean", type=float, default=defaults.gen_mean,
+                        help=f"Median generation time in seconds (default: {defaults.gen_mean})")
+    parser.add_argument("--gen-sigma", type=float, default=defaults.gen_sigma,
+                        help=f"Lognormal sigma of generation time (default: {defaults.gen_sigma})")
+    parser.add_argument("--lora-switch", type=float, default=defaults.lora_switch,
+                        help="Seconds added to a generation whose LoRA set differs from the previous job's "
+                             "(default: 0)")
+    parser.add_argument("--submit-latency", type=float, default=defaults.submit_latency)
+    parser.add_argument("--poll-latency", type=float, default=defaults.poll_latency)
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429,
+                        help="Probability a submit gets a 429 (default: 0)")
+    parser.add_argument("--max-inflight-submits", type=int, default=defaults.max_inflight_submits,
+                        help="429 when more submits than this are in flight (default: off)")
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+    parser.add_argument("--fail-rate", type=float, default=defaults.fail_rate,
+                        help="Probability a generation fails (default: 0)")
+    parser.add_argument("--drop-rate", type=float, default=defaults.drop_rate,
+                        help="Probability a video download is cut off half way (default: 0)")
+    parser.add_argument("--webhook-loss", type=float, default=defaults.webhook_loss,
+                        help="Probability a requested webhook is never sent (default: 0)")
+    parser.add_argument("--video-bytes", type=int, default=defaults.video_bytes,
+                        help=f"Size of each generated video (default: {defaults.video_bytes})")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeConfig(
+        gen_mean=args.gen_mean,
+        gen_sigma=args.gen_sigma,
+        lora_switch=args.lora_switch,
+        submit_latency=args.submit_latency,
+        poll_latency=args.poll_latency,
+        rate_429=args.rate_429,
+        max_inflight_submits=args.max_inflight_submits,
+        retry_after=args.retry_after,
+        fail_rate=args.fail_rate,
+        drop_rate=args.drop_rate,
+        webhook_loss=args.webhook_loss,
+        video_bytes=args.video_bytes,
+        seed=args.seed,
+    )
+    print(f"Fake WaveSpeed/CDN/R2 on http://{args.host}:{args.port}  {config}", flush=True)
+    web.run_app(FakeWaveSpeed(config).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
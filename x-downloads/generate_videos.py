@@ -2,27 +2,122 @@
 """
 Batch I2V video generation using WaveSpeed API.
 
-Reads top_1000_classified.json, maps each image's position to LoRA presets,
-submits to WaveSpeed wan-2.2 i2v endpoint, and polls for results.
+Streams top_1000_classified.json (or any --input manifest, JSON array or
+JSON lines, optionally filtered), maps each image's position to LoRA presets,
+submits to WaveSpeed wan-2.2 i2v endpoint, and polls for results. Each
+finished video is downloaded, uploaded to R2 and appended to the feed as soon
+as its own prediction completes.
 
-Restartable: tracks progress in generation_progress.json.
+Restartable: tracks progress in generation_progress.json (snapshot) plus
+generation_progress.journal (append-only log of state changes since the
+last snapshot).
 
 Usage:
-    python generate_videos.py [--concurrency N] [--delay S] [--dry-run]
+    python generate_videos.py [--concurrency N] [--max-concurrency N] [--delay S] [--dry-run]
+                              [--poll-concurrency N] [--poll-min-interval S]
+                              [--poll-max-interval S] [--poll-jitter F]
+                              [--download-concurrency N] [--upload-concurrency N]
+                              [--r2-uploader auto|s3|wrangler]
+                              [--encode-workers N] [--max-image-side PX] [--legacy-feed]
+                              [--metrics-port PORT] [--metrics-interval S]
+                              [--workers N | --worker NAME] [--lease-seconds S]
+                              [--api-key-env VAR]
+                              [--input FILE] [--account NAME]... [--position NAME]...
+                              [--min-favorites N]
+                              [--order priority|manifest] [--priority-field FIELD]
+                              [--account-weight NAME=W]... [--position-weight NAME=W]...
+                              [--priority-window N] [--lora-runs N] [--lora-window N]
+                              [--dedup] [--dedup-threshold BITS] [--dedup-workers N]
+                              [--budget-seconds S] [--budget-cost USD] [--budget-run ID]
+                              [--daily-budget-seconds S] [--daily-budget-cost USD]
+                              [--cost-per-second USD] [--deadline WHEN]
+                              [--webhook-port PORT] [--webhook-host ADDR] [--webhook-url URL]
+                              [--stage-images] [--presets FILE] [--vary FIELD=V,...]...
+                              [--postprocess] [--postprocess-workers N] [--poster-format jpg|webp]
+    python generate_videos.py reconcile [--repair] [--delete-orphans] [--stale-hours H]
+                                        [--report FILE]
+    python generate_videos.py [--input FILE ...] plan [--concurrency-grid N,N,...]
+                                                      [--delay-grid S,S,...] [--runs N] [--seed N]
+
+With --workers N (or one --worker NAME per process/machine), several
+workers share generation_leases.db: each claims jobs under a renewable
+lease, uses its own API key and rate limit, and takes over the jobs of a
+worker whose lease expired.
+
+Items are submitted highest priority first (favorite_count, weighted per
+account and position), ranked within a sliding window of 10,000 items so
+memory stays bounded (--priority-window 0 ranks the whole manifest).
+Budgets cap generated seconds or cost per run (all --workers together)
+and per UTC day (across runs); every process reserves through one locked
+ledger, generation_spend.jsonl, so together they cannot overshoot them.
+--deadline stops submitting once a new job could no longer finish in
+time. --lora-runs N sends jobs that load the same LoRA weights in runs of
+up to N, and the final results compare generation time right after the
+same set vs after a switch, per set.
+
+--dedup perceptually hashes every manifest image (cached in
+image_phashes.jsonl) and submits only the highest-priority image of each
+cluster of near-duplicates (_1/_2 shots of one tweet, reposts); the others
+are recorded with duplicateOf and take over its video once it is published.
+
+With --webhook-port, WaveSpeed calls a local receiver when each prediction
+finishes (expose it with --webhook-url); jobs are then polled only rarely,
+as a safety net for lost callbacks.
+
+`reconcile` lists the R2 prefix once and scans generated_videos/, the
+progress file and the feed once each, then reports (with --repair, fixes)
+stale submissions, missing uploads, missing feed rows and orphans.
+
+--vary (or "variants" in a --presets file) fans each image out into a
+matrix of variants, e.g. --vary scale=0.8,1.2 --vary duration=5,8. The
+variants share one encoded/staged image, are tracked as <path>#A, #B, ...
+and appear in the feed together as "... - Variant A", "... - Variant B".
+
+Every job records per-stage timestamps and submit/poll counts in the
+progress file. `plan` fits stage-time and 429 distributions to them and
+simulates the outstanding manifest under a grid of --concurrency/--delay
+settings, predicting makespan, API calls and cost before anything is spent.
+
+Per-stage metrics (in-flight gauges, latency histograms, counters) are
+appended to generation_metrics.jsonl and, with --metrics-port, served as
+Prometheus text.
 """
 
 import argparse
 import asyncio
 import base64
+import fcntl
+import hashlib
+import hmac
+import io
+import itertools
 import json
+import heapq
+import math
 import os
+import random
+import re
+import secrets
+import shutil
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Mapping, NamedTuple, Sequence
+from urllib.parse import parse_qsl, quote, urlsplit
 
 import aiohttp
+from aiohttp import web
+from yarl import URL
 
 # ---------------------------------------------------------------------------
 # Paths
@@ -30,11 +125,33 @@ import aiohttp
 BASE_DIR = Path(__file__).resolve().parent
 PROJECT_DIR = BASE_DIR.parent  # gaylyfans root
 INPUT_FILE = BASE_DIR / "top_1000_classified.json"
+MANIFEST_READ_SIZE = 64 * 1024  # bytes per read when streaming a JSON-array manifest
+MANIFEST_BATCH = 256  # items parsed/filtered per trip to the reader thread
 PROGRESS_FILE = BASE_DIR / "generation_progress.json"
+PROGRESS_JOURNAL = BASE_DIR / "generation_progress.journal"
+PROGRESS_COMPACT_EVERY = 500  # min journal records between snapshot rewrites (more once there are many entries)
 GENERATED_DIR = BASE_DIR / "generated_videos"
-FEED_FILE = PROJECT_DIR / "src" / "data" / "feed-videos.json"
+FEED_FILE = PROJECT_DIR / "src" / "data" / "feed-videos.json"  # legacy flat export
+FEED_DIR = PROJECT_DIR / "src" / "data" / "feed"  # sharded feed, see FeedWriter
 CLASSIFIED_SRC = PROJECT_DIR / "src" / "x-downloads-data" / "top_1000_classified.json"
 ENV_GLOBAL = Path.home() / ".claude" / ".env.global"
+ENCODE_CACHE_DIR = BASE_DIR / "encode_cache"
+GENERATION_CACHE_FILE = BASE_DIR / "generation_cache.jsonl"
+STAGED_IMAGES_FILE = BASE_DIR / "staged_images.jsonl"  # image hash -> public R2 URL (--stage-images)
+PHASH_INDEX_FILE = BASE_DIR / "image_phashes.jsonl"  # image path -> perceptual hash (--dedup)
+METRICS_FILE = BASE_DIR / "generation_metrics.jsonl"
+LEASE_DB = BASE_DIR / "generation_leases.db"  # shared job table for --workers/--worker
+SPEND_LEDGER = BASE_DIR / "generation_spend.jsonl"  # budget reservations and billable submissions
+
+# ---------------------------------------------------------------------------
+# Image encoding
+# ---------------------------------------------------------------------------
+ENCODE_WORKERS = 4  # threads reading/hashing/base64-encoding source images
+ENCODE_CACHE_BYTES = 512 * 1024 * 1024  # on-disk data URI cache budget
+ENCODE_JPEG_QUALITY = 90  # used when --max-image-side re-encodes an image
+PHASH_SIDE = 32  # px; images are shrunk to this square before the DCT
+DEDUP_THRESHOLD = 6  # max differing bits (of 64) for two images to count as near-duplicates
+DEDUP_WORKERS = os.cpu_count() or 2  # processes hashing images with --dedup
 
 # ---------------------------------------------------------------------------
 # R2 config
@@ -42,6 +159,17 @@ ENV_GLOBAL = Path.home() / ".claude" / ".env.global"
 R2_BUCKET = "gaygayfans"
 R2_PREFIX = "gaylyfans/generated"
 R2_PUBLIC_URL = "https://pub-be9e0552363545c5a4778d2715805f99.r2.dev"
+# S3-compatible API. Credentials come from R2_ACCESS_KEY_ID / R2_SECRET_ACCESS_KEY
+# and the endpoint from R2_ENDPOINT (or R2_ACCOUNT_ID); without them uploads
+# fall back to wrangler. Point R2_ENDPOINT at a local stand-in for testing.
+R2_REGION = "auto"
+R2_MULTIPART_THRESHOLD = 64 * 1024 * 1024  # bytes; larger files go multipart
+R2_PART_SIZE = 16 * 1024 * 1024
+R2_PART_CONCURRENCY = 4  # parallel part uploads per multipart file
+R2_IMAGE_PREFIX = "gaylyfans/sources"  # staged source images, keyed by content hash
+R2_POSTER_PREFIX = "gaylyfans/thumbnails"  # <key>.jpg, where the admin pages look for thumbnails
+R2_PREVIEW_PREFIX = "gaylyfans/previews"
+R2_LIST_PAGE = 1000  # keys per ListObjectsV2 call (the S3 maximum)
 
 # ---------------------------------------------------------------------------
 # API — standard wan-2.2 (NOT spicy, per FINDINGS.md)
@@ -49,9 +177,83 @@ R2_PUBLIC_URL = "https://pub-be9e0552363545c5a4778d2715805f99.r2.dev"
 API_BASE = "https://api.wavespeed.ai/api/v3"
 SUBMIT_URL = f"{API_BASE}/wavespeed-ai/wan-2.2/image-to-video-lora"
 RESULT_URL = f"{API_BASE}/predictions/{{request_id}}/result"
-POLL_INTERVAL = 5  # seconds
+POLL_MIN_INTERVAL = 2.0  # seconds between polls once a job is overdue
+POLL_MAX_INTERVAL = 30.0  # backoff cap per job
+POLL_BACKOFF = 1.5  # interval multiplier per unfinished overdue poll
+POLL_JITTER = 0.2  # +/- fraction applied to every poll delay
+POLL_CONCURRENCY = 8  # max result GETs in flight at once
+POLL_STATS_INTERVAL = 30.0  # seconds between [progress] lines while polling
+WEBHOOK_HOST = "127.0.0.1"  # receiver bind address; expose it with --webhook-url
+WEBHOOK_PATH = "/wavespeed/webhook"
+WEBHOOK_FALLBACK_POLL = 120.0  # seconds between safety-net polls of a job awaiting its webhook
+WEBHOOK_EARLY_MAX = 1000  # callbacks held for jobs whose submit is still being recorded
+RECONCILE_STALE_HOURS = 24.0  # a job `submitted` longer ago than this is re-checked by reconcile
+
+# ---------------------------------------------------------------------------
+# Pipeline stages
+# ---------------------------------------------------------------------------
+STAGE_QUEUE_SIZE = 64  # max items buffered between two stages
+DOWNLOAD_CONCURRENCY = 4
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes per off-loop disk write
+DOWNLOAD_ATTEMPTS = 4  # per video; each retry resumes where the last one stopped
+DOWNLOAD_RETRY_DELAY = 2.0  # seconds, times the attempt number
+UPLOAD_CONCURRENCY = 2
+POSTPROCESS_WORKERS = os.cpu_count() or 2  # ffmpeg jobs at once with --postprocess
+POSTER_SECOND = 0.5  # where in the video the poster frame is taken
+PREVIEW_HEIGHT = 480  # px; preview rendition height
+PREVIEW_CRF = 30  # x264 quality of the preview rendition
+FEED_FLUSH_INTERVAL = 2.0  # seconds; max delay before a new row hits the feed file
+FEED_PAGE_SIZE = 100  # entries per feed page shard
+FEED_GENERIC_TAGS = {"ai", "wan2.1", "wan2.2", "lora", "generated"}  # not indexed
+VIDEO_DURATION = 5  # seconds
+VARIANT_FIELDS = ("scale", "prompt", "duration")  # axes of a variant matrix (--vary / "variants")
+VARIANT_LABELS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"  # one per variant; also caps the matrix size
+VARIANT_IMAGE_MEMO = 16  # images kept prepared for variants still being submitted
 MAX_RETRIES = 5
 RETRY_BASE_DELAY = 2.0  # seconds, doubles each retry
+AIMD_MAX_CONCURRENCY = 16  # ceiling for the adaptive submission limit
+AIMD_INCREASE = 1.0  # slots added per limit's worth of successful submits
+AIMD_DECREASE = 0.5  # limit multiplier on 429/5xx
+AIMD_COOLDOWN = 2.0  # seconds; throttles closer together count as one event
+
+# ---------------------------------------------------------------------------
+# Priority and budgets
+# ---------------------------------------------------------------------------
+PRIORITY_FIELD = "favorite_count"  # manifest field scoring an item (higher goes first)
+PRIORITY_WINDOW = 10_000  # items ranked at a time (--priority-window; 0 ranks the whole manifest)
+COST_PER_SECOND = 0.04  # USD per generated second; approximate, override with --cost-per-second
+DEADLINE_FALLBACK_SECONDS = 300.0  # assumed generation time before any job has completed
+DEADLINE_MARGIN = 30.0  # seconds left for download/upload/feed after a generation
+LORA_BATCH_WINDOW = 128  # pending jobs looked over when forming --lora-runs
+
+# ---------------------------------------------------------------------------
+# Capacity planning (plan)
+# ---------------------------------------------------------------------------
+PLAN_DEFAULT_SECONDS = {  # assumed per-stage times until runs have recorded some
+    "submit": 1.0,
+    "generation": DEADLINE_FALLBACK_SECONDS,
+    "download": 5.0,
+    "upload": 5.0,
+}
+PLAN_CONCURRENCY = "1,2,3,4,6,8"  # default --concurrency grid
+PLAN_DELAY = "0,1,2"  # default --delay grid
+PLAN_RUNS = 5  # simulated runs per setting
+
+# ---------------------------------------------------------------------------
+# Coordinated workers (--workers / --worker)
+# ---------------------------------------------------------------------------
+LEASE_SECONDS = 120.0  # a job is reclaimable this long after its worker's last renewal
+LEASE_CLAIM_BATCH = 8  # jobs claimed at a time; small so idle workers can share the tail
+LEASE_IDLE_POLL = 5.0  # seconds between claim attempts while others hold every job
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+METRICS_INTERVAL = 10.0  # seconds between JSON-lines snapshots
+METRICS_HOST = "127.0.0.1"  # --metrics-port binds here
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+THROUGHPUT_BUCKETS = tuple(2 ** n for n in range(16, 31, 2))  # bytes/sec, 64 KiB/s .. 1 GiB/s
 
 # ---------------------------------------------------------------------------
 # LoRA URLs (from FINDINGS.md)
@@ -78,70 +280,72 @@ LORA_URLS = {
 # ANIME images: position LoRA only at 1.5 in high_noise_loras (no Gay LoRA)
 # From FINDINGS.md: "Anime (any pose) — Position LoRA 1.5 only (no Gay LoRA, no NSFW-H)"
 # ---------------------------------------------------------------------------
+LORA_CONFIGS: dict[str, dict] = {
+    "anal_cowgirl": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["cowgirl_high"], "scale": 1.5},
+        ],
+    },
+    "cowgirl": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["cowgirl_high"], "scale": 1.5},
+        ],
+    },
+    "anal_doggy": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["doggy_high"], "scale": 1.5},
+        ],
+    },
+    "doggy": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["doggy_high"], "scale": 1.5},
+        ],
+    },
+    "oral": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["oral_high"], "scale": 1.5},
+        ],
+    },
+    "handjob": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["handjob_high"], "scale": 1.2},
+            {"path": LORA_URLS["orgasm_high"], "scale": 0.8},
+        ],
+    },
+    "facial": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["facial_high"], "scale": 1.0},
+        ],
+        "low_noise_loras": [
+            {"path": LORA_URLS["cumshot_low"], "scale": 1.2},
+        ],
+    },
+    "anal_missionary": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["missionary_high"], "scale": 1.5},
+        ],
+    },
+    "missionary": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["missionary_high"], "scale": 1.5},
+        ],
+    },
+    "footjob": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["handjob_high"], "scale": 1.2},
+        ],
+    },
+    "general": {
+        "high_noise_loras": [
+            {"path": LORA_URLS["nsfw_general_high"], "scale": 1.0},
+        ],
+    },
+}
+
+
 def get_lora_config(position: str) -> dict:
     """Return {high_noise_loras, low_noise_loras, loras} for given position."""
-    configs = {
-        "anal_cowgirl": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["cowgirl_high"], "scale": 1.5},
-            ],
-        },
-        "cowgirl": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["cowgirl_high"], "scale": 1.5},
-            ],
-        },
-        "anal_doggy": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["doggy_high"], "scale": 1.5},
-            ],
-        },
-        "doggy": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["doggy_high"], "scale": 1.5},
-            ],
-        },
-        "oral": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["oral_high"], "scale": 1.5},
-            ],
-        },
-        "handjob": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["handjob_high"], "scale": 1.2},
-                {"path": LORA_URLS["orgasm_high"], "scale": 0.8},
-            ],
-        },
-        "facial": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["facial_high"], "scale": 1.0},
-            ],
-            "low_noise_loras": [
-                {"path": LORA_URLS["cumshot_low"], "scale": 1.2},
-            ],
-        },
-        "anal_missionary": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["missionary_high"], "scale": 1.5},
-            ],
-        },
-        "missionary": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["missionary_high"], "scale": 1.5},
-            ],
-        },
-        "footjob": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["handjob_high"], "scale": 1.2},
-            ],
-        },
-        "general": {
-            "high_noise_loras": [
-                {"path": LORA_URLS["nsfw_general_high"], "scale": 1.0},
-            ],
-        },
-    }
-    return configs.get(position, configs["general"])
+    return LORA_CONFIGS.get(position, LORA_CONFIGS["general"])
 
 
 # ---------------------------------------------------------------------------
@@ -162,14 +366,410 @@ PROMPT_MAP: dict[str, str] = {
 }
 
 
+# ---------------------------------------------------------------------------
+# Preset registry: PROMPT_MAP + LORA_CONFIGS compiled into request templates
+# ---------------------------------------------------------------------------
+LORA_SLOTS = ("loras", "high_noise_loras", "low_noise_loras")
+
+
+class RequestTemplate(NamedTuple):
+    """Everything in a submission except the image, serialized up front."""
+
+    position: str
+    settings: str  # canonical JSON of prompt, duration and LoRA slots
+    prefix: bytes  # the request body up to the image value
+    fingerprint: str  # of `settings`; what request_fingerprint returns without downscaling
+
+    @property
+    def spec(self) -> dict[str, Any]:
+        return json.loads(self.settings)
+
+    @property
+    def duration(self) -> int:
+        return self.spec["duration"]
+
+    @property
+    def lora_key(self) -> str:
+        """Short hash of the LoRA weights the request loads, per slot; scales aside."""
+        spec = self.spec
+        return _settings_hash({slot: sorted(lora["path"] for lora in spec.get(slot, ())) for slot in LORA_SLOTS})[:8]
+
+    def body(self, image: str) -> bytes:
+        """The whole JSON request body for `image` (a URL or data URI)."""
+        return self.prefix + json.dumps(image).encode() + b"}"
+
+    def fingerprint_for(self, max_image_side: int | None) -> str:
+        if max_image_side is None:
+            return self.fingerprint
+        return _settings_hash({**self.spec, "max_image_side": max_image_side})
+
+
+def _settings_hash(spec: dict[str, Any]) -> str:
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+class PresetRegistry:
+    """Validated per-position request templates, compiled once.
+
+    Built from PROMPT_MAP and LORA_CONFIGS, optionally overlaid with a JSON
+    file of the same shape ({position: {"prompt": ..., "duration": S,
+    "high_noise_loras": [{"path": URL, "scale": N}], ...}}). Unknown
+    positions fall back to "general". Each template carries its serialized
+    body prefix, so a submission only encodes the image, and a fingerprint
+    for caching and change detection.
+
+    A position may also have a variant matrix, from its preset's
+    "variants" ({"scale": [0.8, 1.2], "prompt": [...], "duration": [5, 8]})
+    and/or `vary` (the same, for every position, from --vary). Every
+    combination becomes a variant template labelled A, B, ...; "scale"
+    multiplies each LoRA scale of the preset. See expand.
+    """
+
+    def __init__(
+        self,
+        presets: Mapping[str, Mapping[str, Any]],
+        vary: Mapping[str, list] | None = None,
+    ) -> None:
+        self.templates = {position: self._compile(position, spec) for position, spec in presets.items()}
+        if "general" not in self.templates:
+            raise ValueError('presets: no "general" position to fall back to')
+        self.variants: dict[str, dict[str, RequestTemplate]] = {}
+        self.variant_settings: dict[str, dict[str, str]] = {}  # position -> label -> "scale=0.8 ..."
+        for position, preset in presets.items():
+            declared = preset.get("variants", {})
+            if not isinstance(declared, dict):
+                raise ValueError(f"preset {position!r}: variants must be an object of field -> values")
+            axes = self._axes(position, {**declared, **(vary or {})})
+            if not axes:
+                continue
+            combos = list(itertools.product(*axes.values()))
+            if len(combos) > len(VARIANT_LABELS):
+                raise ValueError(f"preset {position!r}: {len(combos)} variants, at most {len(VARIANT_LABELS)}")
+            self.variants[position] = {}
+            self.variant_settings[position] = {}
+            for label, combo in zip(VARIANT_LABELS, combos):
+                chosen = dict(zip(axes, combo))
+                self.variants[position][label] = self._compile(position, self._apply(preset, chosen))
+                self.variant_settings[position][label] = " ".join(
+                    f"{k}={v!r}" if k == "prompt" else f"{k}={v:g}" for k, v in chosen.items()
+                )
+
+    @classmethod
+    def builtin(
+        cls,
+        overrides: Mapping[str, Mapping[str, Any]] | None = None,
+        vary: Mapping[str, list] | None = None,
+    ) -> "PresetRegistry":
+        presets = {position: {"prompt": prompt, **get_lora_config(position)} for position, prompt in PROMPT_MAP.items()}
+        return cls({**presets, **(overrides or {})}, vary)
+
+    @classmethod
+    def from_file(cls, path: Path, vary: Mapping[str, list] | None = None) -> "PresetRegistry":
+        """Built-in presets with the positions defined in `path` replaced."""
+        overrides = json.loads(path.read_text())
+        if not isinstance(overrides, dict):
+            raise ValueError(f"{path.name}: expected an object of position -> preset")
+        return cls.builtin(overrides, vary)
+
+    def get(self, position: str, variant: str | None = None) -> RequestTemplate:
+        if variant is not None:
+            return self.variants_for(position)[variant]
+        return self.templates.get(position) or self.templates["general"]
+
+    def variants_for(self, position: str) -> dict[str, RequestTemplate]:
+        """Variant templates by label ({} without a matrix); follows get's fallback."""
+        return self.variants.get(position if position in self.templates else "general", {})
+
+    def expand(self, items: Iterable[dict]) -> Iterator[dict]:
+        """Yield each item, or instead its variants back to back.
+
+        A variant is the item with path `<path>#<label>`, plus `parent` (the
+        image path) and `variant` (the label).
+        """
+        for item in items:
+            variants = self.variants_for(item.get("position", "general"))
+            if not variants:
+                yield item
+                continue
+            for label in variants:
+                yield {**item, "path": f"{item['path']}#{label}", "parent": item["path"], "variant": label}
+
+    def fingerprints(self) -> dict[str, str]:
+        return {position: t.fingerprint for position, t in self.templates.items()}
+
+    def lora_groups(self) -> dict[str, list[str]]:
+        """Positions by the LoRA set they load (RequestTemplate.lora_key)."""
+        groups: dict[str, list[str]] = {}
+        for position, template in self.templates.items():
+            groups.setdefault(template.lora_key, []).append(position)
+        return groups
+
+    @staticmethod
+    def _axes(position: str, axes: Mapping[str, Any]) -> dict[str, list]:
+        unknown = set(axes) - set(VARIANT_FIELDS)
+        if unknown:
+            raise ValueError(f"preset {position!r}: unknown variant fields {sorted(unknown)}")
+        for field, values in axes.items():
+            if not isinstance(values, list) or not values:
+                raise ValueError(f"preset {position!r}: variants {field} must be a non-empty list")
+            for value in values:
+                if field == "scale" and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+                    raise ValueError(f"preset {position!r}: variant scale must be a positive number, got {value!r}")
+        return dict(axes)
+
+    @staticmethod
+    def _apply(preset: Mapping[str, Any], chosen: Mapping[str, Any]) -> dict[str, Any]:
+        """`preset` with one combination of variant values applied."""
+        out = {k: v for k, v in preset.items() if k != "variants"}
+        for slot in LORA_SLOTS:
+            if slot in out and "scale" in chosen:
+                out[slot] = [{**lora, "scale": round(lora.get("scale", 1.0) * chosen["scale"], 3)} for lora in out[slot]]
+        out.update({k: v for k, v in chosen.items() if k != "scale"})
+        return out
+
+    @staticmethod
+    def _compile(position: str, preset: Mapping[str, Any]) -> RequestTemplate:
+        unknown = set(preset) - {"prompt", "duration", "variants", *LORA_SLOTS}
+        if unknown:
+            raise ValueError(f"preset {position!r}: unknown fields {sorted(unknown)}")
+        prompt = preset.get("prompt")
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError(f"preset {position!r}: prompt must be a non-empty string")
+        duration = preset.get("duration", VIDEO_DURATION)
+        if isinstance(duration, bool) or not isinstance(duration, int) or duration <= 0:
+            raise ValueError(f"preset {position!r}: duration must be a positive whole number of seconds, got {duration!r}")
+        spec: dict[str, Any] = {"prompt": prompt, "duration": duration}
+        for slot in LORA_SLOTS:
+            if slot not in preset:
+                continue
+            for lora in preset[slot]:
+                path, scale = lora.get("path"), lora.get("scale")
+                if not isinstance(path, str) or not path.startswith(("http://", "https://")):
+                    raise ValueError(f"preset {position!r}: {slot} path must be an http(s) URL, got {path!r}")
+                if isinstance(scale, bool) or not isinstance(scale, (int, float)):
+                    raise ValueError(f"preset {position!r}: {slot} scale must be a number, got {scale!r}")
+            spec[slot] = [{"path": lora["path"], "scale": lora["scale"]} for lora in preset[slot]]
+        body = json.dumps(spec)
+        return RequestTemplate(
+            position=position,
+            settings=json.dumps(spec, sort_keys=True, separators=(",", ":")),
+            prefix=f'{body[:-1]}, "image": '.encode(),
+            fingerprint=_settings_hash({**spec, "max_image_side": None}),
+        )
+
+
+PRESETS = PresetRegistry.builtin()
+
+
+# ---------------------------------------------------------------------------
+# Metrics: per-stage counters, in-flight gauges and latency histograms
+#
+# One process-wide registry (METRICS) that the stages update as they go.
+# Served as Prometheus text with --metrics-port and appended to METRICS_FILE
+# as JSON lines every --metrics-interval seconds.
+# ---------------------------------------------------------------------------
+def _series(name: str, labels: dict[str, str]) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are interpolated within a bucket."""
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.max
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = min(self.buckets[i], self.max)
+                return lower + (upper - lower) * max(0.0, rank - seen) / n
+            seen += n
+        return self.max
+
+    def summary(self) -> dict[str, float | None]:
+        def r(v: float | None) -> float | None:
+            return round(v, 4) if v is not None else None
+
+        return {
+            "count": self.count,
+            "sum": r(self.sum),
+            "mean": r(self.sum / self.count) if self.count else None,
+            "p50": r(self.quantile(0.5)),
+            "p90": r(self.quantile(0.9)),
+            "p99": r(self.quantile(0.99)),
+            "max": r(self.max) if self.count else None,
+        }
+
+
+class Metrics:
+    """Counters, gauges and histograms keyed by metric name plus labels.
+
+    Updates are cheap dict operations under a lock (the encoder updates from
+    worker threads). Gauges that are cheaper to read than to maintain, like
+    queue depths or job counts by status, come from collector callbacks run
+    just before each render/snapshot.
+    """
+
+    def __init__(self) -> None:
+        self.counters: dict[tuple[str, str], float] = {}
+        self.gauges: dict[tuple[str, str], float] = {}
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.started = time.time()
+        self._collectors: list[Callable[["Metrics"], None]] = []
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, _series(name, labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, delta: float, **labels: str) -> None:
+        key = (name, _series(name, labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self.gauges[(name, _series(name, labels))] = value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> None:
+        key = (name, _series(name, labels))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    @contextmanager
+    def track(self, stage: str):
+        """Count `stage` as in flight and record its duration in gv_stage_seconds."""
+        self.add_gauge("gv_stage_inflight", 1, stage=stage)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_gauge("gv_stage_inflight", -1, stage=stage)
+            self.observe("gv_stage_seconds", time.monotonic() - started, stage=stage)
+
+    def add_collector(self, collector: Callable[["Metrics"], None]) -> None:
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[["Metrics"], None]) -> None:
+        self._collectors.remove(collector)
+
+    def _collect(self) -> None:
+        for collector in self._collectors:
+            collector(self)
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        self._collect()
+        lines: list[str] = []
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                typed: set[str] = set()
+                for (name, key), value in sorted(series.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {name} {kind}")
+                        typed.add(name)
+                    lines.append(f"{key} {value:g}")
+            typed = set()
+            for (name, key), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                labels = key[len(name) + 1:-1] if key != name else ""
+                sep = "," if labels else ""
+                cumulative = 0
+                for bound, n in zip((*hist.buckets, "+Inf"), hist.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {hist.sum:g}")
+                lines.append(f"{name}_count{suffix} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, Any]:
+        """JSON-friendly view with histogram percentiles instead of buckets."""
+        self._collect()
+        with self._lock:
+            return {
+                "ts": round(time.time(), 3),
+                "uptime": round(time.time() - self.started, 3),
+                "counters": {key: value for (_, key), value in sorted(self.counters.items())},
+                "gauges": {key: value for (_, key), value in sorted(self.gauges.items())},
+                "histograms": {key: hist.summary() for (_, key), hist in sorted(self.histograms.items())},
+            }
+
+
+METRICS = Metrics()
+
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST) -> web.AppRunner:
+    """Serve /metrics (Prometheus text) and /metrics.json (snapshot) locally."""
+
+    async def prometheus(request: web.Request) -> web.Response:
+        return web.Response(
+            text=METRICS.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def snapshot(request: web.Request) -> web.Response:
+        return web.json_response(METRICS.snapshot())
+
+    app = web.Application()
+    app.router.add_get("/metrics", prometheus)
+    app.router.add_get("/metrics.json", snapshot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"[metrics] Serving http://{host}:{port}/metrics")
+    return runner
+
+
+async def write_metrics_snapshots(metrics_file: Path, interval: float) -> None:
+    """Append one METRICS snapshot per `interval` until cancelled, then a final one."""
+    with open(metrics_file, "a", encoding="utf-8") as f:
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                f.write(json.dumps(METRICS.snapshot()) + "\n")
+                f.flush()
+        finally:
+            f.write(json.dumps(METRICS.snapshot()) + "\n")
+
+
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
-def load_api_key() -> str:
-    """Read WAVESPEED_API_KEY from env or ~/.claude/.env.global."""
-    key = os.environ.get("WAVESPEED_API_KEY")
-    if key:
-        return key
+def read_env(name: str) -> str | None:
+    """Read a setting from env or ~/.claude/.env.global."""
+    value = os.environ.get(name)
+    if value:
+        return value
     if ENV_GLOBAL.exists():
         for line in ENV_GLOBAL.read_text().splitlines():
             line = line.strip()
@@ -178,435 +778,4123 @@ def load_api_key() -> str:
             k, _, v = line.partition("=")
             k = k.strip()
             v = v.strip().strip("'\"")
-            if k == "WAVESPEED_API_KEY":
+            if k == name:
                 return v
-    print("ERROR: WAVESPEED_API_KEY not found in environment or ~/.claude/.env.global")
+    return None
+
+
+def load_api_key(name: str = "WAVESPEED_API_KEY") -> str:
+    """Read the API key (WAVESPEED_API_KEY by default) from env or ~/.claude/.env.global."""
+    key = read_env(name)
+    if key:
+        return key
+    print(f"ERROR: {name} not found in environment or ~/.claude/.env.global")
     sys.exit(1)
 
 
-def image_to_data_uri(path: str) -> str:
-    """Encode a local image file as a base64 data URI."""
-    p = Path(path)
-    suffix = p.suffix.lower()
-    mime = {
-        ".jpg": "image/jpeg",
-        ".jpeg": "image/jpeg",
-        ".png": "image/png",
-        ".webp": "image/webp",
-        ".gif": "image/gif",
-    }.get(suffix, "image/jpeg")
-    data = p.read_bytes()
-    b64 = base64.b64encode(data).decode("ascii")
-    return f"data:{mime};base64,{b64}"
+class ManifestReader:
+    """Streams manifest items without loading the whole file.
 
+    Accepts the classic JSON array (parsed incrementally, one item at a time)
+    or JSON lines (.jsonl/.ndjson, or any file not starting with "[").
+    Items failing `keep` are skipped as they stream past; `scanned` and
+    `selected` count what has been read so far.
+    """
 
-def load_progress() -> dict[str, dict]:
-    """Load progress file (keyed by image path)."""
-    if PROGRESS_FILE.exists():
-        return json.loads(PROGRESS_FILE.read_text())
-    return {}
+    def __init__(self, path: Path, keep: Callable[[dict], bool] | None = None) -> None:
+        self.path = path
+        self.keep = keep
+        self.scanned = 0
+        self.selected = 0
 
+    def __iter__(self) -> Iterator[dict]:
+        self.scanned = self.selected = 0
+        with open(self.path, encoding="utf-8") as f:
+            for item in self._parse(f):
+                self.scanned += 1
+                if self.keep is None or self.keep(item):
+                    self.selected += 1
+                    yield item
 
-def save_progress(progress: dict[str, dict]) -> None:
-    """Atomically save progress file."""
-    tmp = PROGRESS_FILE.with_suffix(".tmp")
-    tmp.write_text(json.dumps(progress, indent=2))
-    tmp.replace(PROGRESS_FILE)
+    def _parse(self, f: io.TextIOBase) -> Iterator[dict]:
+        if self.path.suffix.lower() not in (".jsonl", ".ndjson"):
+            head = f.read(MANIFEST_READ_SIZE)
+            if head.lstrip().startswith("["):
+                yield from _iter_json_array(f, head)
+                return
+            f.seek(0)
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{self.path.name} line {n}: {e}") from None
 
 
-def print_stats(progress: dict[str, dict]) -> None:
-    """Print a one-line summary of current progress."""
-    counts: dict[str, int] = {"pending": 0, "submitted": 0, "completed": 0, "failed": 0}
-    for entry in progress.values():
-        s = entry.get("status", "pending")
-        counts[s] = counts.get(s, 0) + 1
-    total = sum(counts.values())
-    print(
-        f"[progress] completed={counts['completed']}  submitted={counts['submitted']}  "
-        f"failed={counts['failed']}  remaining={counts['pending']}  total={total}"
-    )
+def _iter_json_array(f: io.TextIOBase, buf: str = "") -> Iterator[Any]:
+    """Yield the elements of a top-level JSON array read from `f` in chunks.
 
+    An element is only taken once the `,` or `]` after it has been read, so
+    a number or literal cut by a chunk boundary is never decoded in pieces.
+    """
+    decoder = json.JSONDecoder()
+    pos, eof = 0, False
 
-# ---------------------------------------------------------------------------
-# Async workers
-# ---------------------------------------------------------------------------
-async def submit_one(
-    session: aiohttp.ClientSession,
-    entry: dict,
-    progress: dict[str, dict],
-    headers: dict,
-    delay: float,
-    semaphore: asyncio.Semaphore,
-    dry_run: bool,
-) -> None:
-    """Submit a single image for I2V generation."""
-    path = entry["path"]
-    position = entry.get("position", "general")
-    lora_config = get_lora_config(position)
-    prompt = PROMPT_MAP.get(position, PROMPT_MAP["general"])
-
-    async with semaphore:
-        if dry_run:
-            hn = len(lora_config.get("high_noise_loras", []))
-            ln = len(lora_config.get("low_noise_loras", []))
-            print(f"[dry-run] {Path(path).name}  pos={position}  high_noise={hn} low_noise={ln}")
-            progress[path]["status"] = "completed"
-            progress[path]["videoUrl"] = "(dry-run)"
-            save_progress(progress)
-            return
+    def read_more() -> None:
+        nonlocal buf, pos, eof
+        chunk = f.read(MANIFEST_READ_SIZE)
+        buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+
+    def skip_space(i: int) -> int:
+        """Index of the first non-whitespace character at or after `i`, reading
+        more as needed (len(buf) at the end of the file). Keeps buf[pos:]."""
+        while True:
+            while i < len(buf) and buf[i].isspace():
+                i += 1
+            if i < len(buf) or eof:
+                return i
+            i -= pos
+            read_more()
+            i += pos
 
-        # Encode image
+    pos = skip_space(pos)
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("manifest is not a JSON array")
+    pos = skip_space(pos + 1)
+    if buf[pos:pos + 1] == "]":
+        return
+    while True:
         try:
-            data_uri = image_to_data_uri(path)
-        except FileNotFoundError:
-            progress[path]["status"] = "failed"
-            progress[path]["error"] = f"Image file not found: {path}"
-            save_progress(progress)
-            print(f"[error] Image not found: {path}")
+            value, end = decoder.raw_decode(buf, pos)
+            if not eof and not buf[end:].strip("0123456789.eE+-"):
+                # Runs to the end of the buffer, maybe mid-number ("12" of "12345", "1." of "1.5")
+                raise json.JSONDecodeError("element may continue in the next chunk", buf, end)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()  # element spans the chunk boundary
+            continue
+        end = skip_space(end)
+        if end == len(buf):
+            raise ValueError("manifest ended before the closing ]")
+        if buf[end] == "]":
+            yield value
             return
+        if buf[end] != ",":
+            raise ValueError(f"manifest: expected , or ] after an element, found {buf[end]!r}")
+        pos = skip_space(end + 1)
+        yield value
 
-        body: dict[str, Any] = {
-            "image": data_uri,
-            "prompt": prompt,
-            "duration": 5,
-        }
-        # Add LoRA slots
-        if "loras" in lora_config:
-            body["loras"] = lora_config["loras"]
-        if "high_noise_loras" in lora_config:
-            body["high_noise_loras"] = lora_config["high_noise_loras"]
-        if "low_noise_loras" in lora_config:
-            body["low_noise_loras"] = lora_config["low_noise_loras"]
-
-        # Submit with retry on 429
-        for attempt in range(MAX_RETRIES):
-            try:
-                async with session.post(SUBMIT_URL, json=body, headers=headers) as resp:
-                    if resp.status == 429:
-                        backoff = RETRY_BASE_DELAY * (2 ** attempt)
-                        print(f"[rate-limit] 429 for {Path(path).name}, retry {attempt+1}/{MAX_RETRIES} in {backoff:.0f}s")
-                        await asyncio.sleep(backoff)
-                        continue
-                    resp_data = await resp.json()
-                    if resp.status != 200:
-                        progress[path]["status"] = "failed"
-                        progress[path]["error"] = f"HTTP {resp.status}: {json.dumps(resp_data)}"
-                        save_progress(progress)
-                        print(f"[error] Submit failed for {Path(path).name}: HTTP {resp.status}")
-                        return
-                    request_id = resp_data.get("data", {}).get("id") or resp_data.get("id")
-                    if not request_id:
-                        progress[path]["status"] = "failed"
-                        progress[path]["error"] = f"No request ID in response: {json.dumps(resp_data)}"
-                        save_progress(progress)
-                        print(f"[error] No request ID for {Path(path).name}")
-                        return
-                    progress[path]["status"] = "submitted"
-                    progress[path]["requestId"] = request_id
-                    save_progress(progress)
-                    print(f"[submitted] {Path(path).name}  pos={position}  id={request_id}")
-                    break
-            except Exception as e:
-                if attempt < MAX_RETRIES - 1:
-                    backoff = RETRY_BASE_DELAY * (2 ** attempt)
-                    print(f"[error] Exception for {Path(path).name}: {e}, retry in {backoff:.0f}s")
-                    await asyncio.sleep(backoff)
-                else:
-                    progress[path]["status"] = "failed"
-                    progress[path]["error"] = str(e)
-                    save_progress(progress)
-                    print(f"[error] All retries failed for {Path(path).name}: {e}")
-                    return
 
-        # Rate-limit between submissions
-        await asyncio.sleep(delay)
+def manifest_filter(
+    accounts: Iterable[str] | None = None,
+    positions: Iterable[str] | None = None,
+    min_favorites: int | None = None,
+) -> Callable[[dict], bool] | None:
+    """Build the --account/--position/--min-favorites predicate (None if unfiltered)."""
+    accounts = set(accounts or ())
+    positions = set(positions or ())
+    if not accounts and not positions and min_favorites is None:
+        return None
 
+    def keep(item: dict) -> bool:
+        if accounts and item.get("account", Path(item["path"]).parent.name) not in accounts:
+            return False
+        if positions and item.get("position", "general") not in positions:
+            return False
+        return min_favorites is None or (item.get("favorite_count") or 0) >= min_favorites
 
-async def poll_one(
-    session: aiohttp.ClientSession,
-    path: str,
-    progress: dict[str, dict],
-    headers: dict,
-) -> bool:
-    """Poll a single submitted prediction. Returns True if terminal (completed/failed)."""
-    request_id = progress[path].get("requestId")
-    if not request_id:
-        progress[path]["status"] = "failed"
-        progress[path]["error"] = "No requestId to poll"
-        save_progress(progress)
-        return True
+    return keep
 
-    url = RESULT_URL.format(request_id=request_id)
-    try:
-        async with session.get(url, headers=headers) as resp:
-            if resp.status != 200:
-                progress[path].setdefault("poll_errors", 0)
-                progress[path]["poll_errors"] += 1
-                if progress[path]["poll_errors"] >= 10:
-                    progress[path]["status"] = "failed"
-                    progress[path]["error"] = f"Too many poll errors (HTTP {resp.status})"
-                    save_progress(progress)
-                    print(f"[failed] {Path(path).name}: HTTP {resp.status} after 10 retries")
-                    return True
-                print(f"[warn] Poll HTTP {resp.status} for {Path(path).name}")
-                return False
-            resp_data = await resp.json()
-            status = resp_data.get("data", {}).get("status", "unknown")
-            if status == "completed":
-                outputs = resp_data.get("data", {}).get("outputs", [])
-                progress[path]["status"] = "completed"
-                progress[path]["videoUrl"] = outputs[0] if outputs else None
-                save_progress(progress)
-                print(f"[completed] {Path(path).name}")
-                return True
-            elif status == "failed":
-                progress[path]["status"] = "failed"
-                progress[path]["error"] = resp_data.get("data", {}).get("error", "Unknown error")
-                save_progress(progress)
-                print(f"[failed] {Path(path).name}: {progress[path]['error']}")
-                return True
-            elif status == "unknown":
-                progress[path].setdefault("poll_errors", 0)
-                progress[path]["poll_errors"] += 1
-                if progress[path]["poll_errors"] >= 10:
-                    progress[path]["status"] = "failed"
-                    progress[path]["error"] = f"Unknown status after 10 polls"
-                    save_progress(progress)
-                    print(f"[failed] {Path(path).name}: unknown status after 10 retries")
-                    return True
-            # still processing
-            return False
-    except Exception as e:
-        progress[path].setdefault("poll_errors", 0)
-        progress[path]["poll_errors"] += 1
-        if progress[path]["poll_errors"] >= 10:
-            progress[path]["status"] = "failed"
-            progress[path]["error"] = f"Poll exception after 10 retries: {e}"
-            save_progress(progress)
-            print(f"[failed] {Path(path).name}: {e} after 10 retries")
-            return True
-        print(f"[warn] Poll error for {Path(path).name}: {e}")
-        return False
 
+def priority_score(
+    field: str = PRIORITY_FIELD,
+    account_weights: Mapping[str, float] | None = None,
+    position_weights: Mapping[str, float] | None = None,
+) -> Callable[[dict], float]:
+    """Score = item[field] x account weight x position weight (weights default to 1)."""
+    account_weights = account_weights or {}
+    position_weights = position_weights or {}
 
-async def poll_loop(
-    session: aiohttp.ClientSession,
-    progress: dict[str, dict],
-    headers: dict,
-) -> None:
-    """Continuously poll all submitted items until none remain."""
-    while True:
-        submitted = [p for p, e in progress.items() if e["status"] == "submitted"]
-        if not submitted:
-            break
-        print(f"[polling] {len(submitted)} items in flight...")
-        tasks = [poll_one(session, p, progress, headers) for p in submitted]
-        await asyncio.gather(*tasks)
-        still_submitted = [p for p, e in progress.items() if e["status"] == "submitted"]
-        if not still_submitted:
-            break
-        print_stats(progress)
-        await asyncio.sleep(POLL_INTERVAL)
+    def score(item: dict) -> float:
+        account = item.get("account", Path(item["path"]).parent.name)
+        return (
+            float(item.get(field) or 0)
+            * account_weights.get(account, 1.0)
+            * position_weights.get(item.get("position", "general"), 1.0)
+        )
 
+    return score
 
-# ---------------------------------------------------------------------------
-# Post-generation: download → R2 upload → feed-videos.json update
-# ---------------------------------------------------------------------------
-def _derive_video_key(image_path: str) -> str:
-    """Derive R2 object key from source image path.
-    e.g. .../twitter/gaizellic/1945940187520884932_1.jpg → gaizellic_1945940187520884932_1
+
+def prioritize(items: Iterable[dict], score: Callable[[dict], float], window: int = 0) -> Iterator[dict]:
+    """Yield `items` highest score first (stable for ties).
+
+    With `window`, ordering is only within a sliding buffer of that many
+    items, so memory stays bounded on huge inputs. Without it every item is
+    ranked; only the fields submission and the feed need are kept per item.
     """
-    p = Path(image_path)
-    account = p.parent.name
-    stem = p.stem  # e.g. 1945940187520884932_1
-    return f"{account}_{stem}"
+    heap: list[tuple[float, int, dict]] = []
+    for seq, item in enumerate(items):
+        compact = {"path": item["path"], **_item_meta(item)}
+        heapq.heappush(heap, (-score(item), seq, compact))
+        if window and len(heap) > window:
+            yield heapq.heappop(heap)[2]
+    if not window:
+        print(f"[priority] Ranked {len(heap)} items")
+    while heap:
+        yield heapq.heappop(heap)[2]
 
 
-async def post_generation(progress: dict[str, dict], items: list[dict]) -> None:
-    """Download completed videos, upload to R2, and update feed-videos.json."""
-    GENERATED_DIR.mkdir(exist_ok=True)
+class LoraBatcher:
+    """Reorders pending submissions into runs that load the same LoRA set.
 
-    # Build lookup from items for metadata
-    items_by_path = {item["path"]: item for item in items}
+    Every submission makes the provider fetch and load its LoRA weights, so
+    jobs sharing a set (same `key`) are sent back to back. Items wait until
+    `window` are buffered; then the group whose oldest item arrived first
+    sends up to `run_length` items in a row, in arrival order. A group never
+    waits behind items that arrived after its own, so a rare position is not
+    starved and a prioritized order is kept at the granularity of runs.
+    """
 
-    # Load existing feed
-    feed: list[dict] = []
-    if FEED_FILE.exists():
-        feed = json.loads(FEED_FILE.read_text())
-    existing_urls = {v["videoUrl"] for v in feed}
-    next_id = max((int(v["id"]) for v in feed if v["id"].isdigit()), default=0) + 1
+    def __init__(self, key: Callable[[dict], str], run_length: int, window: int = LORA_BATCH_WINDOW) -> None:
+        self.key = key
+        self.run_length = max(1, run_length)
+        self.window = max(self.run_length, window)
+        self.groups: dict[str, deque[tuple[int, dict]]] = {}
+        self.waiting = 0
+        self._seq = itertools.count()
 
-    new_entries = []
+    def add(self, item: dict) -> list[dict]:
+        """Buffer `item`; returns whatever is ready to submit now."""
+        self.groups.setdefault(self.key(item), deque()).append((next(self._seq), item))
+        self.waiting += 1
+        ready: list[dict] = []
+        while self.waiting >= self.window:
+            ready += self._run()
+        return ready
 
-    async with aiohttp.ClientSession() as session:
-        for path, entry in progress.items():
-            if entry["status"] != "completed" or not entry.get("videoUrl"):
-                continue
+    def drain(self) -> list[dict]:
+        """Everything still buffered, in runs."""
+        ready: list[dict] = []
+        while self.waiting:
+            ready += self._run()
+        return ready
 
-            video_key = _derive_video_key(path)
-            local_file = GENERATED_DIR / f"{video_key}.mp4"
-            r2_url = f"{R2_PUBLIC_URL}/{R2_PREFIX}/{video_key}.mp4"
+    def _run(self) -> list[dict]:
+        key = min(self.groups, key=lambda k: self.groups[k][0][0])
+        group = self.groups[key]
+        run = [group.popleft()[1] for _ in range(min(self.run_length, len(group)))]
+        if not group:
+            del self.groups[key]
+        self.waiting -= len(run)
+        return run
 
-            # Skip if already in feed
-            if r2_url in existing_urls:
-                continue
 
-            # Step 1: Download from CloudFront if not already local
-            if not local_file.exists():
-                cloudfront_url = entry["videoUrl"]
-                print(f"[download] {video_key}.mp4 ...")
-                try:
-                    async with session.get(cloudfront_url) as resp:
-                        if resp.status == 200:
-                            with open(local_file, "wb") as f:
-                                async for chunk in resp.content.iter_chunked(1024 * 1024):
-                                    f.write(chunk)
-                        else:
-                            print(f"[warn] Download failed for {video_key}: HTTP {resp.status}")
-                            continue
-                except Exception as e:
-                    print(f"[warn] Download error for {video_key}: {e}")
-                    continue
+def parse_weight(spec: str) -> tuple[str, float]:
+    """argparse type for NAME=WEIGHT."""
+    name, sep, value = spec.rpartition("=")
+    try:
+        if sep and name:
+            return name, float(value)
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"expected NAME=WEIGHT, got {spec!r}")
 
-            # Step 2: Upload to R2
-            r2_key = f"{R2_BUCKET}/{R2_PREFIX}/{video_key}.mp4"
-            print(f"[r2-upload] {video_key}.mp4 ...")
-            try:
-                result = subprocess.run(
-                    ["wrangler", "r2", "object", "put", r2_key,
-                     "--file", str(local_file), "--content-type", "video/mp4", "--remote"],
-                    capture_output=True, text=True, timeout=120,
-                )
-                if result.returncode != 0:
-                    print(f"[warn] R2 upload failed for {video_key}: {result.stderr[:200]}")
-                    continue
-            except Exception as e:
-                print(f"[warn] R2 upload error for {video_key}: {e}")
-                continue
 
-            # Step 3: Build feed entry
-            meta = items_by_path.get(path, {})
-            position = meta.get("position", "general")
-            account = meta.get("account", Path(path).parent.name)
-            likes = meta.get("favorite_count", 0)
-
-            new_entries.append({
-                "id": str(next_id),
-                "videoUrl": r2_url,
-                "title": f"{position.replace('_', ' ').title()} - {account}",
-                "creator": account,
-                "creatorAvatar": "\U0001f3ac",  # 🎬
-                "likes": likes,
-                "comments": 0,
-                "shares": 0,
-                "tags": ["ai", "wan2.2", position],
-            })
-            next_id += 1
-            print(f"[feed] Added {video_key} as id={next_id - 1}")
+def parse_deadline(value: str) -> float:
+    """Deadline as epoch seconds from "SECONDS" (from now), "HH:MM" (next occurrence) or ISO-8601."""
+    try:
+        return time.time() + float(value)
+    except ValueError:
+        pass
+    if re.fullmatch(r"\d{1,2}:\d{2}", value):
+        hour, minute = map(int, value.split(":"))
+        now = datetime.now()
+        target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        return target.timestamp() + (86400 if target <= now else 0)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad deadline {value!r}: use seconds, HH:MM or ISO-8601") from None
 
-    if new_entries:
-        feed.extend(new_entries)
-        tmp_file = FEED_FILE.with_suffix(".json.tmp")
-        tmp_file.write_text(json.dumps(feed, indent=2, ensure_ascii=False))
-        tmp_file.replace(FEED_FILE)
-        print(f"\n[feed] Updated {FEED_FILE.name}: added {len(new_entries)} videos (total: {len(feed)})")
 
-        # Also copy classified data to src for admin page
-        if INPUT_FILE.exists():
-            CLASSIFIED_SRC.parent.mkdir(parents=True, exist_ok=True)
-            import shutil
-            shutil.copy2(INPUT_FILE, CLASSIFIED_SRC)
-            print(f"[sync] Copied classified data to {CLASSIFIED_SRC}")
-    else:
-        print("[feed] No new videos to add.")
+def _pid_alive(pid: int) -> bool:
+    """Whether a process with this id still exists on this machine."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, owned by someone else
+    return True
 
 
-async def run(concurrency: int, delay: float, dry_run: bool) -> None:
-    """Main async entry point."""
-    api_key = load_api_key()
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
+class SubmissionBudget:
+    """Hard caps on what a run may submit: generated seconds and cost, per
+    run and per UTC day, plus an optional wall-clock deadline.
 
-    # Load input
-    if not INPUT_FILE.exists():
-        print(f"ERROR: Input file not found: {INPUT_FILE}")
-        sys.exit(1)
-    items: list[dict] = json.loads(INPUT_FILE.read_text())
-    print(f"Loaded {len(items)} items from {INPUT_FILE.name}")
+    Every billable submission reserves the duration of its request template
+    (see PresetRegistry) before it is sent and is settled afterwards. Both
+    go through SPEND_LEDGER, an append-only JSON-lines file shared with other
+    runs and workers: a reservation is checked against everything already
+    spent or reserved and appended while holding an exclusive lock on the
+    ledger, so concurrent submits, in this process or another, cannot
+    overshoot. Processes sharing a `run_id` (all workers of one --workers
+    run) share the run caps; every process shares the daily caps.
+    Reservations left by a process that died are ignored. Once a cap or the
+    deadline is hit, submission stops for the rest of the run and unsent
+    items stay pending.
+    """
 
-    # Load or initialize progress
-    progress = load_progress()
-    for item in items:
-        path = item["path"]
-        if path not in progress:
-            progress[path] = {
-                "path": path,
-                "status": "pending",
-                "requestId": None,
-                "videoUrl": None,
-                "error": None,
-            }
-    # Reset failed items to pending so they get retried
-    for path, entry in progress.items():
-        if entry["status"] == "failed":
-            entry["status"] = "pending"
-            entry["error"] = None
-    save_progress(progress)
-    print_stats(progress)
+    def __init__(
+        self,
+        run_seconds: float | None = None,
+        run_cost: float | None = None,
+        day_seconds: float | None = None,
+        day_cost: float | None = None,
+        cost_per_second: float = COST_PER_SECOND,
+        deadline: float | None = None,
+        ledger_file: Path | None = None,
+        persist: bool = True,
+        run_id: str | None = None,
+    ) -> None:
+        self.run_seconds = run_seconds
+        self.run_cost = run_cost
+        self.day_seconds = day_seconds
+        self.day_cost = day_cost
+        self.cost_per_second = cost_per_second
+        self.deadline = deadline
+        self.ledger_file = ledger_file or SPEND_LEDGER
+        self.persist = persist
+        self.run_id = run_id or secrets.token_hex(6)
+        self.spent_seconds = 0.0  # this run, all of its processes
+        self.day_spent_seconds = 0.0  # today, all runs
+        self.stopped: str | None = None
+        self._pending: dict[str, tuple[str, float, int]] = {}  # reservation id -> (run, seconds, pid)
+        self._day = ""
+        self._ledger_offset = 0
 
-    semaphore = asyncio.Semaphore(concurrency)
+    def _today(self) -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-    async with aiohttp.ClientSession() as session:
-        # Phase 1: Re-poll any already-submitted items from a previous run
-        submitted_from_before = [p for p, e in progress.items() if e["status"] == "submitted"]
-        if submitted_from_before:
-            print(f"Resuming: re-polling {len(submitted_from_before)} previously submitted items...")
-            await poll_loop(session, progress, headers)
-            print_stats(progress)
-
-        # Phase 2: Submit all pending items
-        pending_items = [item for item in items if progress[item["path"]]["status"] == "pending"]
-        if pending_items:
-            print(f"Submitting {len(pending_items)} pending items (concurrency={concurrency}, delay={delay}s)...")
-            tasks = [
-                submit_one(session, item, progress, headers, delay, semaphore, dry_run)
-                for item in pending_items
-            ]
-            await asyncio.gather(*tasks)
-            print_stats(progress)
+    @contextmanager
+    def _locked(self) -> Iterator[io.TextIOWrapper | None]:
+        """Exclusive inter-process lock on the ledger, yielding it open for appending."""
+        if not self.persist:
+            yield None
+            return
+        with open(self.ledger_file, "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
-        # Phase 3: Poll all newly submitted items until done
-        if not dry_run:
-            await poll_loop(session, progress, headers)
+    def _refresh(self) -> None:
+        """Fold in ledger lines appended since the last read (and roll over at midnight UTC)."""
+        today = self._today()
+        if today != self._day:
+            self._day, self._ledger_offset = today, 0
+            self.spent_seconds = self.day_spent_seconds = 0.0
+            self._pending.clear()
+        if not self.ledger_file.exists():
+            return
+        with open(self.ledger_file, encoding="utf-8") as f:
+            f.seek(self._ledger_offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # another writer is mid-append
+                self._ledger_offset += len(line.encode())
+                self._fold(json.loads(line))
 
-    # Final stats
-    print("\n=== FINAL RESULTS ===")
-    print_stats(progress)
-    completed = sum(1 for e in progress.values() if e["status"] == "completed")
-    failed = sum(1 for e in progress.values() if e["status"] == "failed")
-    if failed:
-        print(f"\n{failed} items failed. Re-run to retry them.")
-    print(f"Progress saved to {PROGRESS_FILE}")
+    def _fold(self, record: dict) -> None:
+        if "reserved" in record:
+            self._pending[record["id"]] = (record["run"], record["reserved"], record["pid"])
+            return
+        self._pending.pop(record.get("id"), None)
+        if record.get("run") == self.run_id:
+            self.spent_seconds += record["seconds"]
+        if record["day"] == self._day:
+            self.day_spent_seconds += record["seconds"]
 
-    # Post-generation: download, upload to R2, update feed
-    if not dry_run and completed > 0:
-        print("\n=== POST-GENERATION: Download, Upload, Update Feed ===")
-        await post_generation(progress, items)
+    def _record(self, ledger: io.TextIOWrapper | None, record: dict) -> None:
+        """Append `record` to the (locked) ledger and read it back; without persistence, apply it here only."""
+        if ledger is None:
+            self._fold(record)
+            return
+        ledger.write(json.dumps(record) + "\n")
+        ledger.flush()
+        self._refresh()
 
+    def _reserved(self) -> tuple[float, float]:
+        """Seconds held by live reservations: (this run's, everyone's)."""
+        run = day = 0.0
+        for rid, (run_id, seconds, pid) in list(self._pending.items()):
+            if not _pid_alive(pid):
+                del self._pending[rid]  # its process died before settling
+                continue
+            day += seconds
+            if run_id == self.run_id:
+                run += seconds
+        return run, day
 
-# ---------------------------------------------------------------------------
-# CLI
-# ---------------------------------------------------------------------------
-def main() -> None:
+    def reserve(self, seconds: float, expected_generation: float | None = None) -> str | None:
+        """Claim room for one submission and return the reservation id to settle;
+        None (and stop) once any cap would be exceeded."""
+        if self.stopped:
+            return None
+        if self.deadline is not None:
+            finish = time.time() + (expected_generation or DEADLINE_FALLBACK_SECONDS) + DEADLINE_MARGIN
+            if finish > self.deadline:
+                return self._stop("deadline: a new job would not finish in time")
+        with self._locked() as ledger:
+            self._refresh()
+            run_reserved, day_reserved = self._reserved()
+            run_total = self.spent_seconds + run_reserved + seconds
+            day_total = self.day_spent_seconds + day_reserved + seconds
+            for limit, total, label in (
+                (self.run_seconds, run_total, "run seconds"),
+                (self.run_cost, run_total * self.cost_per_second, "run cost"),
+                (self.day_seconds, day_total, "daily seconds"),
+                (self.day_cost, day_total * self.cost_per_second, "daily cost"),
+            ):
+                if limit is not None and total > limit + 1e-9:
+                    return self._stop(f"{label} budget of {limit:g} reached")
+            rid = secrets.token_hex(8)
+            self._record(ledger, {
+                "ts": round(time.time(), 3), "day": self._day, "run": self.run_id,
+                "id": rid, "pid": os.getpid(), "reserved": seconds,
+            })
+        return rid
+
+    def settle(self, rid: str, path: str, seconds: float, charged: bool) -> None:
+        """Release a reservation, recording it as spend if the submission went out."""
+        with self._locked() as ledger:
+            self._record(ledger, {
+                "ts": round(time.time(), 3), "day": self._today(), "run": self.run_id, "id": rid,
+                "path": path, "seconds": seconds if charged else 0.0,
+                "cost": round(seconds * self.cost_per_second, 4) if charged else 0.0,
+            })
+
+    def _stop(self, reason: str) -> None:
+        self.stopped = reason
+        print(f"[budget] Stopping submissions: {reason}")
+        return None
+
+    def summary(self) -> str:
+        self._refresh()
+        return (
+            f"[budget] run: {self.spent_seconds:g}s (${self.spent_seconds * self.cost_per_second:.2f})  "
+            f"today: {self.day_spent_seconds:g}s (${self.day_spent_seconds * self.cost_per_second:.2f})"
+        )
+
+
+def _item_meta(item: dict) -> dict:
+    """Manifest fields the feed row needs, kept in the progress entry."""
+    return {k: item[k] for k in ("account", "position", "favorite_count", "variant") if k in item}
+
+
+def fill_missing_meta(progress: "ProgressStore", input_file: Path, paths: set[str]) -> None:
+    """Record feed metadata for `paths` from one pass over the manifest."""
+    if paths and input_file.exists():
+        for item in ManifestReader(input_file):
+            if item["path"] in paths:
+                progress.update(item["path"], meta=_item_meta(item))
+
+
+def image_to_data_uri(path: str, max_side: int | None = None) -> str:
+    """Encode a local image file as a base64 data URI.
+
+    With `max_side`, images larger than that on their long edge are first
+    downscaled and re-encoded as JPEG (needs Pillow).
+    """
+    data, mime = _image_payload(path, max_side)
+    b64 = base64.b64encode(data).decode("ascii")
+    return f"data:{mime};base64,{b64}"
+
+
+IMAGE_MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+}
+
+
+def _image_payload(path: str, max_side: int | None = None) -> tuple[bytes, str]:
+    """The image bytes (downscaled with `max_side`) and MIME type that get submitted."""
+    p = Path(path)
+    mime = IMAGE_MIME_TYPES.get(p.suffix.lower(), "image/jpeg")
+    data = p.read_bytes()
+    if max_side:
+        data, mime = _downscale_image(data, mime, max_side)
+    return data, mime
+
+
+def _downscale_image(data: bytes, mime: str, max_side: int) -> tuple[bytes, str]:
+    """Shrink to `max_side` on the long edge and re-encode as JPEG."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= max_side:
+            return data, mime
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        out = io.BytesIO()
+        img.convert("RGB").save(out, "JPEG", quality=ENCODE_JPEG_QUALITY)
+    return out.getvalue(), "image/jpeg"
+
+
+class ImageEncoder:
+    """Builds image data URIs on a thread pool, cached on disk by content hash.
+
+    The cache key is the SHA-256 of the source bytes plus the downscale
+    setting, so renamed or re-scraped copies of the same image hit, and
+    reruns skip re-encoding entirely. Once the cache grows past
+    `cache_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        workers: int = ENCODE_WORKERS,
+        max_side: int | None = None,
+        cache_dir: Path | None = None,
+        cache_bytes: int = ENCODE_CACHE_BYTES,
+    ) -> None:
+        if max_side:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                print("ERROR: --max-image-side requires Pillow (pip install pillow)")
+                sys.exit(1)
+        self.max_side = max_side
+        self.cache_dir = cache_dir or ENCODE_CACHE_DIR
+        self.cache_bytes = cache_bytes
+        self.cache_dir.mkdir(exist_ok=True)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="encode")
+        self._lock = threading.Lock()
+        self._cache_size = sum(f.stat().st_size for f in self.cache_dir.glob("*.b64"))
+        self._hashes: dict[tuple[str, int, int], str] = {}
+
+    async def content_hash(self, path: str) -> str:
+        """SHA-256 of the file's bytes, computed off the loop and memoized."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._content_hash, path)
+
+    def _content_hash(self, path: str) -> str:
+        st = os.stat(path)
+        memo_key = (path, st.st_mtime_ns, st.st_size)
+        digest = self._hashes.get(memo_key)
+        if digest is None:
+            digest = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+            self._hashes[memo_key] = digest
+        return digest
+
+    async def data_uri(self, path: str) -> str:
+        """Return the (possibly downscaled) data URI for `path` without blocking the loop."""
+        loop = asyncio.get_running_loop()
+        with METRICS.track("encode"):
+            return await loop.run_in_executor(self._executor, self._encode_cached, path)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _encode_cached(self, path: str) -> str:
+        cache_name = f"{self._content_hash(path)}|max_side={self.max_side}"
+        cache_file = self.cache_dir / f"{hashlib.sha256(cache_name.encode()).hexdigest()}.b64"
+        try:
+            uri = cache_file.read_text()
+            os.utime(cache_file)  # mark as recently used
+            METRICS.inc("gv_encode_cache_total", result="hit")
+            return uri
+        except FileNotFoundError:
+            pass
+        METRICS.inc("gv_encode_cache_total", result="miss")
+        uri = image_to_data_uri(path, self.max_side)
+        tmp = cache_file.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(uri)
+        tmp.replace(cache_file)
+        with self._lock:
+            self._cache_size += len(uri)
+            if self._cache_size > self.cache_bytes:
+                self._evict()
+        return uri
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the cache is at 90% of budget."""
+        files = sorted(self.cache_dir.glob("*.b64"), key=lambda f: f.stat().st_mtime)
+        for f in files:
+            if self._cache_size <= 0.9 * self.cache_bytes:
+                break
+            size = f.stat().st_size
+            f.unlink(missing_ok=True)
+            self._cache_size -= size
+
+
+class JobRecord:
+    """One ProgressStore entry, held in fixed slots instead of a dict.
+
+    Reads like the dict it replaces (entry["status"], entry.get(...),
+    "meta" in entry), so callers treat it as one. Fields outside FIELDS go to
+    a small overflow dict, so snapshots written by other versions still load.
+    """
+
+    FIELDS = (
+        "path", "status", "requestId", "videoUrl", "error", "meta", "cacheKey", "parent", "variant",
+        "submittedAt", "submitAttempts", "throttles", "submitSeconds", "submitLimit", "finishedAt", "polls",
+        "poll_errors", "downloadedAt", "downloadSeconds", "r2Url", "posterUrl", "previewUrl",
+        "uploadedAt", "uploadSeconds", "published", "publishedAt", "loraGroup", "loraRun", "duplicateOf",
+    )
+    __slots__ = FIELDS + ("_extra",)
+    _SLOTS = frozenset(FIELDS)
+
+    def __init__(self, fields: Mapping[str, Any] | None = None) -> None:
+        self._extra: dict[str, Any] | None = None
+        if fields:
+            self.update(fields)
+
+    def update(self, fields: Mapping[str, Any]) -> None:
+        for key, value in fields.items():
+            if key not in self._SLOTS:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+            elif key == "status" and value is not None:
+                # A handful of distinct values shared by every record
+                setattr(self, key, sys.intern(value))
+            elif key == "meta" and value:
+                # Accounts, positions and variants repeat across most records
+                setattr(self, key, {
+                    sys.intern(k): sys.intern(v) if isinstance(v, str) else v for k, v in value.items()
+                })
+            else:
+                setattr(self, key, value)
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._SLOTS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key: object) -> bool:
+        if key in self._SLOTS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def keys(self) -> list[str]:
+        return [k for k in self.FIELDS if hasattr(self, k)] + list(self._extra or ())
+
+    def items(self) -> list[tuple[str, Any]]:
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(self.items())
+
+    def __repr__(self) -> str:
+        return f"JobRecord({self.to_dict()!r})"
+
+
+class ProgressStore:
+    """Per-image progress (keyed by image path) backed by snapshot + journal.
+
+    The snapshot is the classic generation_progress.json dict, so runs started
+    by older versions resume as-is and the file stays usable as an export.
+    Every state change appends one small JSON line to the journal instead of
+    rewriting the snapshot. Once the journal holds `compact_every` records,
+    or half as many as there are entries if that is more, it is folded back
+    into the snapshot, so rewrites cost O(1) per update however large the
+    store grows. That rewrite runs in a background thread: the journal is
+    first moved aside to `<journal>.old` and a fresh one started, and the
+    thread writes a copy of the entries taken at that moment, then deletes
+    the old journal. load() replays the snapshot, the old journal and the
+    journal in that order; as replaying is idempotent, a crash at any point
+    loses nothing. close() folds everything in before returning.
+
+    Entries are JobRecords, and every update keeps an index of paths per
+    status (plus completed-but-unpublished) current, so `counts`, `paths()`
+    and `unpublished()` cost the size of the answer rather than a rescan of
+    every entry.
+
+    Besides status, requestId, videoUrl and error, entries keep each job's
+    timing: submittedAt, finishedAt, downloadedAt, uploadedAt, publishedAt
+    (epoch seconds), submitSeconds/downloadSeconds/uploadSeconds, and
+    submitAttempts, throttles, submitLimit and polls. `plan` fits to these.
+    loraGroup and loraRun record the job's LoRA set and whether the one
+    submitted before it used the same set ("same") or not ("switch").
+    duplicateOf names the image whose video a near-duplicate reuses (--dedup).
+    """
+
+    def __init__(
+        self,
+        snapshot_file: Path | None = None,
+        journal_file: Path | None = None,
+        compact_every: int = PROGRESS_COMPACT_EVERY,
+    ) -> None:
+        self.snapshot_file = snapshot_file or PROGRESS_FILE
+        self.journal_file = journal_file or PROGRESS_JOURNAL
+        self.compact_every = compact_every
+        self.entries: dict[str, JobRecord] = {}
+        self._by_status: dict[str, set[str]] = {}
+        self._unpublished: set[str] = set()
+        self._journal_records = 0
+        self._journal_fh = None
+        self._old_journal = self.journal_file.with_name(self.journal_file.name + ".old")
+        self._compactor: threading.Thread | None = None
+
+    # -- mapping-style access -------------------------------------------------
+    def __getitem__(self, path: str) -> JobRecord:
+        return self.entries[path]
+
+    def __contains__(self, path: object) -> bool:
+        return path in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def items(self):
+        return self.entries.items()
+
+    def values(self):
+        return self.entries.values()
+
+    # -- status index ---------------------------------------------------------
+    @property
+    def counts(self) -> Counter:
+        return Counter({status: len(paths) for status, paths in self._by_status.items() if paths})
+
+    def paths(self, status: str) -> set[str]:
+        """Paths currently in `status` (live; copy before updating while iterating)."""
+        return self._by_status.get(status, set())
+
+    def unpublished(self) -> set[str]:
+        """Completed paths not published yet (live, like `paths`)."""
+        return self._unpublished
+
+    def _index(self, path: str, entry: JobRecord, old_status: str | None = None) -> None:
+        status = entry.get("status", "pending")
+        if status != old_status:
+            if old_status is not None:
+                self._by_status[old_status].discard(path)
+            self._by_status.setdefault(status, set()).add(path)
+        if status == "completed" and not entry.get("published"):
+            self._unpublished.add(path)
+        else:
+            self._unpublished.discard(path)
+
+    # -- persistence ----------------------------------------------------------
+    def load(self) -> "ProgressStore":
+        """Load the snapshot, then replay any journal left by a previous run."""
+        if self.snapshot_file.exists():
+            for path, fields in self._read_snapshot():
+                self.entries[path] = JobRecord(fields)
+        journals = [f for f in (self._old_journal, self.journal_file) if f.exists()]
+        for journal in journals:
+            with open(journal, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn final line from a crash mid-append
+                        break
+                    path = record.pop("path")
+                    entry = self.entries.get(path)
+                    if entry is None:
+                        entry = self.entries[path] = JobRecord({"path": path})
+                    entry.update(record)
+        if journals:
+            # Fold the replayed journals in so this run starts from a clean log
+            self.compact()
+        self._by_status = {}
+        self._unpublished = set()
+        for path, entry in self.entries.items():
+            self._index(path, entry)
+        return self
+
+    def _read_snapshot(self) -> Iterator[tuple[str, dict]]:
+        """Yield (path, entry) pairs, a line at a time for snapshots written by compact().
+
+        Older snapshots (one indented document) are parsed whole.
+        """
+        with open(self.snapshot_file, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line in ("", "{", "}"):
+                    continue
+                try:
+                    yield from json.loads("{" + line + "}").items()
+                except json.JSONDecodeError:
+                    break
+            else:
+                return
+        yield from json.loads(self.snapshot_file.read_text()).items()
+
+    def update(self, path: str, **fields: Any) -> None:
+        """Apply a state transition to one entry and journal it."""
+        entry = self.entries.get(path)
+        if entry is None:
+            entry = self.entries[path] = JobRecord({"path": path})
+            old_status = None
+        else:
+            old_status = entry.get("status", "pending")
+        entry.update(fields)
+        self._index(path, entry, old_status)
+        if self._journal_fh is None:
+            self._journal_fh = open(self.journal_file, "a", encoding="utf-8")
+        self._journal_fh.write(json.dumps({"path": path, **fields}) + "\n")
+        self._journal_fh.flush()
+        self._journal_records += 1
+        if (
+            self._journal_records >= max(self.compact_every, len(self.entries) // 2)
+            and (self._compactor is None or not self._compactor.is_alive())
+        ):
+            self._compactor = threading.Thread(
+                target=self._write_snapshot, args=(self._rotate(),), name="progress-compact", daemon=True,
+            )
+            self._compactor.start()
+
+    def _rotate(self) -> list[tuple[str, JobRecord]]:
+        """Move the journal aside and start a new one; returns the entries to snapshot."""
+        if self._journal_fh is not None:
+            self._journal_fh.close()
+            self._journal_fh = None
+        if self.journal_file.exists():
+            if self._old_journal.exists():
+                # Left by a compaction that failed: keep both, in order
+                with open(self._old_journal, "ab") as old, open(self.journal_file, "rb") as new:
+                    shutil.copyfileobj(new, old)
+                self.journal_file.unlink()
+            else:
+                self.journal_file.replace(self._old_journal)
+        self._journal_records = 0
+        # Records may change while the copy is written; the new journal has every such change
+        return list(self.entries.items())
+
+    def _write_snapshot(self, entries: list[tuple[str, JobRecord]]) -> None:
+        """Atomically rewrite the snapshot, then drop the journal it supersedes."""
+        tmp = self.snapshot_file.with_suffix(".tmp")
+        try:
+            # One entry per line, written as it is serialised
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write("{")
+                for n, (path, entry) in enumerate(entries):
+                    f.write(f"{',' if n else ''}\n  {json.dumps(path)}: {json.dumps(entry.to_dict())}")
+                f.write("\n}\n")
+            tmp.replace(self.snapshot_file)
+        except Exception as e:
+            # Usually runs in a thread nobody joins for its result; the journal still has everything
+            print(f"[warn] Could not rewrite {self.snapshot_file.name}: {e}; keeping the journal")
+            return
+        self._old_journal.unlink(missing_ok=True)
+
+    def compact(self) -> None:
+        """Fold the journal into the snapshot now, waiting for any background rewrite first."""
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        self._write_snapshot(self._rotate())
+
+    def close(self) -> None:
+        self.compact()
+
+
+class LeaseStore:
+    """Job table shared by several worker processes, claimed through leases.
+
+    Lives in one SQLite file (LEASE_DB) that every worker opens; workers may
+    be separate processes or machines that can lock the same file. Each row
+    holds the manifest item, the same fields as a ProgressStore entry, an
+    owner and a lease deadline. A worker claims a few rows at a time, renews
+    its leases while it works on them and writes every state change back,
+    but only while it still owns the row. A lease that runs out because its
+    worker crashed or hung makes the row claimable again, so a submitted job
+    is picked up and re-polled instead of being stranded.
+
+    Offers ProgressStore's mapping/update interface for the rows this worker
+    has claimed; `counts` and `len()` cover the whole table.
+    """
+
+    def __init__(self, worker: str, db_file: Path | None = None, lease_seconds: float = LEASE_SECONDS) -> None:
+        self.worker = worker
+        self.db_file = db_file or LEASE_DB
+        self.lease_seconds = lease_seconds
+        self.entries: dict[str, dict] = {}
+        self._given_up: set[str] = set()  # released after a publish error; not reclaimed by us
+        self._closed_counts: Counter | None = None  # table totals frozen by close()
+        self._db = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " path TEXT PRIMARY KEY, seq INTEGER NOT NULL, item TEXT NOT NULL, data TEXT NOT NULL,"
+            " status TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0,"
+            " owner TEXT, lease_until REAL NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (done, lease_until, seq)")
+
+    # -- mapping-style access (claimed rows) -----------------------------------
+    def __getitem__(self, path: str) -> dict:
+        return self.entries[path]
+
+    def __contains__(self, path: object) -> bool:
+        return path in self.entries
+
+    def __len__(self) -> int:
+        if self._closed_counts is not None:
+            return sum(self._closed_counts.values())
+        return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def items(self):
+        return self.entries.items()
+
+    def values(self):
+        return self.entries.values()
+
+    @property
+    def counts(self) -> Counter:
+        if self._closed_counts is not None:
+            return self._closed_counts
+        return Counter(dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")))
+
+    def paths(self, status: str) -> list[str]:
+        """Claimed paths currently in `status`."""
+        return [path for path, entry in self.entries.items() if entry.get("status") == status]
+
+    def unpublished(self) -> list[str]:
+        """Claimed paths completed but not published yet."""
+        return [path for path, entry in self.entries.items() if entry.get("status") == "completed" and not entry.get("published")]
+
+    # -- persistence ----------------------------------------------------------
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    @staticmethod
+    def _is_done(entry: dict) -> bool:
+        """Failed, or completed and published (or with nothing to publish)."""
+        if entry.get("status") == "failed":
+            return True
+        return entry.get("status") == "completed" and (
+            bool(entry.get("published")) or entry.get("videoUrl") in (None, "(dry-run)")
+        )
+
+    def seed(self, items: Iterable[dict]) -> "LeaseStore":
+        """Add manifest items not in the table yet and queue failed jobs for retry.
+
+        State from generation_progress.json is taken over when it is further
+        along than the table (first coordinated run, or after a
+        single-process run), so switching modes never resubmits finished work.
+        """
+        rank = {"pending": 0, "failed": 0, "submitted": 1, "completed": 2}
+        with self._transaction():
+            snapshot = ProgressStore().load()
+            now = time.time()
+            for seq, item in enumerate(items):
+                path = item["path"]
+                entry = snapshot[path].to_dict() if path in snapshot else None
+                known = self._db.execute("SELECT status, lease_until FROM jobs WHERE path = ?", (path,)).fetchone()
+                if known is None:
+                    entry = entry or {"path": path, "status": "pending", "requestId": None, "videoUrl": None, "error": None}
+                    self._db.execute(
+                        "INSERT INTO jobs (path, seq, item, data, status, done) VALUES (?, ?, ?, ?, ?, ?)",
+                        (path, seq, json.dumps(item), json.dumps(entry), entry["status"], int(self._is_done(entry))),
+                    )
+                    continue
+                status, lease_until = known
+                if entry and lease_until < now and rank.get(entry["status"], 0) > rank.get(status, 0):
+                    self._db.execute(
+                        "UPDATE jobs SET data = ?, status = ?, done = ? WHERE path = ?",
+                        (json.dumps(entry), entry["status"], int(self._is_done(entry)), path),
+                    )
+                self._db.execute("UPDATE jobs SET seq = ?, item = ? WHERE path = ?", (seq, json.dumps(item), path))
+            # Reset failed jobs to pending so they get retried
+            for path, data in self._db.execute("SELECT path, data FROM jobs WHERE status = 'failed'").fetchall():
+                entry = {**json.loads(data), "status": "pending", "error": None}
+                self._db.execute(
+                    "UPDATE jobs SET data = ?, status = 'pending', done = 0 WHERE path = ?", (json.dumps(entry), path),
+                )
+        return self
+
+    def claim(self, limit: int) -> list[dict]:
+        """Lease up to `limit` unfinished, unleased jobs; returns their manifest items."""
+        now = time.time()
+        claimed: list[dict] = []
+        with self._transaction():
+            rows = self._db.execute(
+                "SELECT path, item, data, owner FROM jobs WHERE done = 0 AND lease_until < ? ORDER BY seq LIMIT ?",
+                (now, limit + len(self._given_up)),
+            ).fetchall()
+            for path, item, data, owner in rows:
+                if path in self._given_up or len(claimed) >= limit:
+                    continue
+                self._db.execute(
+                    "UPDATE jobs SET owner = ?, lease_until = ? WHERE path = ?",
+                    (self.worker, now + self.lease_seconds, path),
+                )
+                if path in self.entries:
+                    continue  # our own lease lapsed while we still hold the job
+                self.entries[path] = json.loads(data)
+                claimed.append(json.loads(item))
+                if owner and owner != self.worker:
+                    print(f"[lease] {self.worker} reclaimed {Path(path).name} from {owner}")
+        return claimed
+
+    def unfinished_elsewhere(self) -> int:
+        """Unfinished jobs this worker does not hold and has not given up on."""
+        rows = self._db.execute("SELECT path FROM jobs WHERE done = 0 AND (owner IS NULL OR owner != ?)", (self.worker,))
+        return sum(1 for (path,) in rows if path not in self._given_up and path not in self.entries)
+
+    async def claims(self, batch: int = LEASE_CLAIM_BATCH):
+        """Yield claimed batches until nothing is left that another worker could strand."""
+        while True:
+            items = self.claim(batch)
+            if items:
+                yield items
+            elif not self.unfinished_elsewhere():
+                return
+            else:
+                # Everything left is leased by live workers; wait for them to
+                # finish or for a crashed worker's lease to run out
+                await asyncio.sleep(min(LEASE_IDLE_POLL, self.lease_seconds / 4))
+
+    async def keep_alive(self) -> None:
+        """Renew this worker's leases until cancelled."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            self._db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND done = 0",
+                (time.time() + self.lease_seconds, self.worker),
+            )
+
+    def update(self, path: str, **fields: Any) -> None:
+        """Apply a state transition to a claimed job and write it back if still ours."""
+        entry = self.entries.setdefault(path, {"path": path})
+        entry.update(fields)
+        done = self._is_done(entry)
+        # A completed job that could not be published is handed back for others
+        give_up = not done and entry.get("status") == "completed" and entry.get("error")
+        cur = self._db.execute(
+            "UPDATE jobs SET data = ?, status = ?, done = ?,"
+            " owner = CASE WHEN ? THEN NULL ELSE owner END,"
+            " lease_until = CASE WHEN ? THEN 0 ELSE lease_until END"
+            " WHERE path = ? AND owner = ?",
+            (json.dumps(entry), entry.get("status", "pending"), int(done), bool(give_up), bool(give_up), path, self.worker),
+        )
+        if give_up:
+            self._given_up.add(path)
+        if cur.rowcount == 0:
+            print(f"[lease] {self.worker} no longer holds {Path(path).name}; change not saved")
+
+    def export(self, target: Path | None = None) -> None:
+        """Write the whole table out as a generation_progress.json snapshot."""
+        target = target or PROGRESS_FILE
+        with self._transaction():
+            entries = {path: json.loads(data) for path, data in self._db.execute("SELECT path, data FROM jobs ORDER BY seq")}
+            tmp = target.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(entries, indent=2))
+            tmp.replace(target)
+
+    def close(self) -> None:
+        """Release unfinished leases, refresh the progress snapshot and disconnect."""
+        self._db.execute(
+            "UPDATE jobs SET owner = NULL, lease_until = 0 WHERE owner = ? AND done = 0", (self.worker,),
+        )
+        self.export()
+        self._closed_counts = self.counts
+        self._db.close()
+
+
+def print_stats(progress: ProgressStore) -> None:
+    """Print a one-line summary of current progress."""
+    counts = progress.counts
+    total = len(progress)
+    print(
+        f"[progress] completed={counts['completed']}  submitted={counts['submitted']}  "
+        f"failed={counts['failed']}  remaining={counts['pending']}  total={total}"
+    )
+
+
+def print_lora_report(presets: PresetRegistry) -> None:
+    """Generation time per LoRA set: sent right after the same set vs after a switch."""
+    name = "gv_lora_generation_seconds"
+    for group, positions in presets.lora_groups().items():
+        cells = []
+        for run in ("same", "switch"):
+            hist = METRICS.histograms.get((name, _series(name, {"group": group, "run": run})))
+            if hist is not None and hist.count:
+                cells.append(f"{run}: mean {hist.sum / hist.count:.1f}s p50 {hist.quantile(0.5):.1f}s (n={hist.count})")
+        if cells:
+            print(f"[lora] {group} ({', '.join(positions)})  " + "  ".join(cells))
+
+
+class GenerationCache:
+    """Generation results keyed by image content hash + request fingerprint.
+
+    Lets a moved, renamed or duplicated image reuse an earlier prediction (or
+    its R2 copy) instead of paying for the same generation again; a
+    duplicate that comes up while the original is still being submitted
+    waits for it (claim/release). Stored as
+    an append-only JSON-lines file where the last record per key wins; a
+    record with "forget" drops the key.
+    """
+
+    def __init__(self, cache_file: Path | None = None) -> None:
+        self.cache_file = cache_file or GENERATION_CACHE_FILE
+        self.entries: dict[str, dict] = {}
+        self._claims: dict[str, asyncio.Event] = {}  # keys being submitted right now
+        self._fh = None
+
+    def load(self, compact: bool = True) -> "GenerationCache":
+        records = 0
+        if self.cache_file.exists():
+            with open(self.cache_file, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    records += 1
+                    key = record.pop("key")
+                    if record.pop("forget", False):
+                        self.entries.pop(key, None)
+                    else:
+                        self.entries.setdefault(key, {}).update(record)
+        if compact and records > 2 * len(self.entries):
+            # Mostly superseded records: rewrite one line per live key
+            tmp = self.cache_file.with_suffix(".tmp")
+            tmp.write_text("".join(json.dumps({"key": k, **v}) + "\n" for k, v in self.entries.items()))
+            tmp.replace(self.cache_file)
+        return self
+
+    def get(self, key: str) -> dict | None:
+        return self.entries.get(key)
+
+    async def claim(self, key: str) -> dict | None:
+        """The reusable result for `key`, or None once the caller holds `key`:
+        it then submits and calls release(). Waits while an identical
+        submission holds it, so duplicates within a run share one generation."""
+        while key in self._claims:
+            await self._claims[key].wait()
+        hit = self.get(key)
+        if hit and (hit.get("videoUrl") or hit.get("requestId")):
+            return hit
+        self._claims[key] = asyncio.Event()
+        return None
+
+    def release(self, key: str) -> None:
+        event = self._claims.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def record(self, key: str, **fields: Any) -> None:
+        self.entries.setdefault(key, {}).update(fields)
+        self._append({"key": key, **fields})
+
+    def forget(self, key: str) -> None:
+        if self.entries.pop(key, None) is not None:
+            self._append({"key": key, "forget": True})
+
+    def _append(self, record: dict) -> None:
+        if self._fh is None:
+            self._fh = open(self.cache_file, "a", encoding="utf-8")
+        self._fh.write(json.dumps(record) + "\n")
+        self._fh.flush()
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class ImageStager:
+    """Uploads each source image to R2 once so submissions can carry its URL.
+
+    Objects are keyed by content hash and downscale setting, so renamed or
+    duplicated images share one object. Public URLs are remembered in
+    STAGED_IMAGES_FILE (same JSON-lines format as GenerationCache) across
+    runs; if that file is lost, the uploader's ETag check still avoids
+    sending the bytes again.
+    """
+
+    def __init__(self, uploader: "R2Uploader", encoder: ImageEncoder, cache_file: Path | None = None) -> None:
+        self.uploader = uploader
+        self.encoder = encoder
+        self.urls = GenerationCache(cache_file or STAGED_IMAGES_FILE)
+
+    def load(self, compact: bool = True) -> "ImageStager":
+        self.urls.load(compact)
+        return self
+
+    async def url(self, path: str) -> str | None:
+        """Public URL of the staged image, uploading it first if needed; None on failure."""
+        digest = await self.encoder.content_hash(path)
+        max_side = self.encoder.max_side
+        key = f"{digest}|max_side={max_side}"
+        hit = self.urls.get(key)
+        if hit:
+            METRICS.inc("gv_image_staging_total", result="cached")
+            return hit["url"]
+        with METRICS.track("stage_image"):
+            data, mime = await asyncio.to_thread(_image_payload, path, max_side)
+            ext = next((e for e, m in IMAGE_MIME_TYPES.items() if m == mime), ".jpg")
+            object_key = f"{R2_IMAGE_PREFIX}/{digest[:32]}{f'-{max_side}' if max_side else ''}{ext}"
+            staged = await self.uploader.upload_bytes(data, object_key, mime)
+        METRICS.inc("gv_image_staging_total", result="uploaded" if staged else "error")
+        if not staged:
+            return None
+        url = f"{R2_PUBLIC_URL}/{object_key}"
+        self.urls.record(key, url=url)
+        return url
+
+    def close(self) -> None:
+        self.urls.close()
+
+
+def _perceptual_hash(path: str) -> int | None:
+    """64-bit DCT hash (pHash) of an image, or None if it cannot be decoded.
+
+    Runs in PerceptualIndex's worker processes.
+    """
+    import numpy as np
+    from PIL import Image
+
+    try:
+        with Image.open(path) as img:
+            small = img.convert("L").resize((PHASH_SIDE, PHASH_SIDE), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    k = np.arange(PHASH_SIDE)
+    dct = np.cos(np.pi * k[:, None] * (2 * k[None, :] + 1) / (2 * PHASH_SIDE))  # DCT-II basis, row per frequency
+    low = (dct @ np.asarray(small, dtype=np.float64) @ dct.T)[:8, :8].ravel()
+    # The DC term is overall brightness; leave it out of the median
+    return int.from_bytes(np.packbits(low > np.median(low[1:])).tobytes(), "big")
+
+
+class PerceptualIndex:
+    """Perceptual hashes of source images, for finding near-duplicates.
+
+    A pHash keeps only the coarsest structure of an image, so re-encodes,
+    resizes, recompressed reposts and small overlays land a few bits apart.
+    Hashes are computed in a process pool and kept in PHASH_INDEX_FILE
+    (GenerationCache's JSON-lines format) keyed by path; a file whose size
+    or mtime changed is hashed again. Needs NumPy and Pillow.
+    """
+
+    def __init__(self, workers: int = DEDUP_WORKERS, index_file: Path | None = None) -> None:
+        try:
+            import numpy  # noqa: F401
+            import PIL  # noqa: F401
+        except ImportError:
+            print("ERROR: --dedup requires NumPy and Pillow (pip install numpy pillow)")
+            sys.exit(1)
+        self.workers = workers
+        self.records = GenerationCache(index_file or PHASH_INDEX_FILE)
+        self.hashes: dict[str, int] = {}
+
+    def load(self, compact: bool = True) -> "PerceptualIndex":
+        self.records.load(compact)
+        return self
+
+    def update(self, paths: Iterable[str]) -> None:
+        """Hash every readable path not already indexed in its current state."""
+        stale: list[tuple[str, os.stat_result]] = []
+        for path in dict.fromkeys(paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            known = self.records.get(path)
+            if known and known.get("size") == st.st_size and known.get("mtime") == st.st_mtime_ns:
+                if known.get("phash"):
+                    self.hashes[path] = int(known["phash"], 16)
+            else:
+                stale.append((path, st))
+        if not stale:
+            return
+        with METRICS.track("phash"), ProcessPoolExecutor(self.workers) as pool:
+            hashed = pool.map(_perceptual_hash, [path for path, _ in stale], chunksize=32)
+            for (path, st), phash in zip(stale, hashed):
+                self.records.record(
+                    path, size=st.st_size, mtime=st.st_mtime_ns, phash=f"{phash:016x}" if phash is not None else None,
+                )
+                if phash is not None:
+                    self.hashes[path] = phash
+        print(f"[dedup] Hashed {len(stale)} images ({len(self.hashes)} indexed)")
+
+    def clusters(self, paths: list[str], threshold: int = DEDUP_THRESHOLD) -> dict[str, str]:
+        """Map each near-duplicate in `paths` to its cluster's representative.
+
+        Greedy in the given order: the first unclaimed path becomes a
+        representative and claims every later unclaimed path within
+        `threshold` bits of it, so each member is close to its
+        representative (no chaining) and the representative is the one that
+        would have been submitted first. Distances to all remaining hashes
+        are computed at once with NumPy.
+        """
+        import numpy as np
+
+        known = [path for path in dict.fromkeys(paths) if path in self.hashes]
+        hashes = np.array([self.hashes[path] for path in known], dtype=np.uint64)
+        open_ = np.ones(len(known), dtype=bool)
+        links: dict[str, str] = {}
+        for i, path in enumerate(known):
+            if not open_[i]:
+                continue
+            rest = hashes[i + 1:] ^ hashes[i]
+            if hasattr(np, "bitwise_count"):
+                distance = np.bitwise_count(rest)
+            else:
+                distance = np.unpackbits(rest.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+            near = np.flatnonzero(open_[i + 1:] & (distance <= threshold)) + i + 1
+            open_[near] = False
+            for j in near:
+                links[known[j]] = path
+        return links
+
+    def close(self) -> None:
+        self.records.close()
+
+
+def dedup_items(items: Iterable[dict], index: PerceptualIndex, threshold: int = DEDUP_THRESHOLD) -> Iterator[dict]:
+    """Yield `items`, marking near-duplicates with "duplicate_of" (their representative's path).
+
+    Needs the whole manifest up front, so items are collected first (only the
+    fields submission and the feed need are kept) and hashed on first use.
+    """
+    items = [{"path": item["path"], **_item_meta(item)} for item in items]
+    index.update(item["path"] for item in items)
+    links = index.clusters([item["path"] for item in items], threshold)
+    if links:
+        print(f"[dedup] {len(links)} near-duplicates of {len(set(links.values()))} images will reuse their videos")
+    for item in items:
+        rep = links.get(item["path"])
+        yield {**item, "duplicate_of": rep} if rep else item
+
+
+def request_fingerprint(
+    position: str, max_image_side: int | None = None, presets: PresetRegistry | None = None,
+) -> str:
+    """Stable hash of everything except the image that shapes a generation."""
+    return (presets or PRESETS).get(position).fingerprint_for(max_image_side)
+
+
+# ---------------------------------------------------------------------------
+# Async workers
+# ---------------------------------------------------------------------------
+def _retry_after_seconds(value: str | None) -> float | None:
+    """Parse a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit shared by all submissions.
+
+    Each success raises the limit by AIMD_INCREASE / limit (about +1 per
+    limit's worth of successes); a 429 or 5xx multiplies it by AIMD_DECREASE,
+    at most once per AIMD_COOLDOWN so a burst of rejections counts as one
+    congestion event. A Retry-After hint also pauses new acquisitions until
+    it expires.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = AIMD_MAX_CONCURRENCY) -> None:
+        self.minimum = minimum
+        self.maximum = max(maximum, initial)
+        self.limit = float(initial)
+        self.in_flight = 0
+        self._blocked_until = 0.0
+        self._last_cut = 0.0
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        started = time.monotonic()
+        async with self._cond:
+            while True:
+                wait = self._blocked_until - time.monotonic()
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    await self._cond.wait()
+            self.in_flight += 1
+        METRICS.observe("gv_submit_wait_seconds", time.monotonic() - started)
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def on_success(self) -> None:
+        before = int(self.limit)
+        self.limit = min(self.maximum, self.limit + AIMD_INCREASE / self.limit)
+        if int(self.limit) != before:
+            print(f"[aimd] concurrency {before} -> {int(self.limit)}")
+
+    def on_throttle(self, retry_after: float | None, reason: str) -> None:
+        now = time.monotonic()
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+        if now - self._last_cut < AIMD_COOLDOWN:
+            return
+        self._last_cut = now
+        before = int(self.limit)
+        self.limit = max(self.minimum, self.limit * AIMD_DECREASE)
+        print(f"[aimd] concurrency {before} -> {int(self.limit)} ({reason})")
+
+
+def _apply_cache_hit(progress: ProgressStore, path: str, cache_key: str, hit: dict) -> None:
+    """Point a progress entry at an existing generation instead of submitting."""
+    if hit.get("videoUrl"):
+        progress.update(
+            path, status="completed", requestId=hit.get("requestId"), videoUrl=hit["videoUrl"],
+            r2Url=hit.get("r2Url"), cacheKey=cache_key, error=None,
+        )
+    else:
+        # Same generation still in flight (e.g. a duplicate earlier in this run)
+        progress.update(
+            path, status="submitted", requestId=hit["requestId"],
+            submittedAt=hit.get("submittedAt"), cacheKey=cache_key, error=None,
+        )
+    print(f"[cache-hit] {Path(path).name}  -> {hit.get('r2Url') or hit.get('videoUrl') or hit['requestId']}")
+
+
+async def submit_one(
+    session: aiohttp.ClientSession,
+    entry: dict,
+    progress: ProgressStore,
+    headers: dict,
+    delay: float,
+    dry_run: bool,
+    limiter: AdaptiveLimiter,
+    encoder: ImageEncoder | None = None,
+    cache: GenerationCache | None = None,
+    webhook_url: str | None = None,
+    stager: ImageStager | None = None,
+    presets: PresetRegistry | None = None,
+    shared_images: dict[str, asyncio.Future] | None = None,
+) -> bool:
+    """Submit a single image for I2V generation.
+
+    Concurrency is bounded by `limiter`, which adapts to throttling. With a
+    `cache` (and `encoder` to hash the image), an identical earlier
+    generation is reused instead of submitting again. With a `stager`, the
+    image is sent as a URL to its R2 copy rather than inline (falling back
+    to a data URI if staging fails). With `webhook_url`, WaveSpeed is asked
+    to call it when the prediction finishes. The request comes from the
+    position's template in `presets` (default PRESETS), or the variant's.
+    Variants of one image share its prepared form through `shared_images`.
+    Returns True if a new (billable) generation was submitted, or would have
+    been in a dry run.
+    """
+    path = entry["path"]
+    image_path = path.partition("#")[0]
+    position = entry.get("position", "general")
+    template = (presets or PRESETS).get(position, entry.get("variant"))
+
+    if dry_run:
+        spec = template.spec
+        hn = len(spec.get("high_noise_loras", []))
+        ln = len(spec.get("low_noise_loras", []))
+        print(f"[dry-run] {Path(path).name}  pos={position}  high_noise={hn} low_noise={ln}  duration={spec['duration']}")
+        progress.update(path, status="completed", videoUrl="(dry-run)")
+        return True
+
+    async def prepare_image() -> str:
+        image = await stager.url(image_path) if stager is not None else None
+        if image is None:
+            image = await encoder.data_uri(image_path) if encoder else image_to_data_uri(image_path)
+        return image
+
+    # Encode image (hashing first so a cache hit skips the encode)
+    cache_key = claimed = None
+    try:  # until submitted or given up, duplicates of a claimed key wait
+        try:
+            if cache is not None and encoder is not None:
+                image_hash = await encoder.content_hash(image_path)
+                cache_key = f"{image_hash}:{template.fingerprint_for(encoder.max_side)}"
+                hit = await cache.claim(cache_key)
+                if hit:
+                    _apply_cache_hit(progress, path, cache_key, hit)
+                    METRICS.inc("gv_submit_total", result="cache_hit")
+                    return False
+                claimed = cache_key
+            if shared_images is not None and image_path != path:
+                # Variants are queued back to back: the first prepares the image, the rest await it
+                if image_path not in shared_images:
+                    shared_images[image_path] = asyncio.ensure_future(prepare_image())
+                    while len(shared_images) > VARIANT_IMAGE_MEMO:
+                        shared_images.pop(next(iter(shared_images)))
+                image = await shared_images[image_path]
+            else:
+                image = await prepare_image()
+        except FileNotFoundError:
+            progress.update(path, status="failed", error=f"Image file not found: {image_path}")
+            print(f"[error] Image not found: {image_path}")
+            return False
+        except (OSError, ValueError) as e:
+            # Unreadable, or undecodable when --max-image-side re-encodes it (PIL's
+            # UnidentifiedImageError is an OSError); only this job fails
+            progress.update(path, status="failed", error=f"Image unusable: {type(e).__name__}: {e}")
+            print(f"[error] Image unusable: {image_path}: {e}")
+            return False
+
+        params = {"webhook": webhook_url} if webhook_url else None
+        payload = template.body(image)  # serialized once, not per retry
+
+        # Submit with retry on 429/5xx; the slot is released while backing off
+        throttles = 0
+        for attempt in range(MAX_RETRIES):
+            backoff = RETRY_BASE_DELAY * (2 ** attempt)
+            try:
+                async with limiter.slot():
+                    with METRICS.track("submit"):
+                        started = time.monotonic()
+                        async with session.post(SUBMIT_URL, data=payload, headers=headers, params=params) as resp:
+                            throttled = resp.status == 429 or resp.status >= 500
+                            if throttled:
+                                throttles += 1
+                                METRICS.inc("gv_submit_total", result="throttled")
+                                hint = _retry_after_seconds(resp.headers.get("Retry-After"))
+                                limiter.on_throttle(hint, f"HTTP {resp.status}")
+                                if hint is not None:
+                                    backoff = hint
+                                print(f"[rate-limit] {resp.status} for {Path(path).name}, retry {attempt+1}/{MAX_RETRIES} in {backoff:.0f}s")
+                            else:
+                                resp_data = await resp.json()
+                                if resp.status != 200:
+                                    METRICS.inc("gv_submit_total", result="http_error")
+                                    progress.update(path, status="failed", error=f"HTTP {resp.status}: {json.dumps(resp_data)}")
+                                    print(f"[error] Submit failed for {Path(path).name}: HTTP {resp.status}")
+                                    return False
+                                limiter.on_success()
+                                METRICS.inc("gv_submit_total", result="ok")
+                                request_id = resp_data.get("data", {}).get("id") or resp_data.get("id")
+                                if not request_id:
+                                    progress.update(path, status="failed", error=f"No request ID in response: {json.dumps(resp_data)}")
+                                    print(f"[error] No request ID for {Path(path).name}")
+                                    return False
+                                submitted_at = time.time()
+                                progress.update(
+                                    path, status="submitted", requestId=request_id,
+                                    submittedAt=submitted_at, cacheKey=cache_key,
+                                    # Timing history for `plan`
+                                    submitAttempts=attempt + 1, throttles=throttles,
+                                    submitSeconds=round(time.monotonic() - started, 3), submitLimit=int(limiter.limit),
+                                )
+                                if cache is not None and cache_key:
+                                    cache.record(cache_key, requestId=request_id, submittedAt=submitted_at)
+                                print(f"[submitted] {Path(path).name}  pos={position}  id={request_id}")
+                    if not throttled:
+                        # Rate-limit between submissions
+                        await asyncio.sleep(delay)
+                        return True
+            except Exception as e:
+                METRICS.inc("gv_submit_total", result="error")
+                if attempt == MAX_RETRIES - 1:
+                    progress.update(path, status="failed", error=str(e))
+                    print(f"[error] All retries failed for {Path(path).name}: {e}")
+                    return False
+                print(f"[error] Exception for {Path(path).name}: {e}, retry in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+        return False
+
+    finally:
+        if claimed is not None:
+            cache.release(claimed)
+
+def record_result(path: str, progress: ProgressStore, data: dict) -> bool:
+    """Apply a prediction result (poll response or webhook `data`). Returns True if terminal."""
+    status = data.get("status")
+    if status == "completed":
+        outputs = data.get("outputs") or []
+        progress.update(path, status="completed", videoUrl=outputs[0] if outputs else None, finishedAt=time.time())
+        print(f"[completed] {Path(path).name}")
+        return True
+    if status == "failed":
+        progress.update(path, status="failed", error=data.get("error") or "Unknown error", finishedAt=time.time())
+        print(f"[failed] {Path(path).name}: {progress[path]['error']}")
+        return True
+    return False
+
+
+async def poll_one(
+    session: aiohttp.ClientSession,
+    path: str,
+    progress: ProgressStore,
+    headers: dict,
+) -> bool:
+    """Poll a single submitted prediction. Returns True if terminal (completed/failed)."""
+    request_id = progress[path].get("requestId")
+    if not request_id:
+        progress.update(path, status="failed", error="No requestId to poll")
+        return True
+
+    url = RESULT_URL.format(request_id=request_id)
+    try:
+        async with session.get(url, headers=headers) as resp:
+            if resp.status != 200:
+                progress.update(path, poll_errors=progress[path].get("poll_errors", 0) + 1)
+                if progress[path]["poll_errors"] >= 10:
+                    progress.update(path, status="failed", error=f"Too many poll errors (HTTP {resp.status})")
+                    print(f"[failed] {Path(path).name}: HTTP {resp.status} after 10 retries")
+                    return True
+                print(f"[warn] Poll HTTP {resp.status} for {Path(path).name}")
+                return False
+            resp_data = await resp.json()
+            data = resp_data.get("data", {})
+            status = data.get("status", "unknown")
+            if status in ("completed", "failed"):
+                return record_result(path, progress, data)
+            elif status == "unknown":
+                progress.update(path, poll_errors=progress[path].get("poll_errors", 0) + 1)
+                if progress[path]["poll_errors"] >= 10:
+                    progress.update(path, status="failed", error=f"Unknown status after 10 polls")
+                    print(f"[failed] {Path(path).name}: unknown status after 10 retries")
+                    return True
+            # still processing
+            return False
+    except Exception as e:
+        progress.update(path, poll_errors=progress[path].get("poll_errors", 0) + 1)
+        if progress[path]["poll_errors"] >= 10:
+            progress.update(path, status="failed", error=f"Poll exception after 10 retries: {e}")
+            print(f"[failed] {Path(path).name}: {e} after 10 retries")
+            return True
+        print(f"[warn] Poll error for {Path(path).name}: {e}")
+        return False
+
+
+class PollScheduler:
+    """Polls in-flight predictions from a min-heap of per-job deadlines.
+
+    A job's first poll is scheduled shortly before the observed typical
+    generation time (an EMA of jobs completed so far this run); after that,
+    or before anything has completed, it backs off
+    geometrically from `min_interval` up to `max_interval`. Every delay is
+    jittered and at most `concurrency` result requests run at once.
+
+    Results can also be pushed in with `deliver` (see WebhookReceiver). With
+    `fallback_interval`, jobs are expected to finish that way and are only
+    polled every `fallback_interval` seconds, as a safety net for callbacks
+    that never arrive.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        progress: ProgressStore,
+        headers: dict,
+        concurrency: int = POLL_CONCURRENCY,
+        min_interval: float = POLL_MIN_INTERVAL,
+        max_interval: float = POLL_MAX_INTERVAL,
+        jitter: float = POLL_JITTER,
+        on_terminal: Callable[[str], Awaitable[None]] | None = None,
+        fallback_interval: float | None = None,
+    ) -> None:
+        self.session = session
+        self.progress = progress
+        self.headers = headers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.fallback_interval = fallback_interval
+        self.expected_seconds: float | None = None  # EMA of submit-to-complete
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._heap: list[tuple[float, int, str]] = []
+        self._waiting: set[str] = set()  # paths with a live heap entry
+        self._seq = 0
+        self._overdue_polls: dict[str, int] = {}
+        self._poll_counts: dict[str, int] = {}  # doubles as the set of unfinished jobs
+        self._by_request_id: dict[str, str] = {}
+        self._early: dict[str, dict] = {}  # pushed before the job was added
+        self._inflight: set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._on_terminal = on_terminal
+        self._closed = False
+
+    @property
+    def scheduled(self) -> int:
+        """Jobs waiting in the heap for their next poll."""
+        return len(self._waiting)
+
+    def add(self, path: str) -> None:
+        """Schedule a submitted job for its first poll."""
+        self._overdue_polls[path] = 0
+        self._poll_counts[path] = 0
+        request_id = self.progress[path].get("requestId")
+        if request_id:
+            self._by_request_id[request_id] = path
+            early = self._early.pop(request_id, None)
+            if early is not None and record_result(path, self.progress, early):
+                # The webhook beat the submit bookkeeping with a final result;
+                # anything else ("processing") leaves the job to be polled
+                self._start(self._finish_pushed(path, self._poll_counts.pop(path)))
+                return
+        self._push(path, self._first_delay(path))
+
+    def deliver(self, data: dict) -> bool:
+        """Apply a pushed result for prediction `data["id"]`.
+
+        Returns False if the prediction is not one of this run's. A terminal
+        result finishes the job as a poll would have; anything else, or a
+        repeat of a result already applied, is ignored and polling carries on.
+        """
+        request_id = data.get("id")
+        path = self._by_request_id.get(request_id)
+        if path is None:
+            if request_id and len(self._early) < WEBHOOK_EARLY_MAX:
+                self._early[request_id] = data
+            return False
+        if path in self._poll_counts and record_result(path, self.progress, data):
+            # Claimed here, before the finish task runs, so a retried callback
+            # or an in-flight poll cannot finish the job a second time
+            self._waiting.discard(path)
+            self._start(self._finish_pushed(path, self._poll_counts.pop(path)))
+        return True
+
+    def _push(self, path: str, delay: float) -> None:
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, path))
+        self._waiting.add(path)
+        self._seq += 1
+        self._wakeup.set()
+
+    def _start(self, coro: Awaitable[None]) -> None:
+        task = asyncio.create_task(coro)
+        self._inflight.add(task)
+
+    def _first_delay(self, path: str) -> float:
+        submitted_at = self.progress[path].get("submittedAt")
+        if submitted_at is None:
+            # Submitted by an older run with no timestamp: check right away
+            return 0.0
+        if self.fallback_interval is not None:
+            # Jobs from an earlier run called its receiver, not this one: poll them now
+            return max(0.0, self.fallback_interval - (time.time() - submitted_at))
+        if self.expected_seconds is None:
+            # Nothing observed yet; fall back to plain backoff
+            return self._next_delay(path)
+        # Aim a little early; most jobs land near the EMA, some before it
+        remaining = 0.75 * self.expected_seconds - (time.time() - submitted_at)
+        return max(self.min_interval, remaining)
+
+    def _next_delay(self, path: str) -> float:
+        if self.fallback_interval is not None:
+            return self.fallback_interval
+        n = self._overdue_polls[path]
+        self._overdue_polls[path] = n + 1
+        return min(self.max_interval, self.min_interval * POLL_BACKOFF ** n)
+
+    def _observe(self, path: str) -> None:
+        entry = self.progress[path]
+        submitted_at = entry.get("submittedAt")
+        if entry["status"] == "completed" and submitted_at is not None:
+            took = time.time() - submitted_at
+            METRICS.observe("gv_generation_seconds", took)
+            if entry.get("loraGroup"):
+                METRICS.observe("gv_lora_generation_seconds", took, group=entry["loraGroup"], run=entry["loraRun"])
+            if self.expected_seconds is None:
+                self.expected_seconds = took
+            else:
+                self.expected_seconds = 0.8 * self.expected_seconds + 0.2 * took
+
+    async def _finish(self, path: str, via: str, polls: int) -> None:
+        """Wrap up a job already claimed (removed from _poll_counts) by the caller."""
+        self._overdue_polls.pop(path, None)
+        self._by_request_id.pop(self.progress[path].get("requestId"), None)
+        self.progress.update(path, polls=polls)
+        METRICS.observe("gv_polls_per_job", polls, COUNT_BUCKETS)
+        METRICS.inc("gv_jobs_finished_total", status=self.progress[path]["status"], via=via)
+        self._observe(path)
+        if self._on_terminal is not None:
+            await self._on_terminal(path)
+
+    async def _finish_pushed(self, path: str, polls: int) -> None:
+        try:
+            await self._finish(path, "webhook", polls)
+        finally:
+            self._inflight.discard(asyncio.current_task())
+            self._wakeup.set()
+
+    async def _poll(self, path: str) -> None:
+        try:
+            async with self._semaphore:
+                if path not in self._poll_counts:
+                    return  # finished by a webhook while queued for a slot
+                with METRICS.track("poll"):
+                    terminal = await poll_one(self.session, path, self.progress, self.headers)
+            if path not in self._poll_counts:
+                return  # a webhook finished it during the request
+            self._poll_counts[path] += 1
+            if terminal:
+                await self._finish(path, "poll", self._poll_counts.pop(path))
+            else:
+                self._push(path, self._next_delay(path))
+        finally:
+            self._inflight.discard(asyncio.current_task())
+            self._wakeup.set()
+
+    def close(self) -> None:
+        """No more jobs will be added; `run` returns once the heap drains."""
+        self._closed = True
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        """Dispatch polls as deadlines come due until closed and drained."""
+        last_stats = time.monotonic()
+        while self._waiting or self._inflight or not self._closed:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._heap and (self._heap[0][0] <= now or self._heap[0][2] not in self._waiting):
+                _, _, path = heapq.heappop(self._heap)
+                if path in self._waiting:  # else finished by a webhook
+                    self._waiting.discard(path)
+                    self._start(self._poll(path))
+            if now - last_stats >= POLL_STATS_INTERVAL:
+                print_stats(self.progress)
+                last_stats = now
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class WebhookReceiver:
+    """Local HTTP endpoint WaveSpeed calls when a prediction finishes.
+
+    Each submission carries `url`, which ends in a random per-run token;
+    callbacks with any other token are rejected. Payloads are handed to
+    `handler` (PollScheduler.deliver). WaveSpeed has to be able to reach
+    the receiver: pass the public address (e.g. a tunnel) as `public_url`,
+    where "{port}" stands for `port`.
+    """
+
+    def __init__(self, port: int, host: str = WEBHOOK_HOST, public_url: str | None = None) -> None:
+        self.port = port
+        self.host = host
+        self.token = secrets.token_urlsafe(16)
+        base = (public_url.format(port=port) if public_url else f"http://{host}:{port}").rstrip("/")
+        self.url = f"{base}{WEBHOOK_PATH}/{self.token}"
+        self.handler: Callable[[dict], bool] | None = None
+        self._runner: web.AppRunner | None = None
+
+    async def start(self) -> "WebhookReceiver":
+        app = web.Application()
+        app.router.add_post(f"{WEBHOOK_PATH}/{{token}}", self._receive)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"[webhook] Listening on http://{self.host}:{self.port}{WEBHOOK_PATH}/...")
+        return self
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _receive(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.match_info["token"], self.token):
+            METRICS.inc("gv_webhook_total", result="rejected")
+            return web.Response(status=404)
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = None
+        data = payload.get("data", payload) if isinstance(payload, dict) else None
+        if not isinstance(data, dict) or not data.get("id"):
+            METRICS.inc("gv_webhook_total", result="malformed")
+            return web.Response(status=400)
+        known = self.handler is not None and self.handler(data)
+        METRICS.inc("gv_webhook_total", result="ok" if known else "unknown")
+        return web.json_response({"ok": True})
+
+
+# ---------------------------------------------------------------------------
+# Post-generation: download → R2 upload → feed shards update
+# ---------------------------------------------------------------------------
+def _derive_video_key(image_path: str) -> str:
+    """Derive R2 object key from source image path.
+    e.g. .../twitter/gaizellic/1945940187520884932_1.jpg → gaizellic_1945940187520884932_1
+    A variant (path#B, see PresetRegistry.expand) gets its label appended: ..._1_B
+    """
+    image_path, _, variant = image_path.partition("#")
+    p = Path(image_path)
+    account = p.parent.name
+    stem = p.stem  # e.g. 1945940187520884932_1
+    return f"{account}_{stem}_{variant}" if variant else f"{account}_{stem}"
+
+
+def _file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+async def _remote_size(session: aiohttp.ClientSession, url: str) -> int | None:
+    try:
+        async with session.head(url) as resp:
+            return resp.content_length if resp.status == 200 else None
+    except aiohttp.ClientError:
+        return None
+
+
+async def download_video(session: aiohttp.ClientSession, video_key: str, url: str) -> Path | None:
+    """Fetch a generated video from CloudFront unless it is already local.
+
+    Bytes go to `<key>.mp4.part`, which is renamed into place only once its
+    size matches Content-Length (and its MD5 a plain-MD5 ETag), so a crash
+    never leaves a truncated .mp4 behind. An interrupted transfer resumes
+    from the .part file with a Range request, on this or a later run.
+    Disk writes happen off the event loop.
+    """
+    local_file = GENERATED_DIR / f"{video_key}.mp4"
+    part_file = local_file.with_name(local_file.name + ".part")
+    if local_file.exists():
+        # Written whole by rename -- unless an older version left it truncated
+        local_size = _file_size(local_file)
+        remote_size = await _remote_size(session, url)
+        if remote_size is None or remote_size == local_size:
+            return local_file
+        print(f"[download] {video_key}.mp4 is {local_size}/{remote_size} bytes; resuming")
+        local_file.replace(part_file)
+    print(f"[download] {video_key}.mp4 ...")
+    started = time.monotonic()
+    received = 0
+    error = "error"
+    try:
+        with METRICS.track("download"):
+            for attempt in range(DOWNLOAD_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(DOWNLOAD_RETRY_DELAY * attempt)
+                offset = _file_size(part_file)
+                headers = {"Range": f"bytes={offset}-"} if offset else {}
+                try:
+                    async with session.get(url, headers=headers) as resp:
+                        if resp.status == 416 and offset:
+                            # Nothing past the end: the .part may already be whole
+                            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                            if total == str(offset):
+                                expected, etag = offset, None
+                                break
+                            part_file.unlink()
+                            continue
+                        if resp.status not in (200, 206):
+                            print(f"[warn] Download failed for {video_key}: HTTP {resp.status}")
+                            error = "http_error"
+                            if resp.status < 500 and resp.status != 429:
+                                METRICS.inc("gv_download_total", result=error)
+                                return None
+                            continue
+                        if resp.status == 200:
+                            offset = 0  # server ignored the Range; start over
+                        expected = offset + resp.content_length if resp.content_length is not None else None
+                        etag = resp.headers.get("ETag", "").strip('"')  # of the whole object
+                        f = await asyncio.to_thread(open, part_file, "ab" if offset else "wb")
+                        try:
+                            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                await asyncio.to_thread(f.write, chunk)
+                                received += len(chunk)
+                        finally:
+                            await asyncio.to_thread(f.close)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print(f"[warn] Download of {video_key} interrupted at {_file_size(part_file)} bytes: {e}")
+                    continue
+                size = _file_size(part_file)
+                if expected is not None and size != expected:
+                    print(f"[warn] Download of {video_key} short: {size}/{expected} bytes")
+                    continue
+                break
+            else:
+                print(f"[warn] Download failed for {video_key} after {DOWNLOAD_ATTEMPTS} attempts")
+                METRICS.inc("gv_download_total", result=error)
+                return None
+            if etag and re.fullmatch(r"[0-9a-f]{32}", etag):
+                # Plain (non-multipart) ETags are the object's MD5
+                if await asyncio.to_thread(_local_etag, part_file) != etag:
+                    print(f"[warn] Download of {video_key} failed its checksum; discarding")
+                    part_file.unlink()
+                    METRICS.inc("gv_download_total", result="corrupt")
+                    return None
+            part_file.replace(local_file)
+    except Exception as e:
+        print(f"[warn] Download error for {video_key}: {e}")
+        METRICS.inc("gv_download_total", result="error")
+        return None
+    finally:
+        METRICS.inc("gv_download_bytes_total", received)
+    METRICS.inc("gv_download_total", result="ok")
+    METRICS.observe(
+        "gv_download_bytes_per_second", received / max(time.monotonic() - started, 1e-6), THROUGHPUT_BUCKETS,
+    )
+    return local_file
+
+
+def upload_to_r2(local_file: Path, video_key: str, key: str | None = None, content_type: str = "video/mp4") -> bool:
+    """Upload one video (or, with `key`, any file) with wrangler.
+
+    Fallback when R2Uploader is not configured. Blocking; run it in a thread.
+    """
+    key = key or f"{R2_PREFIX}/{video_key}.mp4"
+    name = Path(key).name
+    print(f"[r2-upload] {name} ...")
+    try:
+        result = subprocess.run(
+            ["wrangler", "r2", "object", "put", f"{R2_BUCKET}/{key}",
+             "--file", str(local_file), "--content-type", content_type, "--remote"],
+            capture_output=True, text=True, timeout=120,
+        )
+        if result.returncode != 0:
+            print(f"[warn] R2 upload failed for {name}: {result.stderr[:200]}")
+            return False
+    except Exception as e:
+        print(f"[warn] R2 upload error for {name}: {e}")
+        return False
+    return True
+
+
+def _moov_first(path: Path) -> bool:
+    """True if the MP4's index (moov) comes before its media data, i.e. it can start streaming."""
+    with open(path, "rb") as f:
+        while header := f.read(8):
+            if len(header) < 8:
+                return False
+            size, kind = int.from_bytes(header[:4], "big"), header[4:]
+            if kind == b"moov":
+                return True
+            if kind == b"mdat":
+                return False
+            if size == 1:
+                size = int.from_bytes(f.read(8), "big") - 8
+            elif size < 8:
+                return False  # 0 = runs to end of file; anything else is corrupt
+            f.seek(size - 8, os.SEEK_CUR)
+    return False
+
+
+async def _ffmpeg_render(output: Path, *args: str) -> bool:
+    """Run ffmpeg writing to a temp file next to `output`, renamed into place on success."""
+    tmp = output.with_name(f"{output.stem}.tmp{output.suffix}")  # keeps the extension ffmpeg keys on
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-v", "error", "-y", *args, str(tmp),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        tmp.unlink(missing_ok=True)
+        print(f"[warn] ffmpeg failed for {output.name}: {stderr.decode(errors='replace')[-200:]}")
+        return False
+    tmp.replace(output)
+    return True
+
+
+def _faststart_file(video_key: str) -> Path:
+    """Where postprocess_video puts the fast-start remux of `<key>.mp4`."""
+    return GENERATED_DIR / f"{video_key}.faststart.mp4"
+
+
+async def postprocess_video(
+    video_key: str, local_file: Path, poster_format: str = "jpg",
+) -> tuple[Path, dict[str, Path]]:
+    """Make a fast-start copy of `local_file` and render its poster and preview.
+
+    Returns the video to upload (the `<key>.faststart.mp4` remux, or
+    `local_file` when it already starts fast or the remux failed) and the
+    renditions that exist afterwards ("poster", "preview"). The download
+    itself is left byte-for-byte as served, so download_video can still
+    compare it with the CDN's size and resume it. Outputs are renamed into
+    place only when complete, so anything already on disk is reused and
+    reruns only do missing work.
+    """
+    renditions: dict[str, Path] = {}
+    video = local_file
+    with METRICS.track("postprocess"):
+        faststart = _faststart_file(video_key)
+        if faststart.exists():
+            METRICS.inc("gv_postprocess_total", output="faststart", result="skipped")
+            video = faststart
+        elif await asyncio.to_thread(_moov_first, local_file):
+            METRICS.inc("gv_postprocess_total", output="faststart", result="skipped")
+        else:
+            # Stream copy; only the container is rewritten
+            ok = await _ffmpeg_render(
+                faststart, "-i", str(local_file), "-map", "0", "-c", "copy", "-movflags", "+faststart",
+            )
+            METRICS.inc("gv_postprocess_total", output="faststart", result="ok" if ok else "error")
+            if ok:
+                video = faststart
+
+        poster = GENERATED_DIR / f"{video_key}.poster.{poster_format}"
+        quality = ["-q:v", "3"] if poster_format == "jpg" else ["-quality", "80"]
+        preview = GENERATED_DIR / f"{video_key}.preview.mp4"
+        for name, output, args in (
+            ("poster", poster, ["-ss", f"{POSTER_SECOND:g}", "-i", str(local_file), "-frames:v", "1", *quality]),
+            ("preview", preview, [
+                "-i", str(local_file), "-vf", f"scale=-2:{PREVIEW_HEIGHT}", "-an",
+                "-c:v", "libx264", "-preset", "veryfast", "-crf", str(PREVIEW_CRF),
+                "-threads", "1", "-movflags", "+faststart",
+            ]),
+        ):
+            if output.exists():
+                METRICS.inc("gv_postprocess_total", output=name, result="skipped")
+                renditions[name] = output
+                continue
+            ok = await _ffmpeg_render(output, *args)
+            METRICS.inc("gv_postprocess_total", output=name, result="ok" if ok else "error")
+            if ok:
+                renditions[name] = output
+    return video, renditions
+
+
+def _sigv4_headers(
+    method: str,
+    url: str,
+    access_key: str,
+    secret_key: str,
+    headers: dict[str, str] | None = None,
+    payload_hash: str = "UNSIGNED-PAYLOAD",
+) -> dict[str, str]:
+    """Return `headers` plus AWS Signature V4 auth for an S3 request."""
+    parts = urlsplit(url)
+    now = datetime.now(timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    datestamp = now.strftime("%Y%m%d")
+
+    signed = {k.lower(): v.strip() for k, v in (headers or {}).items()}
+    signed.update({"host": parts.netloc, "x-amz-content-sha256": payload_hash, "x-amz-date": amz_date})
+    names = sorted(signed)
+    query = "&".join(
+        f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}"
+        for k, v in sorted(parse_qsl(parts.query, keep_blank_values=True))
+    )
+    canonical_request = "\n".join([
+        method,
+        parts.path or "/",
+        query,
+        "".join(f"{k}:{signed[k]}\n" for k in names),
+        ";".join(names),
+        payload_hash,
+    ])
+    scope = f"{datestamp}/{R2_REGION}/s3/aws4_request"
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope,
+        hashlib.sha256(canonical_request.encode()).hexdigest(),
+    ])
+    key = f"AWS4{secret_key}".encode()
+    for piece in (datestamp, R2_REGION, "s3", "aws4_request"):
+        key = hmac.new(key, piece.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    signed.pop("host")  # aiohttp sets it from the URL
+    signed["Authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={';'.join(names)}, Signature={signature}"
+    )
+    return signed
+
+
+def _local_etag(path: Path, multipart_parts: int = 0) -> str:
+    """ETag S3 would report for `path`: plain MD5, or MD5-of-part-MD5s."""
+    if not multipart_parts:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+    digests = b""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(R2_PART_SIZE), b""):
+            digests += hashlib.md5(chunk).digest()
+    return f"{hashlib.md5(digests).hexdigest()}-{multipart_parts}"
+
+
+def _read_range(path: Path, offset: int, size: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class R2Uploader:
+    """Uploads to R2_BUCKET through the S3 API over one pooled session.
+
+    Objects whose size and ETag already match the local file are skipped.
+    Files above R2_MULTIPART_THRESHOLD are sent as multipart uploads with
+    R2_PART_CONCURRENCY parts in flight. Requests are retried with the same
+    exponential backoff as WaveSpeed submissions.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        access_key: str,
+        secret_key: str,
+        concurrency: int = UPLOAD_CONCURRENCY,
+    ) -> None:
+        self.endpoint = endpoint.rstrip("/")
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency * R2_PART_CONCURRENCY),
+            timeout=aiohttp.ClientTimeout(total=None, sock_read=120),
+        )
+
+    @classmethod
+    def from_env(cls, concurrency: int = UPLOAD_CONCURRENCY) -> "R2Uploader | None":
+        """Build an uploader from R2_* settings, or None if they are missing."""
+        access_key = read_env("R2_ACCESS_KEY_ID")
+        secret_key = read_env("R2_SECRET_ACCESS_KEY")
+        endpoint = read_env("R2_ENDPOINT")
+        if not endpoint and read_env("R2_ACCOUNT_ID"):
+            endpoint = f"https://{read_env('R2_ACCOUNT_ID')}.r2.cloudflarestorage.com"
+        if not (access_key and secret_key and endpoint):
+            return None
+        return cls(endpoint, access_key, secret_key, concurrency)
+
+    async def close(self) -> None:
+        await self._session.close()
+
+    def _url(self, key: str, query: str = "") -> str:
+        url = f"{self.endpoint}/{R2_BUCKET}/{quote(key, safe='/-_.~')}"
+        return f"{url}?{query}" if query else url
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        data: bytes | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[int, Mapping[str, str], bytes]:
+        """Signed request; retries 5xx and network errors, returns anything else."""
+        for attempt in range(MAX_RETRIES):
+            signed = _sigv4_headers(method, url, self.access_key, self.secret_key, headers)
+            try:
+                async with self._session.request(method, URL(url, encoded=True), data=data, headers=signed) as resp:
+                    body = await resp.read()
+                    if resp.status < 500:
+                        # Copy keeps header lookups case-insensitive
+                        return resp.status, resp.headers.copy(), body
+                    error = f"HTTP {resp.status}: {body[:200]!r}"
+            except Exception as e:
+                error = str(e)
+            if attempt < MAX_RETRIES - 1:
+                await asyncio.sleep(RETRY_BASE_DELAY * (2 ** attempt))
+        raise RuntimeError(f"{method} {url} failed after {MAX_RETRIES} attempts: {error}")
+
+    async def _already_uploaded(self, local_file: Path, key: str, size: int) -> bool:
+        status, headers, _ = await self._request("HEAD", self._url(key))
+        if status != 200 or int(headers.get("Content-Length", -1)) != size:
+            return False
+        remote_etag = headers.get("ETag", "").strip('"')
+        parts = int(remote_etag.rpartition("-")[2]) if "-" in remote_etag else 0
+        return remote_etag == await asyncio.to_thread(_local_etag, local_file, parts)
+
+    async def upload_file(self, local_file: Path, key: str, content_type: str = "video/mp4") -> bool:
+        """Upload one file to R2_BUCKET/`key`. Returns True if it is now in place."""
+        name = Path(key).name
+        try:
+            size = local_file.stat().st_size
+            if await self._already_uploaded(local_file, key, size):
+                print(f"[r2-upload] {name} already up to date")
+                return True
+            print(f"[r2-upload] {name} ...")
+            if size > R2_MULTIPART_THRESHOLD:
+                await self._put_multipart(local_file, key, size, content_type)
+            else:
+                data = await asyncio.to_thread(local_file.read_bytes)
+                status, _, body = await self._request(
+                    "PUT", self._url(key), data, {"Content-Type": content_type},
+                )
+                if status != 200:
+                    raise RuntimeError(f"HTTP {status}: {body[:200]!r}")
+        except Exception as e:
+            print(f"[warn] R2 upload error for {name}: {e}")
+            return False
+        return True
+
+    async def upload_bytes(self, data: bytes, key: str, content_type: str) -> bool:
+        """Upload a small in-memory object unless R2 already has it. Returns True if it is in place."""
+        try:
+            status, headers, _ = await self._request("HEAD", self._url(key))
+            md5 = await asyncio.to_thread(lambda: hashlib.md5(data).hexdigest())
+            if status == 200 and headers.get("ETag", "").strip('"') == md5:
+                return True
+            status, _, body = await self._request("PUT", self._url(key), data, {"Content-Type": content_type})
+            if status != 200:
+                raise RuntimeError(f"HTTP {status}: {body[:200]!r}")
+        except Exception as e:
+            print(f"[warn] R2 upload error for {Path(key).name}: {e}")
+            return False
+        return True
+
+    async def list_objects(self, prefix: str) -> dict[str, int]:
+        """Every object under `prefix` as key -> size, R2_LIST_PAGE keys per request."""
+        objects: dict[str, int] = {}
+        token = None
+        while True:
+            query = f"list-type=2&max-keys={R2_LIST_PAGE}&prefix={quote(prefix, safe='')}"
+            if token:
+                query += f"&continuation-token={quote(token, safe='')}"
+            status, _, body = await self._request("GET", f"{self.endpoint}/{R2_BUCKET}?{query}")
+            if status != 200:
+                raise RuntimeError(f"ListObjectsV2 HTTP {status}: {body[:200]!r}")
+            token = None
+            for el in ET.fromstring(body):
+                tag = el.tag.rpartition("}")[2]
+                if tag == "Contents":
+                    fields = {child.tag.rpartition("}")[2]: child.text for child in el}
+                    objects[fields["Key"]] = int(fields.get("Size") or 0)
+                elif tag == "NextContinuationToken":
+                    token = el.text
+            if not token:
+                return objects
+
+    async def delete_object(self, key: str) -> bool:
+        """Delete R2_BUCKET/`key`. Returns True if it is gone."""
+        try:
+            status, _, body = await self._request("DELETE", self._url(key))
+            if status not in (200, 204, 404):
+                raise RuntimeError(f"HTTP {status}: {body[:200]!r}")
+        except Exception as e:
+            print(f"[warn] R2 delete error for {Path(key).name}: {e}")
+            return False
+        return True
+
+    async def _put_multipart(self, local_file: Path, key: str, size: int, content_type: str) -> None:
+        status, _, body = await self._request(
+            "POST", self._url(key, "uploads="), headers={"Content-Type": content_type},
+        )
+        if status != 200:
+            raise RuntimeError(f"CreateMultipartUpload HTTP {status}: {body[:200]!r}")
+        upload_id = next(el.text for el in ET.fromstring(body).iter() if el.tag.endswith("UploadId"))
+        upload_query = f"uploadId={quote(upload_id, safe='')}"
+        semaphore = asyncio.Semaphore(R2_PART_CONCURRENCY)
+
+        async def put_part(number: int, offset: int) -> str:
+            async with semaphore:
+                data = await asyncio.to_thread(_read_range, local_file, offset, R2_PART_SIZE)
+                status, headers, body = await self._request(
+                    "PUT", self._url(key, f"partNumber={number}&{upload_query}"), data,
+                )
+                if status != 200:
+                    raise RuntimeError(f"UploadPart {number} HTTP {status}: {body[:200]!r}")
+                return headers["ETag"]
+
+        try:
+            etags = await asyncio.gather(*(
+                put_part(i + 1, offset) for i, offset in enumerate(range(0, size, R2_PART_SIZE))
+            ))
+            manifest = "".join(
+                f"<Part><PartNumber>{i}</PartNumber><ETag>{etag}</ETag></Part>"
+                for i, etag in enumerate(etags, start=1)
+            )
+            status, _, body = await self._request(
+                "POST", self._url(key, upload_query),
+                f"<CompleteMultipartUpload>{manifest}</CompleteMultipartUpload>".encode(),
+            )
+            if status != 200 or b"<Error>" in body:
+                raise RuntimeError(f"CompleteMultipartUpload HTTP {status}: {body[:200]!r}")
+        except Exception:
+            await self._request("DELETE", self._url(key, upload_query))
+            raise
+
+
+class FeedWriter:
+    """Feed published as fixed-size page shards plus a small manifest.
+
+    Layout under FEED_DIR (ids and entries oldest first):
+      manifest.json               pages, totals, next id, index file list
+      pages/page-00000.json       up to FEED_PAGE_SIZE feed entries
+      index/creator/<name>.jsonl  ids by `creator`, one JSON string per line
+      index/tag/<position>.jsonl  ids by position tag
+      urls.txt                    every published videoUrl, for de-duplication
+
+    A flush rewrites only the open last page and the manifest, and appends
+    the new ids to the index files and the new urls to urls.txt, so adding
+    N videos writes O(N) bytes plus the small manifest. The manifest records
+    each index file's "count" and "bytes"; only that prefix is published, so
+    lines left by a flush that died before its manifest are cut off by the
+    next one. The web app can fetch the manifest and lazy-load one page at
+    a time.
+
+    On first use an existing feed-videos.json is imported; `export_legacy`
+    writes that flat format back out.
+
+    Several processes (see --workers) may share one feed: `add` only queues,
+    and `flush` takes an exclusive lock on FEED_DIR/.lock, reloads the
+    manifest if another writer changed it, then appends. Ids stay unique and
+    a videoUrl published by another process is not added twice.
+    """
+
+    def __init__(self, feed_dir: Path | None = None) -> None:
+        self.feed_dir = feed_dir or FEED_DIR
+        self.feed_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest: dict[str, Any] = {
+            "version": 1,
+            "pageSize": FEED_PAGE_SIZE,
+            "total": 0,
+            "nextId": 1,
+            "pages": [],
+            "indexes": {"creator": {}, "tag": {}},
+        }
+        self.existing_urls: set[str] = set()
+        self.added = 0
+        self._open_page: list[dict] = []
+        self._page_dirty = False
+        self._new_ids: dict[tuple[str, str], list[str]] = {}
+        self._new_urls: list[str] = []
+        self._queued: list[tuple[str, dict, str, dict | None]] = []
+        self._manifest_stamp: tuple[int, int] | None = None
+        self._urls_offset = 0
+        self._lock_fh = None
+        self._lock_depth = 0
+
+        with self._locked():
+            if (self.feed_dir / "manifest.json").exists():
+                self._reload()
+            elif FEED_FILE.exists():
+                self._import_legacy(json.loads(FEED_FILE.read_text()))
+
+    @property
+    def total(self) -> int:
+        return self.manifest["total"]
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._queued) or self._page_dirty
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive inter-process lock on the feed directory (re-entrant)."""
+        if self._lock_depth == 0:
+            self._lock_fh = open(self.feed_dir / ".lock", "a")
+            fcntl.flock(self._lock_fh, fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_fh, fcntl.LOCK_UN)
+                self._lock_fh.close()
+                self._lock_fh = None
+
+    def _stamp(self) -> tuple[int, int] | None:
+        try:
+            st = (self.feed_dir / "manifest.json").stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _reload(self) -> set[str]:
+        """Re-read state another writer may have changed; returns its new urls."""
+        self.manifest = json.loads((self.feed_dir / "manifest.json").read_text())
+        self._manifest_stamp = self._stamp()
+        fresh: set[str] = set()
+        urls_file = self.feed_dir / "urls.txt"
+        if urls_file.exists():
+            with open(urls_file, encoding="utf-8") as f:
+                f.seek(self._urls_offset)
+                fresh = set(f.read().splitlines())
+                self._urls_offset = f.tell()
+        self.existing_urls |= fresh
+        pages = self.manifest["pages"]
+        self._open_page = []
+        if pages and pages[-1]["count"] < self.manifest["pageSize"]:
+            self._open_page = json.loads((self.feed_dir / pages[-1]["file"]).read_text())
+        return fresh
+
+    def _import_legacy(self, feed: list[dict]) -> None:
+        for entry in feed:
+            self._append(entry)
+        self.manifest["nextId"] = max((int(v["id"]) for v in feed if v["id"].isdigit()), default=0) + 1
+        self.flush()
+        print(f"[feed] Imported {len(feed)} entries from {FEED_FILE.name} into {self.feed_dir}")
+
+    def add(self, path: str, meta: dict, r2_url: str, extra: dict | None = None) -> None:
+        """Queue a feed row; it is assigned an id and written on the next flush.
+
+        `extra` adds fields such as posterUrl/previewUrl to the row.
+        """
+        self._queued.append((path, meta, r2_url, extra))
+        self.existing_urls.add(r2_url)
+
+    def _add_queued(self, path: str, meta: dict, r2_url: str, extra: dict | None = None) -> None:
+        position = meta.get("position", "general")
+        account = meta.get("account", Path(path).parent.name)
+        likes = meta.get("favorite_count", 0)
+
+        feed_id = self.manifest["nextId"]
+        self.manifest["nextId"] = feed_id + 1
+        title = f"{position.replace('_', ' ').title()} - {account}"
+        if meta.get("variant"):
+            title += f" - Variant {meta['variant']}"
+        self._append({
+            "id": str(feed_id),
+            "videoUrl": r2_url,
+            **(extra or {}),
+            "title": title,
+            "creator": account,
+            "creatorAvatar": "\U0001f3ac",  # 🎬
+            "likes": likes,
+            "comments": 0,
+            "shares": 0,
+            "tags": ["ai", "wan2.2", position],
+        })
+        print(f"[feed] Added {_derive_video_key(path)} as id={feed_id}")
+        self.added += 1
+
+    def _append(self, entry: dict) -> None:
+        page_size = self.manifest["pageSize"]
+        pages = self.manifest["pages"]
+        if not pages or pages[-1]["count"] >= page_size:
+            if self._page_dirty:
+                self._write_open_page()
+            pages.append({"file": f"pages/page-{len(pages):05d}.json", "count": 0, "firstId": entry["id"]})
+            self._open_page = []
+        self._open_page.append(entry)
+        pages[-1]["count"] += 1
+        pages[-1]["lastId"] = entry["id"]
+        self.manifest["total"] += 1
+        self._page_dirty = True
+
+        self._new_ids.setdefault(("creator", entry["creator"]), []).append(entry["id"])
+        position = next((t for t in entry.get("tags", []) if t not in FEED_GENERIC_TAGS), None)
+        if position:
+            self._new_ids.setdefault(("tag", position), []).append(entry["id"])
+        self.existing_urls.add(entry["videoUrl"])
+        self._new_urls.append(entry["videoUrl"])
+
+    def _write_json(self, rel: str, data: Any) -> None:
+        target = self.feed_dir / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False))
+        tmp.replace(target)
+
+    def _write_open_page(self) -> None:
+        self._write_json(self.manifest["pages"][-1]["file"], self._open_page)
+        self._page_dirty = False
+
+    def flush(self) -> list[str]:
+        """Persist new entries; the manifest goes last so readers never see dangling pages.
+
+        Returns the paths of the queued rows that are now in the feed,
+        whether written here or already published by another process.
+        """
+        if not self._queued and not self._page_dirty and not self._new_ids:
+            return []
+        with self._locked():
+            if self._stamp() != self._manifest_stamp:
+                # Another process published since our last flush
+                published_elsewhere = self._reload()
+            else:
+                published_elsewhere = set()
+            for queued in self._queued:
+                if queued[2] not in published_elsewhere:
+                    self._add_queued(*queued)
+            flushed = [path for path, *_ in self._queued]
+            self._queued.clear()
+            self._write_pending()
+        return flushed
+
+    def _write_pending(self) -> None:
+        if self._page_dirty:
+            self._write_open_page()
+        superseded: list[Path] = []
+        for (kind, key), ids in self._new_ids.items():
+            index = self.manifest["indexes"][kind].setdefault(
+                key, {"file": f"index/{kind}/{re.sub(r'[^A-Za-z0-9_.-]', '_', key)}.jsonl", "count": 0, "bytes": 0},
+            )
+            superseded.extend(self._append_index(index, ids))
+        self._new_ids.clear()
+        with open(self.feed_dir / "urls.txt", "a", encoding="utf-8") as f:
+            f.writelines(url + "\n" for url in self._new_urls)
+            self._urls_offset = f.tell()
+        self._new_urls.clear()
+        self._write_json("manifest.json", self.manifest)
+        self._manifest_stamp = self._stamp()
+        for old_file in superseded:
+            old_file.unlink(missing_ok=True)
+
+    def _append_index(self, index: dict, ids: list[str]) -> list[Path]:
+        """Append `ids` to an index file and advance its manifest entry.
+
+        Returns the files it replaces, to delete once the manifest is written.
+        """
+        superseded: list[Path] = []
+        if not index["file"].endswith(".jsonl"):
+            # Written as one JSON list before indexes were append-only
+            old_file = self.feed_dir / index["file"]
+            ids = json.loads(old_file.read_text()) + ids
+            superseded.append(old_file)
+            index.update(file=index["file"] + "l", count=0, bytes=0)
+        index_file = self.feed_dir / index["file"]
+        index_file.parent.mkdir(parents=True, exist_ok=True)
+        lines = "".join(json.dumps(i) + "\n" for i in ids).encode()
+        with open(index_file, "ab") as f:
+            # Drop anything past what the manifest published (a flush that died midway)
+            f.truncate(index["bytes"])
+            f.write(lines)
+        index["bytes"] += len(lines)
+        index["count"] += len(ids)
+        return superseded
+
+    def export_legacy(self, target: Path | None = None) -> None:
+        """Write every page out as one flat feed-videos.json list."""
+        target = target or FEED_FILE
+        feed: list[dict] = []
+        for page in self.manifest["pages"]:
+            feed.extend(json.loads((self.feed_dir / page["file"]).read_text()))
+        tmp_file = target.with_suffix(".json.tmp")
+        tmp_file.write_text(json.dumps(feed, indent=2, ensure_ascii=False))
+        tmp_file.replace(target)
+
+
+# ---------------------------------------------------------------------------
+# Streaming pipeline: submit → poll → download → upload → feed
+#
+# Stages are joined by bounded queues and each runs its own worker pool, so a
+# video moves on as soon as its prediction completes instead of waiting for
+# the slowest job in the batch. `None` on a queue means "no more input".
+# ---------------------------------------------------------------------------
+async def _stage_workers(
+    in_q: asyncio.Queue,
+    out_q: asyncio.Queue | None,
+    concurrency: int,
+    worker,
+) -> None:
+    """Run `concurrency` copies of `worker` over `in_q`; forward non-None results."""
+
+    async def loop() -> None:
+        while True:
+            item = await in_q.get()
+            if item is None:
+                # Let sibling workers see the end marker too
+                in_q.put_nowait(None)
+                return
+            result = await worker(item)
+            if result is not None and out_q is not None:
+                await out_q.put(result)
+
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+    if out_q is not None:
+        await out_q.put(None)
+
+
+async def _feed_stage(
+    feed_q: asyncio.Queue,
+    feed: FeedWriter,
+    on_flushed: Callable[[list[str]], None] | None = None,
+) -> None:
+    """Single writer: append entries, flushing at most every FEED_FLUSH_INTERVAL.
+
+    `on_flushed` gets the paths each flush made durable.
+    """
+
+    def flush() -> None:
+        flushed = feed.flush()
+        if on_flushed is not None and flushed:
+            on_flushed(flushed)
+
+    last_flush = time.monotonic()
+    while True:
+        try:
+            timeout = FEED_FLUSH_INTERVAL if feed.dirty else None
+            item = await asyncio.wait_for(feed_q.get(), timeout)
+        except asyncio.TimeoutError:
+            flush()
+            last_flush = time.monotonic()
+            continue
+        if item is None:
+            break
+        feed.add(*item)
+        METRICS.inc("gv_feed_rows_total")
+        if time.monotonic() - last_flush >= FEED_FLUSH_INTERVAL:
+            flush()
+            last_flush = time.monotonic()
+    flush()
+
+
+@dataclass
+class RunOptions:
+    """Settings for one generation run, as given on the command line.
+
+    Defaults match the CLI's. `run` reads all of them; run_pipeline only
+    the ones that shape the stages (concurrency, pacing, budget, polling,
+    postprocessing, LoRA runs).
+    """
+
+    concurrency: int = 3
+    delay: float = 2.0
+    dry_run: bool = False
+    max_concurrency: int = AIMD_MAX_CONCURRENCY
+    poll_options: dict[str, Any] = field(default_factory=dict)  # PollScheduler keyword arguments
+    download_concurrency: int = DOWNLOAD_CONCURRENCY
+    upload_concurrency: int = UPLOAD_CONCURRENCY
+    r2_uploader: str = "auto"
+    encode_workers: int = ENCODE_WORKERS
+    max_image_side: int | None = None
+    legacy_feed: bool = False
+    metrics_port: int | None = None
+    metrics_interval: float = METRICS_INTERVAL
+    worker: str | None = None
+    lease_seconds: float = LEASE_SECONDS
+    api_key_env: str = "WAVESPEED_API_KEY"
+    input_file: Path | None = None
+    item_filter: Callable[[dict], bool] | None = None
+    priority: Callable[[dict], float] | None = None
+    priority_window: int = PRIORITY_WINDOW
+    budget: SubmissionBudget | None = None
+    webhook_port: int | None = None
+    webhook_url: str | None = None
+    webhook_host: str = WEBHOOK_HOST
+    stage_images: bool = False
+    presets_file: Path | None = None
+    vary: dict[str, list] | None = None
+    postprocess_workers: int = 0
+    poster_format: str = "jpg"
+    lora_runs: int = 0
+    lora_window: int = LORA_BATCH_WINDOW
+    dedup_workers: int = 0
+    dedup_threshold: int = DEDUP_THRESHOLD
+
+
+async def run_pipeline(
+    session: aiohttp.ClientSession,
+    progress: ProgressStore,
+    items: Iterable[dict],
+    headers: dict,
+    options: RunOptions,
+    uploader: R2Uploader | None = None,
+    encoder: ImageEncoder | None = None,
+    cache: GenerationCache | None = None,
+    claims: AsyncIterator[list[dict]] | None = None,
+    webhook: WebhookReceiver | None = None,
+    stager: ImageStager | None = None,
+    presets: PresetRegistry | None = None,
+) -> FeedWriter:
+    """Drive every pending, in-flight and unpublished item through all stages.
+
+    Concurrency, pacing, the budget and the optional stages come from
+    `options`; the rest of its fields are for `run`.
+
+    `items` is consumed lazily as submission capacity frees up, so only
+    in-flight jobs and whatever `items` itself buffers (the window of
+    prioritize) are held in memory. Uploads go through `uploader` when
+    given, else through wrangler. With `claims` (a LeaseStore's batches),
+    work comes from there instead of from `items` and `progress` at startup.
+    With a budget, submission stops once it is spent or its deadline is
+    too close; jobs already submitted are still finished and published.
+    With a `webhook`, completions are pushed and polling is only a fallback.
+    With a `stager`, images are submitted by URL instead of inline.
+    Requests come from `presets` (default PRESETS). With
+    postprocess_workers, downloaded videos go through postprocess_video
+    before upload, and their poster and preview URLs go into the feed.
+    Variants of one image (see PresetRegistry.expand) are held back from
+    the feed until all of them are settled, then appended together.
+    With lora_runs, pending jobs are reordered into runs of up to that
+    many sharing a LoRA set (see LoraBatcher, looking lora_window ahead).
+    Items marked "duplicate_of" (see dedup_items) are not submitted: once
+    their representative is in the feed they take over its video, and if
+    it fails they fail with it (to be retried with it next run).
+    """
+    GENERATED_DIR.mkdir(exist_ok=True)
+    feed = FeedWriter()
+
+    submit_q: asyncio.Queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+    download_q: asyncio.Queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+    upload_q: asyncio.Queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+    postprocess_q: asyncio.Queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+    feed_q: asyncio.Queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+
+    def r2_url_for(path: str) -> str:
+        # A cache hit may already point at another path's R2 copy
+        return progress[path].get("r2Url") or f"{R2_PUBLIC_URL}/{R2_PREFIX}/{_derive_video_key(path)}.mp4"
+
+    def needs_publish(path: str) -> bool:
+        entry = progress[path]
+        if options.dry_run or entry["status"] != "completed" or not entry.get("videoUrl"):
+            return False
+        return r2_url_for(path) not in feed.existing_urls
+
+    def renditions(path: str) -> dict[str, str]:
+        entry = progress[path]
+        return {field: entry[field] for field in ("posterUrl", "previewUrl") if entry.get(field)}
+
+    presets = presets or PRESETS
+    budget = options.budget
+    shared_images: dict[str, asyncio.Future] = {}
+    held: dict[str, dict[str, tuple]] = {}  # parent image -> rows of its variants ready for the feed
+    followers: dict[str, list[str]] = {}  # representative -> near-duplicates waiting for its result
+    feed_lock = asyncio.Lock()  # keeps a variant group's rows adjacent in the feed
+
+    async def publish_row(row: tuple) -> None:
+        path = row[0]
+        parent = path.partition("#")[0]
+        if parent == path:
+            async with feed_lock:
+                await feed_q.put(row)
+            return
+        held.setdefault(parent, {})[path] = row
+        await release_variants(parent, progress[path].get("meta", {}).get("position", "general"))
+
+    async def release_variants(parent: str, position: str, force: bool = False) -> None:
+        rows = held.get(parent, {})
+
+        def settled(path: str) -> bool:
+            entry = progress[path] if path in progress else {}
+            return path in rows or entry.get("status") == "failed" or bool(entry.get("published"))
+
+        siblings = [f"{parent}#{label}" for label in presets.variants_for(position)]
+        if not rows or not (force or all(settled(path) for path in siblings)):
+            return
+        del held[parent]
+        async with feed_lock:
+            for path in sorted(rows):
+                await feed_q.put(rows[path])
+
+    def mark_published(paths: list[str]) -> None:
+        now = time.time()
+        for path in paths:
+            progress.update(path, published=True, publishedAt=now)
+            link_duplicates(path)
+
+    def follow(path: str, rep: str) -> bool:
+        """Park `path` until `rep` settles; False if it should be submitted itself."""
+        entry = progress[rep] if rep in progress else None
+        if entry is None or entry["status"] == "failed":
+            return False
+        progress.update(path, duplicateOf=rep)
+        followers.setdefault(rep, []).append(path)
+        if entry["status"] == "completed" and (entry.get("published") or options.dry_run):
+            link_duplicates(rep)
+        return True
+
+    def link_duplicates(rep: str) -> None:
+        entry = progress[rep]
+        for path in followers.pop(rep, ()):
+            if entry["status"] == "failed":
+                progress.update(path, status="failed", error=f"Duplicate of {Path(rep).name}, which failed")
+                continue
+            progress.update(
+                path, status="completed", requestId=entry.get("requestId"), videoUrl=entry.get("videoUrl"),
+                r2Url=entry.get("r2Url"), published=bool(entry.get("published")), publishedAt=entry.get("publishedAt"),
+                error=None, **renditions(rep),
+            )
+            METRICS.inc("gv_dedup_linked_total")
+
+    async def publish(path: str) -> None:
+        if not needs_publish(path):
+            entry = progress[path]
+            if entry["status"] == "completed" and not entry.get("published") and r2_url_for(path) in feed.existing_urls:
+                # Published by an older run that did not record it
+                progress.update(path, r2Url=r2_url_for(path), published=True)
+            if entry["status"] == "failed" or entry.get("published") or options.dry_run:
+                link_duplicates(path)
+            return
+        if progress[path].get("r2Url"):
+            await publish_row((path, progress[path].get("meta", {}), progress[path]["r2Url"], renditions(path)))
+        else:
+            await download_q.put(path)
+
+    async def on_terminal(path: str) -> None:
+        entry = progress[path]
+        cache_key = entry.get("cacheKey")
+        if cache is not None and cache_key:
+            if entry["status"] == "completed" and entry.get("videoUrl"):
+                cache.record(cache_key, videoUrl=entry["videoUrl"])
+            elif entry["status"] == "failed":
+                cache.forget(cache_key)
+        if entry["status"] == "failed" and "#" in path:
+            # Its siblings may have been waiting on this one
+            await release_variants(path.partition("#")[0], entry.get("meta", {}).get("position", "general"))
+        await publish(path)
+
+    scheduler = PollScheduler(
+        session, progress, headers, on_terminal=on_terminal,
+        fallback_interval=WEBHOOK_FALLBACK_POLL if webhook else None, **options.poll_options,
+    )
+    if webhook is not None:
+        webhook.handler = scheduler.deliver
+
+    # Jobs submitted by a previous run go straight back into the poll heap
+    resumed = list(progress.paths("submitted"))
+    if resumed:
+        print(f"Resuming: re-polling {len(resumed)} previously submitted items...")
+        for path in resumed:
+            scheduler.add(path)
+
+    # `concurrency` is the starting point; the limiter adapts between 1 and
+    # max_concurrency, so enough workers exist to use the whole range.
+    limiter = AdaptiveLimiter(options.concurrency, maximum=options.max_concurrency)
+
+    unsubmitted = 0  # claimed jobs not through submit_one yet
+    submit_done = asyncio.Event()
+    last_lora: str | None = None  # LoRA set of the latest submission
+
+    def lora_key(item: dict) -> str:
+        return presets.get(item.get("position", "general"), item.get("variant")).lora_key
+
+    batcher = LoraBatcher(lora_key, options.lora_runs, options.lora_window) if options.lora_runs else None
+    if batcher is not None:
+        print(f"[lora] Grouping submissions into runs of up to {options.lora_runs} per LoRA set (window {batcher.window})")
+    generation_seconds = ("gv_generation_seconds", _series("gv_generation_seconds", {}))
+
+    def expected_generation() -> float | None:
+        # Be pessimistic about the deadline: p90 once there is a sample, else the EMA
+        hist = METRICS.histograms.get(generation_seconds)
+        if hist is not None and hist.count >= 5:
+            return hist.quantile(0.9)
+        return scheduler.expected_seconds
+
+    async def feed_submissions() -> None:
+        nonlocal unsubmitted
+        queued = 0
+
+        async def enqueue(item: dict) -> None:
+            nonlocal queued, unsubmitted
+            for ready in batcher.add(item) if batcher is not None else [item]:
+                queued += 1
+                unsubmitted += 1
+                await submit_q.put(ready)
+
+        async def flush_runs() -> None:
+            nonlocal queued, unsubmitted
+            for ready in batcher.drain() if batcher is not None else []:
+                queued += 1
+                unsubmitted += 1
+                await submit_q.put(ready)
+
+        if claims is not None:
+            async for batch in claims:
+                if budget is not None and budget.stopped:
+                    break  # unclaimed and unsubmitted jobs go back when the store closes
+                for item in batch:
+                    path = item["path"]
+                    if "meta" not in progress[path]:
+                        progress.update(path, meta=_item_meta(item))
+                    status = progress[path]["status"]
+                    if status == "pending":
+                        await enqueue(item)
+                    elif status == "submitted":
+                        # Reclaimed from a worker that stopped mid-generation
+                        scheduler.add(path)
+                    else:
+                        await publish(path)
+                await flush_runs()
+                # Claim more only once the limiter can take them, so other
+                # workers are not starved by jobs queued here
+                while unsubmitted >= max(1, int(limiter.limit)):
+                    submit_done.clear()
+                    await submit_done.wait()
+            await submit_q.put(None)
+            return
+        print(f"Submitting pending items (concurrency={options.concurrency}..{limiter.maximum}, delay={options.delay}s)...")
+        # Parse and filter off the loop, a batch at a time
+        reader = iter(items)
+        while batch := await asyncio.to_thread(list, itertools.islice(reader, MANIFEST_BATCH)):
+            if budget is not None and budget.stopped:
+                break  # the rest stays pending for a later run
+            for item in batch:
+                path = item["path"]
+                if path not in progress:
+                    progress.update(
+                        path, status="pending", requestId=None, videoUrl=None, error=None, meta=_item_meta(item),
+                        **{k: item[k] for k in ("parent", "variant") if k in item},
+                    )
+                elif progress[path]["status"] != "pending":
+                    continue  # in flight, done, or a duplicate manifest line
+                elif "meta" not in progress[path]:
+                    progress.update(path, meta=_item_meta(item))
+                rep = item.get("duplicate_of")
+                if rep is not None and follow(path, f"{rep}#{item['variant']}" if "variant" in item else rep):
+                    continue
+                await enqueue(item)
+        else:
+            await flush_runs()  # a stopped budget leaves the buffered runs pending
+        print(f"Queued {queued} pending items")
+        await submit_q.put(None)
+
+    async def submit_worker(item: dict) -> None:
+        nonlocal unsubmitted, last_lora
+        seconds = presets.get(item.get("position", "general"), item.get("variant")).duration
+        reservation = budget.reserve(seconds, expected_generation()) if budget is not None else None
+        if budget is not None and reservation is None:
+            unsubmitted -= 1
+            submit_done.set()
+            return
+        # Whether the provider just loaded this LoRA set, for gv_lora_generation_seconds
+        group = lora_key(item)
+        run = "same" if group == last_lora else "switch"
+        last_lora = group
+        charged = await submit_one(
+            session, item, progress, headers, options.delay, options.dry_run, limiter, encoder, cache,
+            webhook.url if webhook else None, stager, presets, shared_images,
+        )
+        if budget is not None:
+            budget.settle(reservation, item["path"], seconds, charged)
+        unsubmitted -= 1
+        submit_done.set()
+        status = progress[item["path"]]["status"]
+        if status == "submitted":
+            progress.update(item["path"], loraGroup=group, loraRun=run)
+            scheduler.add(item["path"])
+        elif status == "completed":
+            # Cache hit on a finished generation
+            await publish(item["path"])
+
+    async def submit_stage() -> None:
+        await _stage_workers(submit_q, None, limiter.maximum, submit_worker)
+        scheduler.close()
+
+    async def poll_and_backfill() -> None:
+        # Completed by an earlier run but never made it into the feed
+        for path in list(progress.unpublished()):
+            await publish(path)
+        await scheduler.run()
+        await download_q.put(None)
+
+    async def download_worker(path: str) -> tuple[str, Path, dict[str, Path]] | None:
+        started = time.monotonic()
+        local_file = await download_video(session, _derive_video_key(path), progress[path]["videoUrl"])
+        if not local_file:
+            progress.update(path, error="Download failed")
+            return None
+        progress.update(path, downloadedAt=time.time(), downloadSeconds=round(time.monotonic() - started, 3))
+        return (path, local_file, {})
+
+    async def postprocess_worker(job: tuple[str, Path, dict[str, Path]]) -> tuple[str, Path, dict[str, Path]]:
+        path, local_file, _ = job
+        video, rendered = await postprocess_video(_derive_video_key(path), local_file, options.poster_format)
+        return (path, video, rendered)
+
+    async def upload(local_file: Path, key: str, content_type: str) -> bool:
+        with METRICS.track("upload"):
+            if uploader is not None:
+                uploaded = await uploader.upload_file(local_file, key, content_type)
+            else:
+                uploaded = await asyncio.to_thread(upload_to_r2, local_file, "", key, content_type)
+        METRICS.inc("gv_upload_total", result="ok" if uploaded else "error")
+        if uploaded:
+            METRICS.inc("gv_upload_bytes_total", local_file.stat().st_size)
+        return uploaded
+
+    async def upload_worker(job: tuple[str, Path, dict[str, Path]]) -> None:
+        path, local_file, rendered = job
+        video_key = _derive_video_key(path)
+        started = time.monotonic()
+        if not await upload(local_file, f"{R2_PREFIX}/{video_key}.mp4", "video/mp4"):
+            progress.update(path, error="R2 upload failed")
+            return
+        r2_url = f"{R2_PUBLIC_URL}/{R2_PREFIX}/{video_key}.mp4"
+        timing = {"uploadedAt": time.time(), "uploadSeconds": round(time.monotonic() - started, 3)}
+        urls = {}
+        for name, field, prefix in (("poster", "posterUrl", R2_POSTER_PREFIX), ("preview", "previewUrl", R2_PREVIEW_PREFIX)):
+            if name not in rendered:
+                continue
+            # Optional extras: a failed upload leaves the row without them
+            file = rendered[name]
+            key = f"{prefix}/{video_key}{file.suffix}"
+            content_type = IMAGE_MIME_TYPES.get(file.suffix, "video/mp4")
+            if await upload(file, key, content_type):
+                urls[field] = f"{R2_PUBLIC_URL}/{key}"
+        progress.update(path, r2Url=r2_url, error=None, **timing, **urls)
+        if cache is not None and progress[path].get("cacheKey"):
+            cache.record(progress[path]["cacheKey"], r2Url=r2_url)
+        await publish_row((path, progress[path].get("meta", {}), r2_url, renditions(path)))
+
+    async def upload_stage() -> None:
+        await _stage_workers(upload_q, None, options.upload_concurrency, upload_worker)
+        # Groups still waiting on a sibling that failed to download or upload go out as they are
+        for parent in list(held):
+            await release_variants(parent, "general", force=True)
+        await feed_q.put(None)
+
+    def collect(metrics: Metrics) -> None:
+        for name, q in (
+            ("submit", submit_q), ("download", download_q), ("postprocess", postprocess_q),
+            ("upload", upload_q), ("feed", feed_q),
+        ):
+            metrics.set_gauge("gv_queue_depth", q.qsize(), queue=name)
+        metrics.set_gauge("gv_poll_scheduled", scheduler.scheduled)
+        metrics.set_gauge("gv_submit_limit", int(limiter.limit))
+        metrics.set_gauge("gv_submit_inflight", limiter.in_flight)
+        if scheduler.expected_seconds is not None:
+            metrics.set_gauge("gv_expected_generation_seconds", round(scheduler.expected_seconds, 3))
+        if budget is not None:
+            metrics.set_gauge("gv_budget_spent_seconds", budget.spent_seconds, scope="run")
+            metrics.set_gauge("gv_budget_spent_seconds", budget.day_spent_seconds, scope="day")
+            metrics.set_gauge("gv_budget_stopped", int(budget.stopped is not None))
+
+    METRICS.add_collector(collect)
+    try:
+        await asyncio.gather(
+            feed_submissions(),
+            submit_stage(),
+            poll_and_backfill(),
+            _stage_workers(download_q, postprocess_q if options.postprocess_workers else upload_q,
+                           options.download_concurrency, download_worker),
+            _stage_workers(postprocess_q, upload_q, options.postprocess_workers, postprocess_worker)
+            if options.postprocess_workers else asyncio.sleep(0),
+            upload_stage(),
+            _feed_stage(feed_q, feed, mark_published),
+        )
+    finally:
+        collect(METRICS)  # leave final values behind for the last snapshot
+        METRICS.remove_collector(collect)
+    return feed
+
+
+def load_presets(presets_file: Path | None = None, vary: dict[str, list] | None = None) -> PresetRegistry:
+    """PRESETS, or the registry built from `presets_file` and `vary`; exits on a bad one."""
+    if presets_file is None and not vary:
+        return PRESETS
+    try:
+        presets = (
+            PresetRegistry.from_file(presets_file, vary) if presets_file is not None
+            else PresetRegistry.builtin(vary=vary)
+        )
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Bad presets {presets_file or '--vary'}: {e}")
+        sys.exit(1)
+    if presets_file is not None:
+        changed = sorted(p for p, fp in presets.fingerprints().items() if PRESETS.fingerprints().get(p) != fp)
+        print(f"[presets] {presets_file.name}: {len(presets.templates)} positions, changed: {', '.join(changed) or 'none'}")
+    for position, settings in presets.variant_settings.items():
+        print(f"[variants] {position}: " + "  ".join(f"{label}: {desc}" for label, desc in settings.items()))
+    return presets
+
+
+async def run(options: RunOptions) -> None:
+    """Main async entry point; see RunOptions for the settings.
+
+    The manifest (`input_file`, default INPUT_FILE) is streamed and
+    `item_filter` applied on the way. With `priority`, items are submitted
+    highest score first (see prioritize); `budget` caps what is submitted.
+    With `worker`, runs as one of several coordinated workers: jobs are
+    claimed from the shared LeaseStore instead of owning the progress file.
+    With `webhook_port`, completions arrive at a local WebhookReceiver
+    (reachable at `webhook_url`) and jobs are polled only as a fallback.
+    With `stage_images`, images are uploaded to R2 once and submitted by URL.
+    `presets_file` overrides the built-in per-position presets, and `vary`
+    adds a variant matrix to every position. With `postprocess_workers`,
+    videos are made fast-start and get a poster and preview (needs ffmpeg).
+    `lora_runs` groups submissions by LoRA set (see LoraBatcher). With
+    `dedup_workers`, images are perceptually hashed by that many processes
+    and only one per near-duplicate cluster (`dedup_threshold` bits) is
+    submitted; the rest reuse its video (see dedup_items).
+    """
+    api_key = load_api_key(options.api_key_env)
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+
+    if options.postprocess_workers and not options.dry_run and shutil.which("ffmpeg") is None:
+        print("ERROR: --postprocess needs ffmpeg on PATH")
+        sys.exit(1)
+    if options.dedup_workers and options.worker:
+        # Duplicates wait on their representative, which another worker may hold
+        print("ERROR: --dedup needs a single-process run (no --workers/--worker)")
+        sys.exit(1)
+
+    presets = load_presets(options.presets_file, options.vary)
+
+    # Input is streamed; nothing is read until the pipeline asks for items
+    input_file = options.input_file or INPUT_FILE
+    if not input_file.exists():
+        print(f"ERROR: Input file not found: {input_file}")
+        sys.exit(1)
+    reader = ManifestReader(input_file, options.item_filter)
+    print(f"Streaming items from {input_file.name}{' (filtered)' if options.item_filter else ''}")
+    items: Iterable[dict] = reader
+    if options.priority is not None:
+        items = prioritize(reader, options.priority, options.priority_window)
+        print(f"[priority] Submitting highest score first (window: {options.priority_window or 'all'})")
+    phashes = None
+    if options.dedup_workers:
+        # After ranking, so each cluster is represented by its top-priority image
+        phashes = PerceptualIndex(options.dedup_workers).load()
+        items = dedup_items(items, phashes, options.dedup_threshold)
+        print(f"[dedup] Submitting one image per near-duplicate cluster (within {options.dedup_threshold} bits)")
+    if presets.variants:
+        # After ranking, so an image's variants stay back to back
+        items = presets.expand(items)
+
+    # Load progress; new items get their entry when they are first queued
+    metrics_file = METRICS_FILE
+    if options.worker:
+        # Claims follow seed order, so every worker shares the same priorities
+        progress = LeaseStore(options.worker, lease_seconds=options.lease_seconds).seed(items)
+        print(f"Seeded {reader.selected} of {reader.scanned} items")
+        metrics_file = METRICS_FILE.with_name(f"{METRICS_FILE.stem}.{options.worker}{METRICS_FILE.suffix}")
+        print(f"[lease] Worker {options.worker} sharing {LEASE_DB.name} (lease {options.lease_seconds:g}s)")
+    else:
+        progress = ProgressStore().load()
+        # Reset failed items to pending so they get retried
+        for path in list(progress.paths("failed")):
+            progress.update(path, status="pending", error=None)
+        # Entries from runs that did not record feed metadata: fill in the
+        # ones still to be published with one pass over the manifest
+        fill_missing_meta(progress, input_file, {
+            path for path in progress.paths("submitted") | progress.unpublished() if "meta" not in progress[path]
+        })
+    print_stats(progress)
+
+    uploader = None
+    if options.r2_uploader != "wrangler" and not options.dry_run:
+        uploader = R2Uploader.from_env(options.upload_concurrency)
+        if uploader is None and options.r2_uploader == "s3":
+            print("ERROR: --r2-uploader s3 needs R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY and R2_ENDPOINT/R2_ACCOUNT_ID")
+            sys.exit(1)
+        print(f"R2 uploads via {'S3 API' if uploader else 'wrangler'}")
+    encoder = ImageEncoder(options.encode_workers, options.max_image_side)
+    # Other workers append to the same cache file, so only a lone run compacts it
+    cache = GenerationCache().load(compact=not options.worker)
+    stager = None
+    if options.stage_images and not options.dry_run:
+        staging_uploader = uploader or R2Uploader.from_env(options.upload_concurrency)
+        if staging_uploader is None:
+            print("ERROR: --stage-images needs R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY and R2_ENDPOINT/R2_ACCOUNT_ID")
+            sys.exit(1)
+        stager = ImageStager(staging_uploader, encoder).load(compact=not options.worker)
+        print(f"[stage] Submitting images by URL from {R2_PUBLIC_URL}/{R2_IMAGE_PREFIX}")
+
+    def collect_jobs(metrics: Metrics) -> None:
+        for status, n in progress.counts.items():
+            metrics.set_gauge("gv_jobs", n, status=status)
+
+    METRICS.add_collector(collect_jobs)
+    metrics_server = await start_metrics_server(options.metrics_port) if options.metrics_port else None
+    webhook = None
+    if options.webhook_port and not options.dry_run:
+        webhook = await WebhookReceiver(options.webhook_port, options.webhook_host, options.webhook_url).start()
+    snapshots = (
+        asyncio.create_task(write_metrics_snapshots(metrics_file, options.metrics_interval))
+        if options.metrics_interval > 0 else None
+    )
+    leases = asyncio.create_task(progress.keep_alive()) if options.worker else None
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            feed = await run_pipeline(
+                session, progress, () if options.worker else items, headers, options,
+                uploader=uploader, encoder=encoder, cache=cache,
+                claims=progress.claims() if options.worker else None,
+                webhook=webhook, stager=stager, presets=presets,
+            )
+    finally:
+        if leases is not None:
+            leases.cancel()
+            await asyncio.gather(leases, return_exceptions=True)
+        if snapshots is not None:
+            snapshots.cancel()
+            await asyncio.gather(snapshots, return_exceptions=True)
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        if webhook is not None:
+            await webhook.close()
+        METRICS.remove_collector(collect_jobs)
+        encoder.close()
+        cache.close()
+        if phashes is not None:
+            phashes.close()
+        if stager is not None:
+            stager.close()
+            if stager.uploader is not uploader:
+                await stager.uploader.close()
+        if uploader is not None:
+            await uploader.close()
+        # Fold the journal (or lease table) into the snapshot so the JSON file is current
+        progress.close()
+
+    # Final stats
+    print("\n=== FINAL RESULTS ===")
+    print_stats(progress)
+    failed = progress.counts["failed"]
+    if failed:
+        print(f"\n{failed} items failed. Re-run to retry them.")
+    if not options.worker:
+        print(f"Selected {reader.selected} of {reader.scanned} manifest items")
+    print(f"Progress saved to {PROGRESS_FILE}")
+    if options.budget is not None:
+        print(options.budget.summary())
+        if options.budget.stopped:
+            print(f"[budget] Stopped early ({options.budget.stopped}); re-run to continue")
+    print_lora_report(presets)
+    if snapshots is not None:
+        print(f"[metrics] Snapshots in {metrics_file}")
+
+    if feed.added:
+        print(f"[feed] Updated {FEED_DIR}: added {feed.added} videos (total: {feed.total})")
+        if options.legacy_feed:
+            feed.export_legacy()
+            print(f"[feed] Exported {FEED_FILE.name}")
+
+        # Also copy classified data to src for admin page (not a custom --input corpus)
+        if input_file.resolve() == INPUT_FILE.resolve():
+            CLASSIFIED_SRC.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(INPUT_FILE, CLASSIFIED_SRC)
+            print(f"[sync] Copied classified data to {CLASSIFIED_SRC}")
+    elif not options.dry_run:
+        print("[feed] No new videos to add.")
+
+
+# ---------------------------------------------------------------------------
+# Reconciliation: progress ↔ generated_videos/ ↔ R2 ↔ feed
+#
+# Each source is read once (R2 with one list call per R2_LIST_PAGE keys) and
+# the four are joined on the video key, so checking a large library costs a
+# few list calls instead of a HEAD or upload per video.
+# ---------------------------------------------------------------------------
+DRIFT_KINDS = ("stale", "missing_upload", "missing_feed", "orphan_remote", "orphan_local")
+
+
+def _r2_object_key(url: str) -> str | None:
+    """R2 key behind a public URL, or None if the URL is not ours."""
+    prefix = f"{R2_PUBLIC_URL}/"
+    return url[len(prefix):] if url.startswith(prefix) else None
+
+
+def _local_videos() -> dict[str, Path]:
+    """Finished videos in GENERATED_DIR by video key (no .part files or renditions).
+
+    A key maps to its fast-start remux when there is one, as that is what gets uploaded.
+    """
+    if not GENERATED_DIR.exists():
+        return {}
+    videos: dict[str, Path] = {}
+    for f in GENERATED_DIR.iterdir():
+        if f.name.endswith(".mp4") and not f.name.endswith((".preview.mp4", ".faststart.mp4", ".tmp.mp4")):
+            key = f.name[:-len(".mp4")]
+            faststart = _faststart_file(key)
+            videos[key] = faststart if faststart.exists() else f
+    return videos
+
+
+def find_drift(
+    progress: ProgressStore,
+    feed_urls: set[str],
+    local: dict[str, Path],
+    remote: dict[str, int],
+    stale_before: float,
+) -> dict[str, list[str]]:
+    """Join progress, feed URLs, local videos and R2 keys; list what disagrees.
+
+    By kind (see DRIFT_KINDS):
+      stale           paths still `submitted` from before `stale_before`, or without a requestId
+      missing_upload  completed paths whose R2 object does not exist
+      missing_feed    completed paths in R2 but not in the feed
+      orphan_remote   R2 keys under R2_PREFIX that no entry or feed row refers to
+      orphan_local    local video keys with no progress entry
+    """
+    drift: dict[str, list[str]] = {kind: [] for kind in DRIFT_KINDS}
+    referenced = {_r2_object_key(url) for url in feed_urls}
+    owned: set[str] = set()
+    for path, entry in progress.items():
+        video_key = _derive_video_key(path)
+        owned.add(video_key)
+        r2_url = entry.get("r2Url") or f"{R2_PUBLIC_URL}/{R2_PREFIX}/{video_key}.mp4"
+        object_key = _r2_object_key(r2_url)
+        referenced.add(object_key)
+        status = entry.get("status", "pending")
+        if status == "submitted":
+            if not entry.get("requestId") or (entry.get("submittedAt") or 0) < stale_before:
+                drift["stale"].append(path)
+        elif status == "completed" and entry.get("videoUrl") and object_key is not None:
+            if object_key not in remote:
+                drift["missing_upload"].append(path)
+            elif r2_url not in feed_urls:
+                drift["missing_feed"].append(path)
+    drift["orphan_remote"] = sorted(key for key in remote if key not in referenced)
+    drift["orphan_local"] = sorted(key for key in local if key not in owned)
+    return drift
+
+
+async def repair_drift(
+    drift: dict[str, list[str]],
+    progress: ProgressStore,
+    feed: FeedWriter,
+    uploader: R2Uploader,
+    local: dict[str, Path],
+    headers: dict | None,
+    input_file: Path,
+    delete_orphans: bool = False,
+) -> Counter:
+    """Fix what find_drift found, in dependency order. Returns fixes by kind.
+
+    Stale jobs are polled once: finished ones are recorded (and flow on into
+    upload and feed), ones the provider no longer knows go back to pending.
+    Missing uploads come from the local file, or are downloaded again first.
+    Missing feed rows are appended. Orphans are deleted only with
+    `delete_orphans`; without `headers` stale jobs are left alone.
+    """
+    fixed: Counter = Counter()
+    missing_upload = list(drift["missing_upload"])
+
+    async with aiohttp.ClientSession() as session:
+        async def check_stale(path: str, semaphore: asyncio.Semaphore) -> None:
+            request_id = progress[path].get("requestId")
+            data: dict = {}
+            if request_id:
+                try:
+                    async with semaphore, session.get(RESULT_URL.format(request_id=request_id), headers=headers) as resp:
+                        if resp.status == 200:
+                            data = (await resp.json()).get("data", {})
+                        elif resp.status != 404:
+                            print(f"[warn] Poll HTTP {resp.status} for {Path(path).name}; left as submitted")
+                            return
+                except aiohttp.ClientError as e:
+                    print(f"[warn] Poll error for {Path(path).name}: {e}; left as submitted")
+                    return
+            if record_result(path, progress, data):
+                fixed["stale"] += 1
+                if progress[path]["status"] == "completed" and progress[path].get("videoUrl"):
+                    missing_upload.append(path)
+            elif not data:
+                progress.update(path, status="pending", requestId=None, submittedAt=None, error=None)
+                print(f"[reconcile] {Path(path).name}: unknown to the provider, back to pending")
+                fixed["stale"] += 1
+
+        async def restore_upload(path: str, semaphore: asyncio.Semaphore) -> None:
+            entry = progress[path]
+            r2_url = entry.get("r2Url") or f"{R2_PUBLIC_URL}/{R2_PREFIX}/{_derive_video_key(path)}.mp4"
+            object_key = _r2_object_key(r2_url)
+            video_key = Path(object_key).name[:-len(".mp4")]
+            async with semaphore:
+                local_file = local.get(video_key) or await download_video(session, video_key, entry["videoUrl"])
+                if local_file is None or not await uploader.upload_file(local_file, object_key):
+                    print(f"[warn] Could not restore {object_key}")
+                    return
+            progress.update(path, r2Url=r2_url, error=None)
+            fixed["missing_upload"] += 1
+
+        if headers is not None and drift["stale"]:
+            semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+            await asyncio.gather(*(check_stale(path, semaphore) for path in drift["stale"]))
+        if missing_upload:
+            GENERATED_DIR.mkdir(exist_ok=True)
+            semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+            await asyncio.gather(*(restore_upload(path, semaphore) for path in missing_upload))
+
+    # Everything completed and in R2 by now, including what was just restored
+    unpublished = [
+        path for path in dict.fromkeys(drift["missing_feed"] + missing_upload)
+        if progress[path].get("r2Url") and progress[path]["r2Url"] not in feed.existing_urls
+    ]
+    fill_missing_meta(progress, input_file, {path for path in unpublished if "meta" not in progress[path]})
+    for path in unpublished:
+        entry = progress[path]
+        extra = {field: entry[field] for field in ("posterUrl", "previewUrl") if entry.get(field)}
+        feed.add(path, entry.get("meta", {}), entry["r2Url"], extra)
+    for path in feed.flush():
+        progress.update(path, published=True)
+        fixed["missing_feed"] += 1
+
+    if delete_orphans:
+        for video_key in drift["orphan_local"]:
+            (GENERATED_DIR / f"{video_key}.mp4").unlink(missing_ok=True)
+            _faststart_file(video_key).unlink(missing_ok=True)
+            fixed["orphan_local"] += 1
+        for key in drift["orphan_remote"]:
+            if await uploader.delete_object(key):
+                fixed["orphan_remote"] += 1
+    return fixed
+
+
+async def reconcile(
+    repair: bool = False,
+    delete_orphans: bool = False,
+    stale_hours: float = RECONCILE_STALE_HOURS,
+    report_file: Path | None = None,
+    api_key_env: str = "WAVESPEED_API_KEY",
+    input_file: Path | None = None,
+) -> dict[str, list[str]]:
+    """`reconcile` command: report drift between progress, local files, R2 and the feed.
+
+    With `repair` (and/or `delete_orphans`) it is fixed too, see repair_drift.
+    `report_file` gets every finding as JSON. Run it while no generator is
+    writing the same progress file.
+    """
+    uploader = R2Uploader.from_env()
+    if uploader is None:
+        print("ERROR: reconcile lists R2 through the S3 API; it needs R2_ACCESS_KEY_ID, "
+              "R2_SECRET_ACCESS_KEY and R2_ENDPOINT/R2_ACCOUNT_ID")
+        sys.exit(1)
+    progress = ProgressStore().load()
+    feed = FeedWriter()
+    try:
+        remote = await uploader.list_objects(f"{R2_PREFIX}/")
+        local = _local_videos()
+        drift = find_drift(progress, feed.existing_urls, local, remote, time.time() - stale_hours * 3600)
+        print(
+            f"[reconcile] {len(progress)} entries, {len(local)} local videos, "
+            f"{len(remote)} R2 objects, {feed.total} feed rows"
+        )
+        for kind, found in drift.items():
+            print(f"[reconcile] {kind}: {len(found)}")
+            for name in found[:10]:
+                print(f"    {Path(name).name}")
+            if len(found) > 10:
+                print(f"    ... and {len(found) - 10} more")
+        if report_file is not None:
+            report_file.write_text(json.dumps(drift, indent=2))
+            print(f"[reconcile] Report written to {report_file}")
+
+        if repair or delete_orphans:
+            if not repair:
+                drift = {kind: (found if kind.startswith("orphan_") else []) for kind, found in drift.items()}
+            headers = None
+            if drift["stale"]:
+                headers = {"Authorization": f"Bearer {load_api_key(api_key_env)}"}
+            fixed = await repair_drift(
+                drift, progress, feed, uploader, local, headers, input_file or INPUT_FILE, delete_orphans,
+            )
+            print("[reconcile] Repaired: " + (
+                ", ".join(f"{kind}={fixed[kind]}" for kind in DRIFT_KINDS if fixed[kind]) or "nothing"
+            ))
+    finally:
+        await uploader.close()
+        progress.close()
+    return drift
+
+
+# ---------------------------------------------------------------------------
+# Capacity planning: `plan`
+#
+# Jobs recorded by earlier runs are fitted to a small model (lognormal stage
+# times, a throttle rate per concurrency level, a failure rate), then a
+# discrete-event simulation replays the manifest's outstanding jobs through
+# the same submit/poll/download/upload scheduling under candidate settings.
+# ---------------------------------------------------------------------------
+class TimingModel(NamedTuple):
+    """Per-job timing distributions fitted to recorded progress entries."""
+
+    stages: dict[str, tuple[float, float]]  # stage -> (mu, sigma) of log seconds
+    samples: dict[str, int]  # stage -> jobs it was fitted to (0: PLAN_DEFAULT_SECONDS)
+    throttle_rates: dict[int, float]  # concurrency limit -> P(429/5xx) per submit attempt
+    fail_rate: float
+
+    @classmethod
+    def fit(cls, entries: Iterable[dict]) -> "TimingModel":
+        durations: dict[str, list[float]] = {stage: [] for stage in PLAN_DEFAULT_SECONDS}
+        attempts: Counter = Counter()
+        throttles: Counter = Counter()
+        finished = failed = 0
+        for entry in entries:
+            if entry.get("submitSeconds") is not None:
+                durations["submit"].append(entry["submitSeconds"])
+                attempts[entry.get("submitLimit", 0)] += entry.get("submitAttempts", 1)
+                throttles[entry.get("submitLimit", 0)] += entry.get("throttles", 0)
+            if entry.get("finishedAt") is not None:
+                finished += 1
+                # Failed jobs are reset to pending on the next run, so go by the outcome
+                if entry.get("status") == "completed" and entry.get("videoUrl"):
+                    if entry.get("submittedAt") is not None:
+                        durations["generation"].append(entry["finishedAt"] - entry["submittedAt"])
+                else:
+                    failed += 1
+            for stage in ("download", "upload"):
+                if entry.get(f"{stage}Seconds") is not None:
+                    durations[stage].append(entry[f"{stage}Seconds"])
+
+        stages = {}
+        for stage, values in durations.items():
+            logs = [math.log(max(v, 1e-3)) for v in values] or [math.log(PLAN_DEFAULT_SECONDS[stage])]
+            mu = sum(logs) / len(logs)
+            stages[stage] = (mu, math.sqrt(sum((x - mu) ** 2 for x in logs) / len(logs)))
+        return cls(
+            stages,
+            {stage: len(values) for stage, values in durations.items()},
+            {limit: throttles[limit] / n for limit, n in attempts.items() if n},
+            failed / finished if finished else 0.0,
+        )
+
+    def sample(self, stage: str, rng: random.Random) -> float:
+        mu, sigma = self.stages[stage]
+        return rng.lognormvariate(mu, sigma)
+
+    def throttle_rate(self, limit: int) -> float:
+        """Observed rate at the nearest recorded concurrency level (the higher one on ties)."""
+        if not self.throttle_rates:
+            return 0.0
+        return self.throttle_rates[min(self.throttle_rates, key=lambda level: (abs(level - limit), -level))]
+
+    def describe(self) -> list[str]:
+        lines = []
+        for stage, (mu, sigma) in self.stages.items():
+            source = f"{self.samples[stage]} jobs" if self.samples[stage] else "no history, assumed"
+            lines.append(
+                f"  {stage:<10} median {math.exp(mu):7.1f}s  p90 {math.exp(mu + 1.2816 * sigma):7.1f}s  ({source})"
+            )
+        rates = ", ".join(f"{limit}: {rate:.1%}" for limit, rate in sorted(self.throttle_rates.items()))
+        lines.append(f"  throttled  {rates or 'none recorded'} (by concurrency)")
+        lines.append(f"  failed     {self.fail_rate:.1%}")
+        return lines
+
+
+def simulate_run(
+    jobs: int,
+    model: TimingModel,
+    concurrency: int,
+    delay: float,
+    max_concurrency: int = AIMD_MAX_CONCURRENCY,
+    poll_options: dict[str, Any] | None = None,
+    download_concurrency: int = DOWNLOAD_CONCURRENCY,
+    upload_concurrency: int = UPLOAD_CONCURRENCY,
+    rng: random.Random | None = None,
+    durations: Sequence[int] | None = None,
+) -> dict[str, float]:
+    """Discrete-event simulation of one run submitting `jobs` new jobs.
+
+    Mirrors run_pipeline: max_concurrency submit workers share an AIMD limit
+    starting at `concurrency` (AdaptiveLimiter's rules), hold their slot for
+    `delay` after an accepted submit and back off with the slot released
+    after a throttle; PollScheduler's EMA-based first poll and backoff find
+    each result; downloads and uploads queue for their own pools. Job i
+    generates `durations[i]` seconds of video (default VIDEO_DURATION each).
+    Returns the makespan, call counts and "billed_seconds".
+    """
+    rng = rng or random.Random()
+    poll = {"min_interval": POLL_MIN_INTERVAL, "max_interval": POLL_MAX_INTERVAL, "jitter": POLL_JITTER}
+    poll.update({k: v for k, v in (poll_options or {}).items() if k in poll})
+    events: list[tuple[float, int, str, int]] = []
+    seq = itertools.count()
+    counts: Counter = Counter()
+    maximum = max(max_concurrency, concurrency)
+    limit = float(concurrency)
+    last_cut = -AIMD_COOLDOWN
+    in_flight = 0
+    waiting: list[int] = []  # jobs waiting for a submit slot, FIFO via `head`
+    head = 0
+    next_job = 0
+    attempts = [0] * jobs
+    submitted_at = [0.0] * jobs
+    ready_at = [0.0] * jobs
+    doomed = [False] * jobs
+    overdue = [0] * jobs
+    expected: float | None = None
+    pools = {"download": [download_concurrency, []], "upload": [upload_concurrency, []]}
+    now = 0.0
+
+    def at(t: float, kind: str, job: int) -> None:
+        heapq.heappush(events, (t, next(seq), kind, job))
+
+    def take_next() -> None:
+        nonlocal next_job
+        if next_job < jobs:
+            waiting.append(next_job)
+            next_job += 1
+
+    def dispatch() -> None:
+        nonlocal head, in_flight
+        while head < len(waiting) and in_flight < int(limit):
+            in_flight += 1
+            counts["submits"] += 1
+            at(now + model.sample("submit", rng), "submitted", waiting[head])
+            head += 1
+
+    def jittered(seconds: float) -> float:
+        return seconds * rng.uniform(1 - poll["jitter"], 1 + poll["jitter"])
+
+    def backoff_delay(job: int) -> float:
+        n = overdue[job]
+        overdue[job] = n + 1
+        return min(poll["max_interval"], poll["min_interval"] * POLL_BACKOFF ** n)
+
+    def enter(stage: str, job: int) -> None:
+        pool = pools[stage]
+        if pool[0] > 0:
+            pool[0] -= 1
+            at(now + model.sample(stage, rng), stage, job)
+        else:
+            pool[1].append(job)
+
+    def leave(stage: str) -> None:
+        pool = pools[stage]
+        if pool[1]:
+            at(now + model.sample(stage, rng), stage, pool[1].pop(0))
+        else:
+            pool[0] += 1
+
+    for _ in range(min(maximum, jobs)):
+        take_next()
+    dispatch()
+    while events:
+        now, _, kind, job = heapq.heappop(events)
+        if kind == "submitted":
+            if rng.random() < model.throttle_rate(int(limit)):
+                counts["throttled"] += 1
+                in_flight -= 1
+                if now - last_cut >= AIMD_COOLDOWN:
+                    last_cut = now
+                    limit = max(1.0, limit * AIMD_DECREASE)
+                attempts[job] += 1
+                if attempts[job] < MAX_RETRIES:
+                    at(now + RETRY_BASE_DELAY * 2 ** (attempts[job] - 1), "retry", job)
+                else:
+                    counts["failed"] += 1
+                    take_next()
+            else:
+                limit = min(maximum, limit + AIMD_INCREASE / limit)
+                counts["billable"] += 1
+                counts["billed_seconds"] += durations[job] if durations is not None else VIDEO_DURATION
+                submitted_at[job] = now
+                ready_at[job] = now + model.sample("generation", rng)
+                doomed[job] = rng.random() < model.fail_rate
+                first = backoff_delay(job) if expected is None else max(poll["min_interval"], 0.75 * expected)
+                at(now + jittered(first), "poll", job)
+                at(now + delay, "released", job)
+        elif kind == "retry":
+            waiting.append(job)
+        elif kind == "released":
+            in_flight -= 1
+            take_next()
+        elif kind == "poll":
+            counts["polls"] += 1
+            if now < ready_at[job]:
+                at(now + jittered(backoff_delay(job)), "poll", job)
+                continue
+            took = now - submitted_at[job]
+            if doomed[job]:
+                counts["failed"] += 1
+                continue
+            expected = took if expected is None else 0.8 * expected + 0.2 * took
+            enter("download", job)
+        elif kind == "download":
+            leave("download")
+            enter("upload", job)
+        elif kind == "upload":
+            leave("upload")
+            counts["published"] += 1
+        dispatch()
+    return {"makespan": now, **counts}
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{secs:02d}s" if minutes else f"{secs}s"
+
+
+def parse_vary(spec: str) -> tuple[str, list]:
+    """argparse type for --vary FIELD=V[,V...]; a prompt is taken whole (repeat --vary for more)."""
+    field, sep, values = spec.partition("=")
+    field = field.strip()
+    if not sep or field not in VARIANT_FIELDS or not values.strip():
+        raise argparse.ArgumentTypeError(f"expected FIELD=V[,V...] with FIELD one of {', '.join(VARIANT_FIELDS)}, got {spec!r}")
+    if field == "prompt":
+        return field, [values.strip()]
+    try:
+        return field, [int(v) if field == "duration" else float(v) for v in values.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{field} values must be numbers, got {values!r}")
+
+
+def parse_grid(spec: str) -> list[float]:
+    """argparse type for a comma-separated list of numbers, e.g. "1,2,4"."""
+    try:
+        values = [float(v) for v in spec.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma-separated numbers, got {spec!r}")
+    if not values or any(v < 0 for v in values):
+        raise argparse.ArgumentTypeError(f"expected non-negative numbers, got {spec!r}")
+    return values
+
+
+def plan(
+    concurrencies: list[float],
+    delays: list[float],
+    runs: int = PLAN_RUNS,
+    max_concurrency: int = AIMD_MAX_CONCURRENCY,
+    poll_options: dict[str, Any] | None = None,
+    download_concurrency: int = DOWNLOAD_CONCURRENCY,
+    upload_concurrency: int = UPLOAD_CONCURRENCY,
+    cost_per_second: float = COST_PER_SECOND,
+    input_file: Path | None = None,
+    item_filter: Callable[[dict], bool] | None = None,
+    seed: int | None = None,
+    presets: PresetRegistry | None = None,
+) -> list[dict]:
+    """`plan` command: predict makespan, API calls and cost per setting.
+
+    Counts the manifest's jobs still to submit (as a dry run would, with
+    the variants of `presets`), fits a TimingModel to the progress file and
+    simulates `runs` runs for every `concurrencies` x `delays` combination.
+    Returns one row per setting.
+    """
+    input_file = input_file or INPUT_FILE
+    if not input_file.exists():
+        print(f"ERROR: Input file not found: {input_file}")
+        sys.exit(1)
+    progress = ProgressStore().load()
+    presets = presets or PRESETS
+    # Seconds each job would generate; variants may differ in duration
+    durations = [
+        presets.get(item.get("position", "general"), item.get("variant")).duration
+        for item in presets.expand(ManifestReader(input_file, item_filter))
+        if item["path"] not in progress or progress[item["path"]].get("status", "pending") in ("pending", "failed")
+    ]
+    jobs = len(durations)
+    model = TimingModel.fit(progress.values())
+    print(f"[plan] {jobs} jobs to submit from {input_file.name}; model fitted to {PROGRESS_FILE.name}:")
+    for line in model.describe():
+        print(line)
+    if not jobs:
+        return []
+
+    rng = random.Random(seed)
+    rows = []
+    print(f"\n  {'conc':>4} {'delay':>5} {'makespan p50':>12} {'p90':>7} {'submits':>8} {'429s':>6} "
+          f"{'polls':>7} {'cost':>9}")
+    for concurrency in concurrencies:
+        for delay in delays:
+            results = [
+                simulate_run(
+                    jobs, model, max(1, int(concurrency)), delay, max_concurrency, poll_options,
+                    download_concurrency, upload_concurrency, rng, durations,
+                )
+                for _ in range(runs)
+            ]
+            makespans = sorted(r["makespan"] for r in results)
+            row = {
+                "concurrency": max(1, int(concurrency)),
+                "delay": delay,
+                "makespan_p50": makespans[len(makespans) // 2],
+                "makespan_p90": makespans[min(len(makespans) - 1, int(0.9 * len(makespans)))],
+                **{k: sum(r.get(k, 0) for r in results) / runs
+                   for k in ("submits", "throttled", "polls", "billable", "billed_seconds", "published", "failed")},
+            }
+            row["cost"] = row["billed_seconds"] * cost_per_second
+            rows.append(row)
+            print(
+                f"  {row['concurrency']:>4} {delay:>5g} {_format_duration(row['makespan_p50']):>12} "
+                f"{_format_duration(row['makespan_p90']):>7} {row['submits']:>8.0f} {row['throttled']:>6.0f} "
+                f"{row['polls']:>7.0f} {'$' + format(row['cost'], '.2f'):>9}"
+            )
+    best = min(rows, key=lambda r: (r["makespan_p50"], r["submits"]))
+    print(
+        f"\n[plan] Fastest: --concurrency {best['concurrency']} --delay {best['delay']:g} "
+        f"(~{_format_duration(best['makespan_p50'])}, ~${best['cost']:.2f})"
+    )
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+def _without_option(argv: list[str], option: str) -> list[str]:
+    """Drop `option VALUE` / `option=VALUE` from an argument list."""
+    out: list[str] = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            out.append(arg)
+    return out
+
+
+def launch_workers(
+    count: int,
+    argv: list[str],
+    metrics_port: int | None,
+    webhook_port: int | None = None,
+    api_key_env: str = "WAVESPEED_API_KEY",
+) -> int:
+    """Run `count` coordinated copies of this script, one API key each.
+
+    Keys come from WAVESPEED_API_KEYS (comma-separated), falling back to
+    `api_key_env`; with fewer keys than workers, keys are shared. Each worker
+    reads its key from `api_key_env` (--api-key-env), set in its env. Output
+    is relayed line by line with a [wN] prefix. Metrics and webhook ports
+    are given to worker N as PORT+N. All workers get one --budget-run id,
+    so --budget-seconds/--budget-cost cap the run as a whole rather than
+    each worker. Returns the worst exit code.
+    """
+    keys = [k.strip() for k in (read_env("WAVESPEED_API_KEYS") or "").split(",") if k.strip()]
+    keys = keys or [load_api_key(api_key_env)]
+    if len(keys) < count:
+        print(f"[workers] {len(keys)} API key(s) for {count} workers; keys will be shared")
+    for option in ("--workers", "--metrics-port", "--webhook-port"):
+        argv = _without_option(argv, option)
+    if not any(arg == "--budget-run" or arg.startswith("--budget-run=") for arg in argv):
+        argv = [*argv, "--budget-run", secrets.token_hex(6)]
+
+    procs: list[subprocess.Popen] = []
+    relays: list[threading.Thread] = []
+    for i in range(count):
+        worker_argv = [sys.executable, "-u", __file__, *argv, "--worker", f"w{i}"]
+        if metrics_port:
+            worker_argv += ["--metrics-port", str(metrics_port + i)]
+        if webhook_port:
+            worker_argv += ["--webhook-port", str(webhook_port + i)]
+        env = {**os.environ, api_key_env: keys[i % len(keys)]}
+        proc = subprocess.Popen(worker_argv, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        procs.append(proc)
+
+        def relay(prefix: str = f"[w{i}]", stream=proc.stdout) -> None:
+            for line in stream:
+                print(f"{prefix} {line}", end="", flush=True)
+
+        relays.append(threading.Thread(target=relay, daemon=True))
+        relays[-1].start()
+    print(f"[workers] Started {count} workers")
+    codes = [proc.wait() for proc in procs]
+    for t in relays:
+        t.join()
+    return max(codes)
+
+
+def main() -> None:
     parser = argparse.ArgumentParser(description="Batch I2V video generation via WaveSpeed API")
-    parser.add_argument("--concurrency", type=int, default=3, help="Max parallel requests (default: 3)")
+    parser.add_argument("--concurrency", type=int, default=3,
+                        help="Initial parallel submissions; adapts to 429s (default: 3)")
+    parser.add_argument("--max-concurrency", type=int, default=AIMD_MAX_CONCURRENCY,
+                        help=f"Ceiling for adaptive submission concurrency (default: {AIMD_MAX_CONCURRENCY})")
     parser.add_argument("--delay", type=float, default=2.0, help="Delay in seconds between submissions (default: 2.0)")
     parser.add_argument("--dry-run", action="store_true", help="Show what would be generated without calling API")
+    parser.add_argument("--poll-concurrency", type=int, default=POLL_CONCURRENCY,
+                        help=f"Max result polls in flight (default: {POLL_CONCURRENCY})")
+    parser.add_argument("--poll-min-interval", type=float, default=POLL_MIN_INTERVAL,
+                        help=f"Seconds between polls of an overdue job (default: {POLL_MIN_INTERVAL})")
+    parser.add_argument("--poll-max-interval", type=float, default=POLL_MAX_INTERVAL,
+                        help=f"Per-job poll backoff cap in seconds (default: {POLL_MAX_INTERVAL})")
+    parser.add_argument("--poll-jitter", type=float, default=POLL_JITTER,
+                        help=f"Random +/- fraction applied to poll delays (default: {POLL_JITTER})")
+    parser.add_argument("--download-concurrency", type=int, default=DOWNLOAD_CONCURRENCY,
+                        help=f"Parallel video downloads (default: {DOWNLOAD_CONCURRENCY})")
+    parser.add_argument("--upload-concurrency", type=int, default=UPLOAD_CONCURRENCY,
+                        help=f"Parallel R2 uploads (default: {UPLOAD_CONCURRENCY})")
+    parser.add_argument("--r2-uploader", choices=["auto", "s3", "wrangler"], default="auto",
+                        help="R2 upload path: S3 API if R2_* credentials are set, else wrangler (default: auto)")
+    parser.add_argument("--encode-workers", type=int, default=ENCODE_WORKERS,
+                        help=f"Threads encoding source images (default: {ENCODE_WORKERS})")
+    parser.add_argument("--max-image-side", type=int, default=None,
+                        help="Downscale images to this many px on the long edge before upload (needs Pillow)")
+    parser.add_argument("--legacy-feed", action="store_true",
+                        help=f"Also rewrite the flat {FEED_FILE.name} from the feed shards after the run")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help=f"Serve Prometheus metrics on http://{METRICS_HOST}:PORT/metrics (default: off)")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help=f"Seconds between snapshots appended to {METRICS_FILE.name}; 0 disables "
+                             f"(default: {METRICS_INTERVAL})")
+    parser.add_argument("--input", type=Path, default=INPUT_FILE,
+                        help=f"Manifest to read: JSON array or JSON lines (default: {INPUT_FILE.name})")
+    parser.add_argument("--account", action="append", default=None, metavar="NAME",
+                        help="Only items from this account (repeatable)")
+    parser.add_argument("--position", action="append", default=None, metavar="NAME",
+                        help="Only items with this position (repeatable)")
+    parser.add_argument("--min-favorites", type=int, default=None, metavar="N",
+                        help="Only items with favorite_count >= N")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Run N coordinated worker processes, one API key each from WAVESPEED_API_KEYS")
+    parser.add_argument("--worker", default=None, metavar="NAME",
+                        help=f"Run as one coordinated worker claiming jobs from {LEASE_DB.name} "
+                             "(e.g. one per machine sharing this directory)")
+    parser.add_argument("--lease-seconds", type=float, default=LEASE_SECONDS,
+                        help=f"Seconds before a silent worker's jobs are reclaimed (default: {LEASE_SECONDS:g})")
+    parser.add_argument("--api-key-env", default="WAVESPEED_API_KEY", metavar="VAR",
+                        help="Environment variable holding this worker's API key (default: WAVESPEED_API_KEY)")
+    parser.add_argument("--order", choices=["priority", "manifest"], default="priority",
+                        help="Submit highest priority first, or in manifest order (default: priority)")
+    parser.add_argument("--priority-field", default=PRIORITY_FIELD, metavar="FIELD",
+                        help=f"Numeric manifest field scoring each item (default: {PRIORITY_FIELD})")
+    parser.add_argument("--account-weight", action="append", type=parse_weight, default=None, metavar="NAME=W",
+                        help="Multiply this account's scores by W (repeatable)")
+    parser.add_argument("--position-weight", action="append", type=parse_weight, default=None, metavar="NAME=W",
+                        help="Multiply this position's scores by W (repeatable)")
+    parser.add_argument("--priority-window", type=int, default=PRIORITY_WINDOW, metavar="N",
+                        help="Rank within a sliding window of N items, which bounds memory; 0 ranks the "
+                             f"whole manifest and holds all of it (default: {PRIORITY_WINDOW})")
+    parser.add_argument("--lora-runs", type=int, default=0, metavar="N",
+                        help="Send pending jobs in runs of up to N that load the same LoRA set, so the provider "
+                             "switches adapters less often (default: off, submission order)")
+    parser.add_argument("--lora-window", type=int, default=LORA_BATCH_WINDOW, metavar="N",
+                        help=f"Pending jobs looked over when forming --lora-runs (default: {LORA_BATCH_WINDOW})")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Submit one image per cluster of near-duplicates (perceptual hash) and give the "
+                             f"rest its video (needs numpy and pillow; hashes kept in {PHASH_INDEX_FILE.name})")
+    parser.add_argument("--dedup-threshold", type=int, default=DEDUP_THRESHOLD, metavar="BITS",
+                        help=f"Max differing hash bits (of 64) for --dedup to treat two images as one "
+                             f"(default: {DEDUP_THRESHOLD})")
+    parser.add_argument("--dedup-workers", type=int, default=DEDUP_WORKERS,
+                        help=f"Processes hashing images with --dedup (default: {DEDUP_WORKERS}, the CPU count)")
+    parser.add_argument("--budget-seconds", type=float, default=None, metavar="S",
+                        help="Stop submitting after this many generated video seconds this run "
+                             "(all --workers together)")
+    parser.add_argument("--budget-cost", type=float, default=None, metavar="USD",
+                        help="Stop submitting after this much spend this run (all --workers together)")
+    parser.add_argument("--budget-run", default=None, metavar="ID",
+                        help=f"Share the run budgets with every process given this id, via {SPEND_LEDGER.name} "
+                             "(set by --workers; default: a fresh id)")
+    parser.add_argument("--daily-budget-seconds", type=float, default=None, metavar="S",
+                        help=f"Cap on generated seconds per UTC day, across runs ({SPEND_LEDGER.name})")
+    parser.add_argument("--daily-budget-cost", type=float, default=None, metavar="USD",
+                        help="Cap on spend per UTC day, across runs")
+    parser.add_argument("--cost-per-second", type=float, default=COST_PER_SECOND, metavar="USD",
+                        help=f"Price of one generated second, for the cost budgets (default: {COST_PER_SECOND})")
+    parser.add_argument("--deadline", type=parse_deadline, default=None, metavar="WHEN",
+                        help="Stop submitting once new jobs cannot finish by then: seconds from now, "
+                             "HH:MM or ISO-8601")
+    parser.add_argument("--webhook-port", type=int, default=None,
+                        help="Receive completion webhooks on this port and poll only every "
+                             f"{WEBHOOK_FALLBACK_POLL:g}s as a fallback (default: off, poll)")
+    parser.add_argument("--webhook-host", default=WEBHOOK_HOST,
+                        help=f"Address the webhook receiver binds to (default: {WEBHOOK_HOST})")
+    parser.add_argument("--webhook-url", default=None, metavar="URL",
+                        help="Public base URL WaveSpeed should call, e.g. a tunnel to the receiver; "
+                             "{port} is replaced by the receiver's port (default: http://HOST:PORT)")
+    parser.add_argument("--stage-images", action="store_true",
+                        help=f"Upload each source image to R2 once and submit its URL instead of inline "
+                             f"base64 (needs R2 S3 credentials; URLs cached in {STAGED_IMAGES_FILE.name})")
+    parser.add_argument("--presets", type=Path, default=None, metavar="FILE",
+                        help="JSON of per-position presets ({position: {prompt, high_noise_loras, ...}}) "
+                             "replacing the built-in ones")
+    parser.add_argument("--vary", action="append", type=parse_vary, default=None, metavar="FIELD=V,...",
+                        help="Generate every combination of these values per image as variants A, B, ...: "
+                             "scale (multiplies LoRA scales), duration, or prompt (repeat for more prompts)")
+    parser.add_argument("--postprocess", action="store_true",
+                        help="Remux videos for fast start and add poster and preview renditions to the feed "
+                             "(needs ffmpeg)")
+    parser.add_argument("--postprocess-workers", type=int, default=POSTPROCESS_WORKERS,
+                        help=f"ffmpeg jobs at once with --postprocess (default: {POSTPROCESS_WORKERS}, the CPU count)")
+    parser.add_argument("--poster-format", choices=["jpg", "webp"], default="jpg",
+                        help="Poster image format (default: jpg)")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    reconcile_parser = commands.add_parser(
+        "reconcile", help="Compare progress, generated_videos/, R2 and the feed in bulk and report or repair drift",
+    )
+    reconcile_parser.add_argument("--repair", action="store_true",
+                                  help="Re-check stale jobs, restore missing uploads and append missing feed rows")
+    reconcile_parser.add_argument("--delete-orphans", action="store_true",
+                                  help="Delete local videos and R2 objects that nothing refers to")
+    reconcile_parser.add_argument("--stale-hours", type=float, default=RECONCILE_STALE_HOURS, metavar="H",
+                                  help=f"Treat jobs submitted more than H hours ago as stale "
+                                       f"(default: {RECONCILE_STALE_HOURS:g})")
+    reconcile_parser.add_argument("--report", type=Path, default=None, metavar="FILE",
+                                  help="Also write every finding to FILE as JSON")
+    plan_parser = commands.add_parser(
+        "plan", help="Simulate the manifest's outstanding jobs under several settings, from recorded timings",
+    )
+    plan_parser.add_argument("--concurrency-grid", type=parse_grid, default=parse_grid(PLAN_CONCURRENCY),
+                             metavar="N,N,...", help=f"Starting concurrencies to try (default: {PLAN_CONCURRENCY})")
+    plan_parser.add_argument("--delay-grid", type=parse_grid, default=parse_grid(PLAN_DELAY),
+                             metavar="S,S,...", help=f"Submission delays to try (default: {PLAN_DELAY})")
+    plan_parser.add_argument("--runs", type=int, default=PLAN_RUNS,
+                             help=f"Simulated runs per setting (default: {PLAN_RUNS})")
+    plan_parser.add_argument("--seed", type=int, default=None, help="Seed the simulation for repeatable output")
     args = parser.parse_args()
+    vary: dict[str, list] = {}
+    for field, values in args.vary or ():
+        vary.setdefault(field, []).extend(values)
 
-    asyncio.run(run(args.concurrency, args.delay, args.dry_run))
+    if args.command == "plan":
+        plan(
+            args.concurrency_grid, args.delay_grid, args.runs, args.max_concurrency,
+            {"min_interval": args.poll_min_interval, "max_interval": args.poll_max_interval,
+             "jitter": args.poll_jitter},
+            args.download_concurrency, args.upload_concurrency, args.cost_per_second, args.input,
+            manifest_filter(args.account, args.position, args.min_favorites), args.seed,
+            load_presets(args.presets, vary),
+        )
+        return
+
+    if args.command == "reconcile":
+        asyncio.run(reconcile(
+            args.repair, args.delete_orphans, args.stale_hours, args.report, args.api_key_env, args.input,
+        ))
+        return
+
+    if args.workers:
+        sys.exit(launch_workers(args.workers, sys.argv[1:], args.metrics_port, args.webhook_port, args.api_key_env))
+
+    poll_options = {
+        "concurrency": args.poll_concurrency,
+        "min_interval": args.poll_min_interval,
+        "max_interval": args.poll_max_interval,
+        "jitter": args.poll_jitter,
+    }
+    priority = None
+    if args.order == "priority":
+        priority = priority_score(args.priority_field, dict(args.account_weight or ()), dict(args.position_weight or ()))
+    budget = None
+    caps = (args.budget_seconds, args.budget_cost, args.daily_budget_seconds, args.daily_budget_cost)
+    if args.deadline is not None or any(cap is not None for cap in caps):
+        budget = SubmissionBudget(
+            *caps, args.cost_per_second, args.deadline, persist=not args.dry_run, run_id=args.budget_run,
+        )
+    asyncio.run(run(RunOptions(
+        concurrency=args.concurrency,
+        delay=args.delay,
+        dry_run=args.dry_run,
+        max_concurrency=args.max_concurrency,
+        poll_options=poll_options,
+        download_concurrency=args.download_concurrency,
+        upload_concurrency=args.upload_concurrency,
+        r2_uploader=args.r2_uploader,
+        encode_workers=args.encode_workers,
+        max_image_side=args.max_image_side,
+        legacy_feed=args.legacy_feed,
+        metrics_port=args.metrics_port,
+        metrics_interval=args.metrics_interval,
+        worker=args.worker,
+        lease_seconds=args.lease_seconds,
+        api_key_env=args.api_key_env,
+        input_file=args.input,
+        item_filter=manifest_filter(args.account, args.position, args.min_favorites),
+        priority=priority,
+        priority_window=args.priority_window,
+        budget=budget,
+        webhook_port=args.webhook_port,
+        webhook_url=args.webhook_url,
+        webhook_host=args.webhook_host,
+        stage_images=args.stage_images,
+        presets_file=args.presets,
+        vary=vary,
+        postprocess_workers=args.postprocess_workers if args.postprocess else 0,
+        poster_format=args.poster_format,
+        lora_runs=args.lora_runs,
+        lora_window=args.lora_window,
+        dedup_workers=args.dedup_workers if args.dedup else 0,
+        dedup_threshold=args.dedup_threshold,
+    )))
 
 
 if __name__ == "__main__":
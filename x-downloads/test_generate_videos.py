@@ -0,0 +1,914 @@
+"""
+End-to-end tests for generate_videos.py against fake_wavespeed.py.
+
+Each test starts FakeWaveSpeed in-process on a free port, points every
+generate_videos path and endpoint at a scratch directory and the fake (as
+bench_generate does, but undone after each test) and checks what a run
+leaves behind: progress entries, the feed, the fake's R2 objects and its
+request counters.
+
+Usage:
+    python -m pytest -q test_generate_videos.py
+"""
+
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import re
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import generate_videos as gv
+from fake_wavespeed import FakeConfig, FakeWaveSpeed
+
+VIDEO_BYTES = 64 * 1024
+POLL_OPTIONS = {"concurrency": 8, "min_interval": 0.05, "max_interval": 0.2, "jitter": 0.1}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Scratch copies of every file generate_videos reads or writes."""
+    for name, target in {
+        "PROGRESS_FILE": "generation_progress.json",
+        "PROGRESS_JOURNAL": "generation_progress.journal",
+        "GENERATED_DIR": "generated_videos",
+        "FEED_FILE": "feed-videos.json",
+        "FEED_DIR": "feed",
+        "CLASSIFIED_SRC": "classified_src.json",
+        "ENCODE_CACHE_DIR": "encode_cache",
+        "GENERATION_CACHE_FILE": "generation_cache.jsonl",
+        "METRICS_FILE": "generation_metrics.jsonl",
+        "LEASE_DB": "generation_leases.db",
+        "SPEND_LEDGER": "generation_spend.jsonl",
+        "STAGED_IMAGES_FILE": "staged_images.jsonl",
+        "PHASH_INDEX_FILE": "image_phashes.jsonl",
+    }.items():
+        monkeypatch.setattr(gv, name, tmp_path / target)
+    monkeypatch.setattr(gv, "DOWNLOAD_RETRY_DELAY", 0.01)
+    monkeypatch.setattr(gv, "RETRY_BASE_DELAY", 0.01)
+    for var in ("WAVESPEED_API_KEY", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(var, "test")
+    return tmp_path
+
+
+@asynccontextmanager
+async def fake_server(monkeypatch, **config):
+    """Serve a FakeWaveSpeed on a free port and route generate_videos to it."""
+    fake = FakeWaveSpeed(FakeConfig(
+        **{"gen_mean": 0.2, "gen_sigma": 0.2, "submit_latency": 0.01, "poll_latency": 0.0,
+           "video_bytes": VIDEO_BYTES, "seed": 7, **config},
+    ))
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base_url = "http://127.0.0.1:%d" % runner.addresses[0][1]
+    monkeypatch.setattr(gv, "SUBMIT_URL", f"{base_url}/api/v3/wavespeed-ai/wan-2.2/image-to-video-lora")
+    monkeypatch.setattr(gv, "RESULT_URL", f"{base_url}/api/v3/predictions/{{request_id}}/result")
+    monkeypatch.setenv("R2_ENDPOINT", f"{base_url}/s3")
+    try:
+        yield fake
+    finally:
+        await runner.cleanup()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def build_manifest(workdir: Path, jobs: int, images: list[bytes] | None = None) -> Path:
+    positions = list(gv.PROMPT_MAP)
+    items = []
+    for i in range(jobs):
+        image = workdir / "images" / f"acct{i % 3}" / f"{1900000000000000000 + i}_1.jpg"
+        image.parent.mkdir(parents=True, exist_ok=True)
+        image.write_bytes(images[i] if images else i.to_bytes(8, "big") * 64)
+        items.append({
+            "path": str(image),
+            "account": image.parent.name,
+            "filename": image.name,
+            "position": positions[i % len(positions)],
+            "favorite_count": jobs - i,
+        })
+    manifest = workdir / "manifest.json"
+    manifest.write_text(json.dumps(items))
+    return manifest
+
+
+def run_options(manifest: Path, **options) -> gv.RunOptions:
+    return gv.RunOptions(**{
+        "concurrency": 4, "delay": 0.0, "poll_options": POLL_OPTIONS, "r2_uploader": "s3",
+        "input_file": manifest, "metrics_interval": 0, **options,
+    })
+
+
+def load_progress() -> dict[str, dict]:
+    return json.loads(gv.PROGRESS_FILE.read_text())
+
+
+def assert_all_published(fake: FakeWaveSpeed, jobs: int) -> dict[str, dict]:
+    progress = load_progress()
+    assert len(progress) == jobs
+    assert {entry["status"] for entry in progress.values()} == {"completed"}
+    assert all(entry.get("published") for entry in progress.values())
+    manifest = json.loads((gv.FEED_DIR / "manifest.json").read_text())
+    assert manifest["total"] == jobs
+    videos = {key: obj for key, obj in fake.objects.items() if key.startswith(f"{gv.R2_BUCKET}/{gv.R2_PREFIX}/")}
+    assert len(videos) == jobs
+    return progress
+
+
+def test_run_publishes_every_job(workdir, monkeypatch):
+    manifest = build_manifest(workdir, 8)
+
+    async def scenario():
+        async with fake_server(monkeypatch) as fake:
+            await gv.run(run_options(manifest))
+            return fake
+
+    fake = asyncio.run(scenario())
+    assert_all_published(fake, 8)
+    assert fake.stats["submit"] == 8
+    assert all(obj["size"] == VIDEO_BYTES for obj in fake.objects.values())
+
+
+def test_resume_after_torn_journal(workdir, monkeypatch):
+    manifest = build_manifest(workdir, 6)
+
+    async def scenario():
+        async with fake_server(monkeypatch, gen_mean=1.0, gen_sigma=0.05) as fake:
+            # Stop the first run while every job is still generating
+            first = asyncio.create_task(gv.run(run_options(manifest)))
+            while len(fake.jobs) < 6:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)
+            first.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await first
+            assert {entry["status"] for entry in load_progress().values()} == {"submitted"}
+            # A crash mid-append leaves half a record at the end of the journal
+            with open(gv.PROGRESS_JOURNAL, "a", encoding="utf-8") as f:
+                f.write('{"path": "torn", "status": "compl')
+            await gv.run(run_options(manifest))
+            return fake
+
+    fake = asyncio.run(scenario())
+    assert_all_published(fake, 6)
+    assert fake.stats["submit"] == 6  # resumed by polling, nothing submitted twice
+
+
+def test_dropped_downloads_resume_with_range(workdir, monkeypatch):
+    monkeypatch.setattr(gv, "DOWNLOAD_ATTEMPTS", 12)
+    # Several chunks per video, as with real ones, so a drop leaves a partial .part
+    monkeypatch.setattr(gv, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+    video_bytes = 4 * 1024 * 1024
+    manifest = build_manifest(workdir, 8)
+
+    async def scenario():
+        async with fake_server(monkeypatch, drop_rate=0.5, video_bytes=video_bytes) as fake:
+            await gv.run(run_options(manifest))
+            return fake
+
+    fake = asyncio.run(scenario())
+    assert_all_published(fake, 8)
+    dropped = fake.stats["download_dropped"]
+    assert dropped > 0
+    # Starting over would refetch the half sent before each drop; resuming
+    # with Range only refetches what was still buffered when it dropped
+    wasted = fake.stats["download_bytes"] - 8 * video_bytes
+    assert wasted < dropped * video_bytes // 4
+    assert all(f.stat().st_size == video_bytes for f in gv.GENERATED_DIR.glob("*.mp4"))
+
+
+def test_webhook_with_lost_callbacks(workdir, monkeypatch):
+    monkeypatch.setattr(gv, "WEBHOOK_FALLBACK_POLL", 0.5)
+    manifest = build_manifest(workdir, 12)
+
+    async def scenario():
+        async with fake_server(monkeypatch, webhook_loss=0.5) as fake:
+            await gv.run(run_options(manifest, webhook_port=free_port()))
+            return fake
+
+    fake = asyncio.run(scenario())
+    assert_all_published(fake, 12)
+    assert fake.stats["webhook_200"] > 0
+    assert fake.stats["webhook_lost"] > 0
+    # Only the jobs whose callback was lost needed the fallback poll
+    assert fake.stats["poll"] < 12
+
+
+def test_reconcile_repairs_missing_uploads(workdir, monkeypatch):
+    manifest = build_manifest(workdir, 5)
+
+    async def scenario():
+        async with fake_server(monkeypatch) as fake:
+            await gv.run(run_options(manifest))
+            keys = sorted(key for key in fake.objects if key.endswith(".mp4"))
+            del fake.objects[keys[0]]
+            del fake.objects[keys[1]]
+            # One of them must be downloaded again before it can be uploaded
+            (gv.GENERATED_DIR / Path(keys[1]).name).unlink()
+            drift = await gv.reconcile(repair=True, input_file=manifest)
+            after = await gv.reconcile(input_file=manifest)
+            return fake, keys, drift, after
+
+    fake, keys, drift, after = asyncio.run(scenario())
+    assert len(drift["missing_upload"]) == 2
+    assert not any(after.values())
+    assert keys[0] in fake.objects and keys[1] in fake.objects
+    assert fake.stats["download"] == 6
+
+
+def test_undecodable_image_fails_only_its_job(workdir, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    images = []
+    for shade in range(3):
+        buf = io.BytesIO()
+        Image.new("RGB", (640, 480), (shade * 60, 90, 120)).save(buf, "JPEG")
+        images.append(buf.getvalue())
+    images.append(b"not a jpeg at all" * 32)
+    manifest = build_manifest(workdir, 4, images)
+
+    async def scenario():
+        async with fake_server(monkeypatch) as fake:
+            await gv.run(run_options(manifest, max_image_side=256))
+            return fake
+
+    fake = asyncio.run(scenario())
+    progress = load_progress()
+    junk = progress[json.loads(manifest.read_text())[3]["path"]]
+    assert junk["status"] == "failed"
+    assert junk["error"].startswith("Image unusable")
+    others = [entry for entry in progress.values() if entry is not junk]
+    assert all(entry["status"] == "completed" and entry.get("published") for entry in others)
+    assert fake.stats["submit"] == 3
+
+
+def test_postprocess_leaves_download_resumable(workdir, monkeypatch):
+    # Stand-in ffmpeg: writes a short file to its output argument
+    bin_dir = workdir / "bin"
+    bin_dir.mkdir()
+    ffmpeg = bin_dir / "ffmpeg"
+    ffmpeg.write_text('#!/bin/sh\nfor out; do :; done\nprintf remuxed > "$out"\n')
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    manifest = build_manifest(workdir, 3)
+
+    async def scenario():
+        async with fake_server(monkeypatch) as fake:
+            await gv.run(run_options(manifest, postprocess_workers=2))
+            downloads = fake.stats["download"]
+            # A later run finds the downloads on disk and must take them as complete
+            async with aiohttp.ClientSession() as session:
+                for path, entry in load_progress().items():
+                    key = gv._derive_video_key(path)
+                    assert await gv.download_video(session, key, entry["videoUrl"]) == gv.GENERATED_DIR / f"{key}.mp4"
+            return fake, downloads
+
+    fake, downloads = asyncio.run(scenario())
+    assert_all_published(fake, 3)
+    assert fake.stats["download"] == downloads
+    for path in load_progress():
+        key = gv._derive_video_key(path)
+        assert (gv.GENERATED_DIR / f"{key}.mp4").stat().st_size == VIDEO_BYTES
+        assert gv._local_videos()[key] == gv._faststart_file(key)
+        assert fake.objects[f"{gv.R2_BUCKET}/{gv.R2_PREFIX}/{key}.mp4"]["size"] == len(b"remuxed")
+
+
+def test_early_non_terminal_callback_keeps_job_polled(workdir):
+    async def scenario():
+        progress = gv.ProgressStore().load()
+        for name in ("a", "b"):
+            progress.update(name, status="submitted", requestId=f"req-{name}", submittedAt=None)
+        finished: list[str] = []
+
+        async def on_terminal(path: str) -> None:
+            finished.append(path)
+
+        scheduler = gv.PollScheduler(None, progress, {}, on_terminal=on_terminal)
+        # Both callbacks arrive before the submit bookkeeping has added the jobs
+        scheduler.deliver({"id": "req-a", "status": "processing"})
+        scheduler.deliver({"id": "req-b", "status": "completed", "outputs": ["https://cdn.example/b.mp4"]})
+        scheduler.add("a")
+        scheduler.add("b")
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        scheduled = scheduler.scheduled
+        progress.close()
+        return progress, scheduled, finished
+
+    progress, scheduled, finished = asyncio.run(scenario())
+    assert scheduled == 1  # "a" is still waiting for a poll
+    assert progress["a"]["status"] == "submitted"
+    assert progress["b"]["status"] == "completed"
+    assert finished == ["b"]
+
+
+def test_repeated_terminal_callback_finishes_once(workdir, capsys):
+    async def scenario():
+        progress = gv.ProgressStore().load()
+        progress.update("a.jpg", status="submitted", requestId="req-a", submittedAt=None)
+        finished: list[str] = []
+
+        async def on_terminal(path: str) -> None:
+            finished.append(path)
+
+        scheduler = gv.PollScheduler(None, progress, {}, on_terminal=on_terminal)
+        scheduler.add("a.jpg")
+        data = {"id": "req-a", "status": "completed", "outputs": ["https://cdn.example/a.mp4"]}
+        # A retried webhook lands before the first one's finish task has run
+        assert scheduler.deliver(data)
+        assert scheduler.deliver(data)
+        await asyncio.gather(*scheduler._inflight)
+        progress.close()
+        return progress, finished, scheduler.scheduled
+
+    progress, finished, scheduled = asyncio.run(scenario())
+    assert finished == ["a.jpg"]
+    assert scheduled == 0
+    assert progress["a.jpg"]["polls"] == 0
+    assert capsys.readouterr().out.count("[completed] a.jpg") == 1
+
+
+def test_progress_compaction_scales_with_store(tmp_path, monkeypatch):
+    rewrites = []
+    write_snapshot = gv.ProgressStore._write_snapshot
+    monkeypatch.setattr(gv.ProgressStore, "_write_snapshot", lambda self, entries: (
+        rewrites.append(len(entries)), write_snapshot(self, entries)))
+    store = gv.ProgressStore(tmp_path / "p.json", tmp_path / "p.journal", compact_every=10).load()
+    for i in range(200):
+        store.update(f"img/{i}.jpg", status="pending")
+    for i in range(200):
+        store.update(f"img/{i}.jpg", status="submitted", requestId=f"r{i}")
+    store.close()
+    # A fixed every-10-records rewrite would have run 40 times, copying 6,000 entries
+    assert len(rewrites) <= 10
+    assert sum(rewrites) <= 3 * 400
+    reloaded = gv.ProgressStore(tmp_path / "p.json", tmp_path / "p.journal").load()
+    assert reloaded.counts == {"submitted": 200}
+    assert not (tmp_path / "p.journal").exists() and not (tmp_path / "p.journal.old").exists()
+
+
+def test_progress_load_replays_journal_left_by_interrupted_compaction(tmp_path):
+    store = gv.ProgressStore(tmp_path / "p.json", tmp_path / "p.journal").load()
+    store.update("a.jpg", status="pending")
+    store.update("b.jpg", status="pending")
+    store.close()
+    # Crashed after moving the journal aside but before the new snapshot landed
+    (tmp_path / "p.journal.old").write_text(json.dumps({"path": "a.jpg", "status": "submitted"}) + "\n")
+    (tmp_path / "p.journal").write_text(
+        json.dumps({"path": "a.jpg", "status": "completed"}) + "\n" + '{"path": "b.jpg", "sta'
+    )
+    store = gv.ProgressStore(tmp_path / "p.json", tmp_path / "p.journal").load()
+    assert store["a.jpg"]["status"] == "completed"
+    assert store["b.jpg"]["status"] == "pending"
+    assert not (tmp_path / "p.journal.old").exists()
+
+
+def test_budgets_sharing_a_ledger_enforce_run_and_daily_caps(tmp_path):
+    ledger = tmp_path / "spend.jsonl"
+    w0 = gv.SubmissionBudget(run_seconds=10, ledger_file=ledger, run_id="run1")
+    w1 = gv.SubmissionBudget(run_seconds=10, ledger_file=ledger, run_id="run1")
+    first = w0.reserve(6)
+    assert first is not None
+    assert w1.reserve(6) is None and w1.stopped == "run seconds budget of 10 reached"
+    assert w0.reserve(4) is not None
+    w0.settle(first, "a.jpg", 6, charged=False)  # released, never billed
+    assert gv.SubmissionBudget(run_seconds=10, ledger_file=ledger, run_id="run1").reserve(6) is not None
+
+    # Another run has its own run cap but shares the day's
+    other = gv.SubmissionBudget(run_seconds=10, day_seconds=18, ledger_file=ledger, run_id="run2")
+    assert other.reserve(9) is None and other.stopped == "daily seconds budget of 18 reached"
+    assert gv.SubmissionBudget(day_seconds=18, ledger_file=ledger, run_id="run2").reserve(8) is not None
+
+
+def test_budget_reservations_hold_across_threads_and_skip_dead_processes(tmp_path):
+    ledger = tmp_path / "spend.jsonl"
+    budgets = [gv.SubmissionBudget(run_seconds=50, ledger_file=ledger, run_id="run") for _ in range(4)]
+
+    def spend(budget: gv.SubmissionBudget) -> None:
+        for i in range(20):
+            rid = budget.reserve(5)
+            if rid is None:
+                return
+            budget.settle(rid, f"{i}.jpg", 5, charged=True)
+
+    threads = [threading.Thread(target=spend, args=(b,)) for b in budgets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    final = gv.SubmissionBudget(ledger_file=ledger, run_id="run")
+    final._refresh()
+    assert final.spent_seconds == 50
+
+    # A reservation whose process died without settling no longer holds room
+    proc = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    with open(ledger, "a") as f:
+        f.write(json.dumps({"ts": 0, "day": final._today(), "run": "gone", "id": "gone.1",
+                            "pid": int(proc.stdout), "reserved": 100}) + "\n")
+    assert gv.SubmissionBudget(day_seconds=60, ledger_file=ledger).reserve(10) is not None
+
+
+def test_workers_get_their_key_in_the_api_key_env_variable(tmp_path, monkeypatch, capsys):
+    child = tmp_path / "child.py"
+    child.write_text("import os, sys\nprint(os.environ.get('MY_KEY'), sys.argv[-1])\n")
+    monkeypatch.setattr(gv, "__file__", str(child))
+    monkeypatch.delenv("WAVESPEED_API_KEYS", raising=False)
+    monkeypatch.setenv("MY_KEY", "only-key")
+    assert gv.launch_workers(2, ["--api-key-env", "MY_KEY"], None, api_key_env="MY_KEY") == 0
+    out = capsys.readouterr().out
+    assert "[w0] only-key w0" in out and "[w1] only-key w1" in out
+
+    monkeypatch.setenv("WAVESPEED_API_KEYS", "k0, k1")
+    assert gv.launch_workers(2, ["--api-key-env", "MY_KEY"], None, api_key_env="MY_KEY") == 0
+    out = capsys.readouterr().out
+    assert "[w0] k0 w0" in out and "[w1] k1 w1" in out
+
+
+def test_lease_store_claims_each_job_once_and_reclaims_expired_leases(workdir):
+    items = [{"path": f"img/{i}.jpg"} for i in range(3)]
+    w0 = gv.LeaseStore("w0", lease_seconds=0.2).seed(items)
+    w1 = gv.LeaseStore("w1", lease_seconds=0.2).seed(items)
+    assert [item["path"] for item in w0.claim(2)] == ["img/0.jpg", "img/1.jpg"]
+    assert [item["path"] for item in w1.claim(5)] == ["img/2.jpg"]
+    assert w0.claim(5) == [] and w0.unfinished_elsewhere() == 1
+
+    w1.update("img/2.jpg", status="completed", videoUrl="(dry-run)")
+    assert w1.counts["completed"] == 1 and w1.unfinished_elsewhere() == 2
+
+    time.sleep(0.25)  # w0 went silent: its leases run out
+    assert sorted(item["path"] for item in w1.claim(5)) == ["img/0.jpg", "img/1.jpg"]
+    w0.update("img/0.jpg", status="failed")  # no longer w0's, so not saved
+    assert w1.counts == {"pending": 2, "completed": 1}
+    w1.update("img/0.jpg", status="submitted", requestId="r0")
+    w1.close()
+    w0.close()
+    assert json.loads(gv.PROGRESS_FILE.read_text())["img/0.jpg"]["status"] == "submitted"
+
+
+@pytest.mark.parametrize("read_size", [1, 3, 1 << 20])
+def test_manifest_reader_streams_arrays_across_chunk_boundaries(tmp_path, monkeypatch, read_size):
+    monkeypatch.setattr(gv, "MANIFEST_READ_SIZE", read_size)
+    items = [{"path": f"a/{i}.jpg", "favorite_count": 10 ** i, "score": -1.5e3, "ok": True} for i in range(5)]
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps(items, indent=1))
+    reader = gv.ManifestReader(manifest, keep=lambda item: item["favorite_count"] >= 100)
+    assert list(reader) == items[2:]
+    assert (reader.scanned, reader.selected) == (5, 3)
+
+    assert list(gv._iter_json_array(io.StringIO("[12345, 678]"))) == [12345, 678]
+    assert list(gv._iter_json_array(io.StringIO(" [ ] "))) == []
+    lines = tmp_path / "manifest.jsonl"
+    lines.write_text("".join(json.dumps(item) + "\n\n" for item in items))
+    assert list(gv.ManifestReader(lines)) == items
+
+
+@pytest.mark.parametrize("text", ['[{"path": "a"} {"path": "b"}]', "[1 2]", "[1,]", '[{"path": "a"}'])
+def test_manifest_reader_rejects_malformed_arrays(tmp_path, monkeypatch, text):
+    monkeypatch.setattr(gv, "MANIFEST_READ_SIZE", 1)
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(text)
+    with pytest.raises(ValueError):
+        list(gv.ManifestReader(manifest))
+
+
+def test_adaptive_limiter_grows_additively_and_halves_once_per_congestion_event(monkeypatch):
+    limiter = gv.AdaptiveLimiter(2, maximum=4)
+    for _ in range(2):
+        limiter.on_success()
+    assert int(limiter.limit) == 2  # +1/limit per success: 2.5, then 2.9
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.limit == 4  # capped at the maximum
+
+    limiter.on_throttle(None, "429")
+    limiter.on_throttle(None, "429")  # same burst, inside the cooldown
+    assert limiter.limit == 2
+    monkeypatch.setattr(gv, "AIMD_COOLDOWN", 0.0)
+    for _ in range(5):
+        limiter.on_throttle(None, "503")
+    assert limiter.limit == limiter.minimum == 1
+
+
+def test_adaptive_limiter_bounds_in_flight_and_honours_retry_after():
+    async def scenario() -> tuple[int, float]:
+        limiter = gv.AdaptiveLimiter(2)
+        peak = 0
+
+        async def job() -> None:
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(job() for _ in range(8)))
+        limiter.on_throttle(0.2, "429")
+        started = time.monotonic()
+        async with limiter.slot():
+            waited = time.monotonic() - started
+        return peak, waited
+
+    peak, waited = asyncio.run(scenario())
+    assert peak == 2
+    assert waited >= 0.15
+
+
+def test_generation_cache_last_record_wins_and_forget_drops(tmp_path):
+    cache_file = tmp_path / "cache.jsonl"
+    cache = gv.GenerationCache(cache_file).load()
+    cache.record("img:fp", requestId="r1", submittedAt=1.0)
+    cache.record("img:fp", videoUrl="https://v/1.mp4")
+    cache.record("other:fp", requestId="r2")
+    cache.forget("other:fp")
+    cache.forget("never-recorded")
+    cache.close()
+    assert len(cache_file.read_text().splitlines()) == 4
+
+    reloaded = gv.GenerationCache(cache_file).load()
+    assert reloaded.get("img:fp") == {"requestId": "r1", "submittedAt": 1.0, "videoUrl": "https://v/1.mp4"}
+    assert reloaded.get("other:fp") is None
+    # Mostly superseded records were rewritten to one line per live key
+    assert [json.loads(line)["key"] for line in cache_file.read_text().splitlines()] == ["img:fp"]
+
+    position = next(iter(gv.PROMPT_MAP))
+    assert gv.request_fingerprint(position) != gv.request_fingerprint(position, max_image_side=512)
+
+
+def test_identical_images_share_one_generation(workdir, monkeypatch):
+    positions = len(gv.PROMPT_MAP)
+    # Items i and i + positions have the same position and the same image bytes
+    manifest = build_manifest(workdir, 2 * positions, [(i % positions).to_bytes(8, "big") * 64 for i in range(2 * positions)])
+
+    async def scenario():
+        async with fake_server(monkeypatch) as fake:
+            await gv.run(run_options(manifest))
+            return fake
+
+    fake = asyncio.run(scenario())
+    progress = assert_all_published(fake, 2 * positions)
+    assert fake.stats["submit"] == positions
+    assert len({entry["requestId"] for entry in progress.values()}) == positions
+    cache = gv.GenerationCache().load()
+    assert len(cache.entries) == positions
+    assert all(entry.get("videoUrl") for entry in cache.entries.values())
+
+
+def feed_meta(account: str, position: str = "doggy") -> dict:
+    return {"account": account, "position": position, "favorite_count": 1}
+
+
+def read_index(feed_dir: Path, index: dict) -> list[str]:
+    return [json.loads(line) for line in (feed_dir / index["file"]).read_text().splitlines()]
+
+
+def test_feed_writer_shards_pages_and_appends_indexes(workdir, monkeypatch):
+    monkeypatch.setattr(gv, "FEED_PAGE_SIZE", 3)
+    feed = gv.FeedWriter()
+    for i in range(4):
+        feed.add(f"img/a/{i}.jpg", feed_meta("a", "doggy" if i % 2 else "oral"), f"https://r2/{i}.mp4")
+    assert feed.flush() == [f"img/a/{i}.jpg" for i in range(4)]
+    for i in range(4, 7):
+        feed.add(f"img/b/{i}.jpg", feed_meta("b"), f"https://r2/{i}.mp4")
+    feed.flush()
+
+    manifest = json.loads((gv.FEED_DIR / "manifest.json").read_text())
+    assert manifest["total"] == 7 and manifest["nextId"] == 8
+    assert [(p["count"], p["firstId"], p["lastId"]) for p in manifest["pages"]] == [(3, "1", "3"), (3, "4", "6"), (1, "7", "7")]
+    pages = [json.loads((gv.FEED_DIR / p["file"]).read_text()) for p in manifest["pages"]]
+    assert [entry["id"] for page in pages for entry in page] == [str(i) for i in range(1, 8)]
+    creators, tags = manifest["indexes"]["creator"], manifest["indexes"]["tag"]
+    assert read_index(gv.FEED_DIR, creators["a"]) == ["1", "2", "3", "4"]
+    assert read_index(gv.FEED_DIR, creators["b"]) == ["5", "6", "7"]
+    assert read_index(gv.FEED_DIR, tags["doggy"]) == ["2", "4", "5", "6", "7"]
+    assert tags["doggy"]["count"] == 5
+    assert tags["doggy"]["bytes"] == (gv.FEED_DIR / tags["doggy"]["file"]).stat().st_size
+
+    # Lines past the published bytes (a flush that died before its manifest) are cut off
+    with open(gv.FEED_DIR / tags["oral"]["file"], "a") as f:
+        f.write('"99"\n')
+    reopened = gv.FeedWriter()
+    reopened.add("img/c/7.jpg", feed_meta("c", "oral"), "https://r2/7.mp4")
+    reopened.flush()
+    assert read_index(gv.FEED_DIR, reopened.manifest["indexes"]["tag"]["oral"]) == ["1", "3", "8"]
+
+    reopened.export_legacy()
+    assert [entry["id"] for entry in json.loads(gv.FEED_FILE.read_text())] == [str(i) for i in range(1, 9)]
+
+
+def test_feed_writers_sharing_a_directory_keep_ids_and_urls_unique(workdir):
+    first, second = gv.FeedWriter(), gv.FeedWriter()
+    first.add("img/a/1.jpg", feed_meta("a"), "https://r2/1.mp4")
+    second.add("img/a/1.jpg", feed_meta("a"), "https://r2/1.mp4")
+    second.add("img/a/2.jpg", feed_meta("a"), "https://r2/2.mp4")
+    first.flush()
+    assert second.flush() == ["img/a/1.jpg", "img/a/2.jpg"]  # 1 was published by the first writer
+    pages = [json.loads((gv.FEED_DIR / p["file"]).read_text()) for p in second.manifest["pages"]]
+    assert [(entry["id"], entry["videoUrl"]) for page in pages for entry in page] == [
+        ("1", "https://r2/1.mp4"), ("2", "https://r2/2.mp4"),
+    ]
+    assert (gv.FEED_DIR / "urls.txt").read_text().splitlines() == ["https://r2/1.mp4", "https://r2/2.mp4"]
+
+
+def test_prioritize_ranks_within_a_sliding_window():
+    items = [{"path": f"{acct}/{i}.jpg", "account": acct, "favorite_count": fav, "extra": "dropped"}
+             for i, (acct, fav) in enumerate([("a", 1), ("b", 5), ("a", 3), ("b", 3), ("a", 9), ("a", 0)])]
+    score = gv.priority_score()
+    ranked = list(gv.prioritize(items, score))
+    assert [item["path"] for item in ranked] == ["a/4.jpg", "b/1.jpg", "a/2.jpg", "b/3.jpg", "a/0.jpg", "a/5.jpg"]
+    assert "extra" not in ranked[0]  # only what submission and the feed need
+    # A window of 2 holds back at most two items: the 9 cannot overtake ones already sent
+    windowed = [item["path"] for item in gv.prioritize(items, score, window=2)]
+    assert windowed == ["b/1.jpg", "a/2.jpg", "a/4.jpg", "b/3.jpg", "a/0.jpg", "a/5.jpg"]
+    weighted = gv.priority_score(account_weights={"b": 10})
+    assert [item["path"] for item in gv.prioritize(items, weighted)][:2] == ["b/1.jpg", "b/3.jpg"]
+
+
+def test_budget_deadline_and_cost_caps(tmp_path):
+    ledger = tmp_path / "spend.jsonl"
+    late = gv.SubmissionBudget(deadline=time.time() + 60, ledger_file=ledger)
+    assert late.reserve(5, expected_generation=120) is None
+    assert late.stopped.startswith("deadline")
+    assert late.reserve(5, expected_generation=1) is None  # stopped for the rest of the run
+
+    budget = gv.SubmissionBudget(run_cost=1.0, cost_per_second=0.1, ledger_file=ledger)
+    rid = budget.reserve(5)
+    budget.settle(rid, "a.jpg", 5, charged=True)
+    assert budget.reserve(5) is not None
+    assert budget.reserve(1) is None and budget.stopped == "run cost budget of 1 reached"
+    assert budget.summary().startswith("[budget] run: 5s ($0.50)")
+    assert gv.SubmissionBudget(persist=False, ledger_file=tmp_path / "none.jsonl").reserve(5) is not None
+    assert not (tmp_path / "none.jsonl").exists()
+
+
+def test_stage_images_uploads_each_image_once_and_submits_its_url(workdir, monkeypatch):
+    image = b"\xff\xd8" + bytes(range(256)) * 64  # 16 KB, bigger than a URL by far
+    # Items 0 and 2 (and 1 and 3) have different templates, so only the staged copy is shared
+    manifest = build_manifest(workdir, 4, [image, image + b"2", image, image + b"2"])
+
+    async def scenario():
+        async with fake_server(monkeypatch) as fake:
+            await gv.run(run_options(manifest, stage_images=True))
+            return fake
+
+    fake = asyncio.run(scenario())
+    assert_all_published(fake, 4)
+    staged = {key: obj for key, obj in fake.objects.items() if key.startswith(f"{gv.R2_BUCKET}/{gv.R2_IMAGE_PREFIX}/")}
+    assert len(staged) == 2 and {obj["size"] for obj in staged.values()} == {len(image), len(image) + 1}
+    assert fake.stats["submit"] == 4 and fake.stats["submit_bytes"] < 4 * len(image)
+    urls = gv.GenerationCache(gv.STAGED_IMAGES_FILE).load()
+    assert sorted(entry["url"] for entry in urls.entries.values()) == sorted(
+        f"{gv.R2_PUBLIC_URL}/{key.partition('/')[2]}" for key in staged
+    )
+
+
+LORA = "https://example.com/lora.safetensors"
+
+
+@pytest.mark.parametrize("preset, error", [
+    ({"prompt": ""}, "prompt must be a non-empty string"),
+    ({"prompt": "p", "duration": 5.5}, "duration must be a positive whole number"),
+    ({"prompt": "p", "duration": True}, "duration must be a positive whole number"),
+    ({"prompt": "p", "loras": [{"path": "lora.safetensors", "scale": 1}]}, "path must be an http(s) URL"),
+    ({"prompt": "p", "loras": [{"path": LORA, "scale": "1"}]}, "scale must be a number"),
+    ({"prompt": "p", "seed": 1}, "unknown fields ['seed']"),
+])
+def test_preset_registry_rejects_invalid_presets(preset, error):
+    with pytest.raises(ValueError, match=re.escape(error)):
+        gv.PresetRegistry({"general": preset})
+
+
+def test_preset_templates_serialize_once_and_fingerprint_their_settings(tmp_path):
+    registry = gv.PresetRegistry({
+        "general": {"prompt": "walk", "duration": 5},
+        "doggy": {"loras": [{"path": LORA, "scale": 0.8}], "duration": 8, "prompt": "run"},
+    })
+    template = registry.get("doggy")
+    assert json.loads(template.body("data:image/jpeg;base64,AAAA")) == {
+        "prompt": "run", "duration": 8, "loras": [{"path": LORA, "scale": 0.8}], "image": "data:image/jpeg;base64,AAAA",
+    }
+    assert template.duration == 8
+    assert registry.get("unknown") is registry.get("general")
+
+    # Same settings in another order: same fingerprint; any change, or downscaling, gives a new one
+    reordered = gv.PresetRegistry({"general": {"duration": 5, "prompt": "walk"}})
+    assert reordered.fingerprints()["general"] == registry.fingerprints()["general"]
+    assert gv.PresetRegistry({"general": {"prompt": "walk", "duration": 8}}).get("general").fingerprint != \
+        registry.get("general").fingerprint
+    assert template.fingerprint_for(None) == template.fingerprint != template.fingerprint_for(512)
+
+    presets_file = tmp_path / "presets.json"
+    presets_file.write_text(json.dumps({"oral": {"prompt": "custom", "duration": 3}}))
+    overridden = gv.PresetRegistry.from_file(presets_file)
+    assert overridden.get("oral").spec == {"prompt": "custom", "duration": 3}
+    assert overridden.fingerprints()["doggy"] == gv.PRESETS.fingerprints()["doggy"]
+
+
+def test_timing_model_fits_recorded_entries():
+    entries = [
+        {"status": "completed", "videoUrl": "v", "submittedAt": 0.0, "finishedAt": 100.0, "submitSeconds": 1.0,
+         "submitLimit": 4, "submitAttempts": 2, "throttles": 1, "downloadSeconds": 4.0, "uploadSeconds": 2.0},
+        {"status": "completed", "videoUrl": "v", "submittedAt": 0.0, "finishedAt": 400.0, "submitSeconds": 4.0,
+         "submitLimit": 8, "submitAttempts": 4, "throttles": 3, "downloadSeconds": 4.0, "uploadSeconds": 2.0},
+        {"status": "pending", "finishedAt": 50.0},  # failed last run, reset since
+        {"status": "pending"},
+    ]
+    model = gv.TimingModel.fit(entries)
+    assert model.samples == {"submit": 2, "generation": 2, "download": 2, "upload": 2}
+    assert math.exp(model.stages["generation"][0]) == pytest.approx(200.0)  # geometric mean of 100 and 400
+    assert model.stages["download"] == pytest.approx((math.log(4.0), 0.0))
+    assert model.throttle_rates == {4: 0.5, 8: 0.75}
+    assert model.throttle_rate(5) == 0.5 and model.throttle_rate(6) == 0.75 and model.throttle_rate(100) == 0.75
+    assert model.fail_rate == pytest.approx(1 / 3)
+
+    assumed = gv.TimingModel.fit([])
+    assert assumed.samples["generation"] == 0 and assumed.throttle_rate(4) == 0.0
+    assert math.exp(assumed.stages["generation"][0]) == pytest.approx(gv.PLAN_DEFAULT_SECONDS["generation"])
+
+
+def test_simulate_run_publishes_every_job_and_bills_their_durations():
+    fixed = {"submit": (math.log(1.0), 0.0), "generation": (math.log(60.0), 0.0),
+             "download": (math.log(2.0), 0.0), "upload": (math.log(2.0), 0.0)}
+    model = gv.TimingModel(fixed, dict.fromkeys(fixed, 10), {}, 0.0)
+    result = gv.simulate_run(20, model, concurrency=20, delay=0.0, rng=random.Random(1), durations=[5, 8] * 10)
+    assert result["published"] == result["billable"] == 20
+    assert result["billed_seconds"] == 130
+    assert "throttled" not in result and "failed" not in result
+    # All submitted at once: one generation plus the stages after it, plus finding the result
+    assert 65.0 <= result["makespan"] < 65.0 + gv.POLL_MAX_INTERVAL * (1 + gv.POLL_JITTER)
+    # Serial submits take longer than parallel ones
+    serial = gv.simulate_run(20, model, concurrency=1, max_concurrency=1, delay=2.0, rng=random.Random(1))
+    assert serial["makespan"] > result["makespan"] + 19 * 3.0 - 1
+
+    throttled = gv.TimingModel(fixed, dict.fromkeys(fixed, 10), {1: 1.0}, 0.0)
+    result = gv.simulate_run(3, throttled, concurrency=2, delay=0.0, rng=random.Random(1))
+    assert result["failed"] == 3 and result["throttled"] == 3 * gv.MAX_RETRIES
+    assert "published" not in result and "billable" not in result
+
+
+def test_variant_matrix_expands_every_combination():
+    registry = gv.PresetRegistry({
+        "general": {"prompt": "walk"},
+        "doggy": {"prompt": "run", "duration": 5, "high_noise_loras": [{"path": LORA, "scale": 1.0}],
+                  "variants": {"prompt": ["run", "sprint"]}},
+    }, vary={"scale": [0.5, 2]})
+    variants = registry.variants_for("doggy")
+    assert list(variants) == ["A", "B", "C", "D"]
+    assert registry.variant_settings["doggy"]["D"] == "prompt='sprint' scale=2"
+    assert variants["D"].spec == {"prompt": "sprint", "duration": 5, "high_noise_loras": [{"path": LORA, "scale": 2.0}]}
+    assert variants["A"].spec["high_noise_loras"][0]["scale"] == 0.5
+    assert len({t.fingerprint for t in variants.values()}) == 4
+    assert registry.get("doggy", "B") is variants["B"]
+    assert registry.variants_for("unknown") is registry.variants_for("general")
+
+    items = [{"path": "a/1.jpg", "position": "doggy"}, {"path": "a/2.jpg", "position": "oral"}]
+    expanded = list(registry.expand(items))
+    assert [item["path"] for item in expanded[:4]] == ["a/1.jpg#A", "a/1.jpg#B", "a/1.jpg#C", "a/1.jpg#D"]
+    assert expanded[0]["parent"] == "a/1.jpg" and expanded[0]["variant"] == "A"
+    assert [item["path"] for item in expanded[4:]] == ["a/2.jpg#A", "a/2.jpg#B"]  # "oral" falls back to general
+
+    assert gv.parse_vary("duration=5,8") == ("duration", [5, 8])
+    assert gv.parse_vary("prompt=slow, then fast") == ("prompt", ["slow, then fast"])
+    with pytest.raises(ValueError, match="at most 26"):
+        gv.PresetRegistry({"general": {"prompt": "p"}}, vary={"scale": [1, 2, 3, 4, 5, 6], "duration": [1, 2, 3, 4, 5]})
+    with pytest.raises(ValueError, match="scale must be a positive number"):
+        gv.PresetRegistry({"general": {"prompt": "p"}}, vary={"scale": [0]})
+
+
+def test_variants_are_generated_and_published_separately(workdir, monkeypatch):
+    manifest = build_manifest(workdir, 2)
+
+    async def scenario():
+        async with fake_server(monkeypatch) as fake:
+            await gv.run(run_options(manifest, vary={"duration": [5, 8]}))
+            return fake
+
+    fake = asyncio.run(scenario())
+    progress = assert_all_published(fake, 4)
+    assert sorted(Path(path).name for path in progress) == [
+        "1900000000000000000_1.jpg#A", "1900000000000000000_1.jpg#B",
+        "1900000000000000001_1.jpg#A", "1900000000000000001_1.jpg#B",
+    ]
+    assert fake.stats["submit"] == 4
+    pages = json.loads((gv.FEED_DIR / "pages" / "page-00000.json").read_text())
+    assert sorted(entry["title"].rpartition(" - ")[2] for entry in pages) == ["Variant A", "Variant A", "Variant B", "Variant B"]
+
+
+def test_job_record_reads_like_a_dict():
+    record = gv.JobRecord({"path": "a.jpg", "status": "submitted", "meta": {"account": "a"}, "legacyField": 1})
+    assert record["status"] == "submitted" and record.get("videoUrl") is None and record.get("error", "-") == "-"
+    assert "meta" in record and "legacyField" in record and "videoUrl" not in record
+    with pytest.raises(KeyError):
+        record["videoUrl"]
+    assert record.to_dict() == {"path": "a.jpg", "status": "submitted", "meta": {"account": "a"}, "legacyField": 1}
+    assert not hasattr(record, "__dict__")
+
+
+def test_progress_status_index_follows_updates_and_reloads(tmp_path):
+    store = gv.ProgressStore(tmp_path / "p.json", tmp_path / "p.journal").load()
+    for i in range(4):
+        store.update(f"{i}.jpg", status="pending")
+    store.update("0.jpg", status="submitted", requestId="r0")
+    store.update("1.jpg", status="completed", videoUrl="v1")
+    store.update("2.jpg", status="completed", videoUrl="v2")
+    store.update("2.jpg", published=True)
+    store.update("3.jpg", status="failed", error="boom")
+    assert store.counts == {"submitted": 1, "completed": 2, "failed": 1}
+    assert store.paths("completed") == {"1.jpg", "2.jpg"}
+    assert store.unpublished() == {"1.jpg"}
+    assert store.paths("pending") == set() and "pending" not in store.counts
+    store.update("3.jpg", status="pending", error=None)  # retried
+    store.close()
+
+    reloaded = gv.ProgressStore(tmp_path / "p.json", tmp_path / "p.journal").load()
+    assert reloaded.counts == {"submitted": 1, "completed": 2, "pending": 1}
+    assert reloaded.unpublished() == {"1.jpg"} and reloaded.paths("pending") == {"3.jpg"}
+    assert isinstance(reloaded["0.jpg"], gv.JobRecord) and reloaded["0.jpg"]["requestId"] == "r0"
+
+
+def test_lora_batcher_forms_runs_without_starving_groups():
+    batcher = gv.LoraBatcher(key=lambda item: item["set"], run_length=2, window=4)
+    items = [{"path": str(i), "set": s} for i, s in enumerate("aabbab")]
+    ready = []
+    for item in items[:3]:
+        assert batcher.add(item) == []  # waits for a full window
+    ready += batcher.add(items[3])
+    assert [item["path"] for item in ready] == ["0", "1"]  # a's oldest item came first
+    ready += batcher.add(items[4])
+    ready += batcher.add(items[5])
+    ready += batcher.drain()
+    assert [(item["path"], item["set"]) for item in ready] == [
+        ("0", "a"), ("1", "a"), ("2", "b"), ("3", "b"), ("4", "a"), ("5", "b"),
+    ]
+    assert batcher.waiting == 0 and not batcher.groups
+
+
+def test_lora_runs_group_submissions_by_lora_set(workdir, monkeypatch):
+    manifest = build_manifest(workdir, 12)
+    positions = {item["path"]: item["position"] for item in json.loads(manifest.read_text())}
+    groups = {position: key for key, members in gv.PRESETS.lora_groups().items() for position in members}
+
+    async def scenario():
+        async with fake_server(monkeypatch, lora_switch=0.05) as fake:
+            await gv.run(run_options(manifest, concurrency=1, max_concurrency=1, lora_runs=4, lora_window=12))
+            return fake
+
+    fake = asyncio.run(scenario())
+    progress = assert_all_published(fake, 12)
+    order = sorted(progress, key=lambda path: progress[path]["submittedAt"])
+    sets = [groups[positions[path]] for path in order]
+    switches = sum(a != b for a, b in zip(sets, sets[1:]))
+    assert switches == len(set(sets)) - 1  # every set sent in one run
+    assert fake.stats["lora_switch"] == len(set(sets))
+    assert {progress[path]["loraGroup"] for path in order} == set(sets)
+
+
+def test_perceptual_clusters_link_to_the_first_image_without_chaining(tmp_path, monkeypatch):
+    np = pytest.importorskip("numpy")
+    index = gv.PerceptualIndex(1, tmp_path / "phash.jsonl")
+    # b is 3 bits from a; c is 3 bits from b but 6 from a; d is 1 bit from c; e is far from everything
+    index.hashes = {"a": 0, "b": 0b111, "c": 0b111111, "d": 0b1111111, "e": (1 << 64) - 1}
+    expected = {"b": "a", "d": "c"}
+    assert index.clusters(["a", "b", "c", "d", "e", "unhashed"], threshold=4) == expected
+    assert index.clusters(["c", "b", "a"], threshold=4) == {"b": "c"}  # order decides the representative
+    monkeypatch.delattr(np, "bitwise_count", raising=False)  # NumPy < 2
+    assert index.clusters(["a", "b", "c", "d", "e"], threshold=4) == expected
+
+
+def test_perceptual_index_matches_re_encoded_images_and_caches_hashes(tmp_path):
+    pytest.importorskip("numpy")
+    Image = pytest.importorskip("PIL.Image")
+    gradient = Image.new("L", (128, 128))
+    gradient.putdata([(i * 7 + j * 3) % 256 for j in range(128) for i in range(128)])
+    gradient.convert("RGB").save(tmp_path / "a.jpg", quality=95)
+    gradient.resize((96, 96)).convert("RGB").save(tmp_path / "a_small.jpg", quality=60)
+    gradient.transpose(Image.Transpose.ROTATE_90).convert("RGB").save(tmp_path / "b.jpg")
+    (tmp_path / "broken.jpg").write_bytes(b"not an image")
+    paths = [str(tmp_path / name) for name in ("a.jpg", "a_small.jpg", "b.jpg", "broken.jpg")]
+
+    index = gv.PerceptualIndex(1, tmp_path / "phash.jsonl").load()
+    index.update(paths)
+    assert set(index.hashes) == set(paths[:3])
+    assert index.clusters(paths) == {paths[1]: paths[0]}
+    index.close()
+    records = (tmp_path / "phash.jsonl").read_text()
+
+    again = gv.PerceptualIndex(1, tmp_path / "phash.jsonl").load()
+    again.update(paths)  # nothing changed: nothing hashed again
+    assert (tmp_path / "phash.jsonl").read_text() == records
+    assert again.hashes == index.hashes